@@ -0,0 +1,339 @@
+import os
+import json
+import numpy as np
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def write_array_store(X,
+                      y,
+                      store_path,
+                      shard_size=512):
+
+    """
+    Writes an image dataset to a sharded array store: a directory holding the images as fixed-size uint8 .npy shards,
+    the class labels as a single small array and a manifest describing both. X is copied one shard at a time, so it
+    can itself be a memory-mapped array (eg. np.load(..., mmap_mode='r')) larger than available memory.
+
+    Paramters:
+        X: (array) the image data; shape: (number of images, height, width, 3)
+        y: (array) the one-hot encoded class data, or an array of integer class labels
+        store_path: (string with quotes) directory in which the store is created
+        shard_size: (int) number of images per shard
+
+    Returns:
+        store: (ArrayStore) the newly written store, opened for reading
+    """
+
+    y = np.asarray(y)
+    labels = y.argmax(axis=1) if y.ndim == 2 else y
+    n_classes = int(y.shape[1]) if y.ndim == 2 else int(labels.max()) + 1
+
+    os.makedirs(store_path, exist_ok=True)
+    np.save(os.path.join(store_path, 'labels.npy'), labels.astype(np.int16))
+
+    shards = []
+    for start in range(0, len(X), shard_size):
+        shard_file = f'X_{len(shards):05d}.npy'
+        shard = np.ascontiguousarray(X[start:start+shard_size], dtype=np.uint8)
+        np.save(os.path.join(store_path, shard_file), shard)
+        shards.append({'file': shard_file, 'start': start, 'count': len(shard)})
+
+    manifest = {'version': 1,
+                'n_items': int(len(X)),
+                'item_shape': [int(i) for i in X.shape[1:]],
+                'dtype': 'uint8',
+                'shard_size': int(shard_size),
+                'n_classes': n_classes,
+                'labels_file': 'labels.npy',
+                'shards': shards}
+
+    _write_manifest(store_path, manifest)
+
+    return ArrayStore(store_path)
+
+
+def append_array_store(X,
+                       y,
+                       store_path,
+                       shard_size=512,
+                       n_classes=None):
+
+    """
+    Appends images to an existing sharded array store (or creates it), writing only new shards: existing shards are
+    never rewritten, and the manifest is replaced in one step once the new shards are on disk.
+
+    Paramters:
+        X: (array) the new image data; shape: (number of new images, height, width, 3)
+        y: (array) the new one-hot encoded class data, or an array of integer class labels
+        store_path: (string with quotes) directory of the store
+        shard_size: (int) number of images per new shard
+        n_classes: (int) number of classes, needed when creating a store from integer labels that may not cover them all
+
+    Returns:
+        store: (ArrayStore) the updated store, opened for reading
+    """
+
+    y = np.asarray(y)
+    new_labels = (y.argmax(axis=1) if y.ndim == 2 else y).astype(np.int16)
+
+    if not os.path.exists(os.path.join(store_path, MANIFEST_NAME)):
+        store = write_array_store(X, new_labels, store_path, shard_size=shard_size)
+        if n_classes is not None and n_classes != store.n_classes:
+            store.manifest['n_classes'] = int(n_classes)
+            _write_manifest(store_path, store.manifest)
+            store = ArrayStore(store_path)
+        return store
+
+    store = ArrayStore(store_path)
+    manifest = store.manifest
+    if tuple(X.shape[1:]) != store.item_shape and len(X):
+        raise ValueError(f'cannot append images of shape {X.shape[1:]} to a store of shape {store.item_shape}')
+
+    start = manifest['n_items']
+    shards = manifest['shards']
+    file_no = _next_file_no(manifest)
+    for i in range(0, len(X), shard_size):
+        shard_file = f'X_{file_no:05d}.npy'
+        file_no += 1
+        shard = np.ascontiguousarray(X[i:i+shard_size], dtype=np.uint8)
+        np.save(os.path.join(store_path, shard_file), shard)
+        shards.append({'file': shard_file, 'start': start + i, 'count': len(shard)})
+
+    labels_file = f'labels_{file_no:05d}.npy'
+    np.save(os.path.join(store_path, labels_file), np.concatenate([np.asarray(store.labels), new_labels]))
+    old_labels_file = manifest['labels_file']
+
+    manifest['n_items'] = start + len(X)
+    manifest['labels_file'] = labels_file
+    if y.ndim == 2:
+        manifest['n_classes'] = max(manifest['n_classes'], int(y.shape[1]))
+    elif len(new_labels):
+        manifest['n_classes'] = max(manifest['n_classes'], int(new_labels.max()) + 1)
+    _write_manifest(store_path, manifest)
+
+    del store
+    if old_labels_file != labels_file:
+        os.remove(os.path.join(store_path, old_labels_file))
+
+    return ArrayStore(store_path)
+
+
+def remove_array_store_rows(store_path,
+                            rows):
+
+    """
+    Removes images from an array store, eg. images whose source file has changed or been deleted. Later images move
+    up so the store stays contiguous, so only the shards from the first removed row onwards are rewritten. They are
+    written under new file names, and the manifest is replaced in one step before the old shards are deleted, so
+    readers never see a half-rewritten store.
+
+    Paramters:
+        store_path: (string with quotes) directory of the store
+        rows: (array of ints) positions of the images to remove
+
+    Returns:
+        new_rows: (int64 array) new position of every old row, -1 for the removed rows
+    """
+
+    store = ArrayStore(store_path)
+    keep = np.ones(len(store), dtype=bool)
+    rows = np.unique(np.asarray(rows, dtype=np.int64))
+    keep[rows] = False
+    new_rows = np.full(len(store), -1, dtype=np.int64)
+    new_rows[keep] = np.arange(int(keep.sum()))
+    if not len(rows):
+        return new_rows
+
+    manifest = store.manifest
+    shards = manifest['shards']
+    first = int(np.searchsorted(store._starts, rows[0], side='right') - 1)
+    start = shards[first]['start']
+    live = np.flatnonzero(keep[start:]) + start
+
+    file_no = _next_file_no(manifest)
+    new_shards = []
+    for i in range(0, len(live), manifest['shard_size']):
+        shard_file = f'X_{file_no:05d}.npy'
+        file_no += 1
+        shard = store[live[i:i+manifest['shard_size']]]
+        np.save(os.path.join(store_path, shard_file), shard)
+        new_shards.append({'file': shard_file, 'start': start + i, 'count': len(shard)})
+
+    labels_file = f'labels_{file_no:05d}.npy'
+    np.save(os.path.join(store_path, labels_file), np.asarray(store.labels)[keep])
+    old_files = [s['file'] for s in shards[first:]] + [manifest['labels_file']]
+
+    manifest['shards'] = shards[:first] + new_shards
+    manifest['n_items'] = int(keep.sum())
+    manifest['labels_file'] = labels_file
+    _write_manifest(store_path, manifest)
+
+    del store
+    for f in old_files:
+        os.remove(os.path.join(store_path, f))
+
+    return new_rows
+
+
+def _next_file_no(manifest):
+    # number for the next shard or labels file, past every file in the store (numbers are never reused, so a new
+    # file never overwrites one that a reader of the previous manifest may still use)
+    names = [s['file'] for s in manifest['shards']] + [manifest['labels_file']]
+    return max([int(''.join(c for c in n if c.isdigit()) or -1) for n in names] + [-1]) + 1
+
+
+def _write_manifest(store_path,
+                    manifest):
+
+    # writing to a temporary file first so that a crash never leaves a half-written manifest
+    tmp_path = os.path.join(store_path, MANIFEST_NAME + '.tmp')
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(tmp_path, os.path.join(store_path, MANIFEST_NAME))
+
+
+class ArrayStore:
+
+    """
+    Read access to a sharded array store written by write_array_store. Shards are opened memory-mapped on first use,
+    so opening a store costs only the manifest and label reads; images are paged in per requested batch, and
+    normalization to float (x/255) is applied to that batch only.
+
+    Paramters:
+        store_path: (string with quotes) directory containing the store manifest
+    """
+
+    def __init__(self, store_path):
+
+        self.store_path = store_path
+        with open(os.path.join(store_path, MANIFEST_NAME)) as file:
+            self.manifest = json.load(file)
+        self.labels = np.load(os.path.join(store_path, self.manifest['labels_file']), mmap_mode='r')
+        self.n_classes = self.manifest['n_classes']
+        self.item_shape = tuple(self.manifest['item_shape'])
+        self._starts = np.array([s['start'] for s in self.manifest['shards']], dtype=np.int64)
+        self._shards = {}
+
+    def __len__(self):
+        return self.manifest['n_items']
+
+    @property
+    def shape(self):
+        return (len(self),) + self.item_shape
+
+    @property
+    def y(self):
+        """One-hot encoded labels for the whole store, in the same format as the y_*_data.npy files."""
+        return np.eye(self.n_classes, dtype=np.float32)[self.labels]
+
+    def _shard(self, shard_no):
+        if shard_no not in self._shards:
+            shard_file = os.path.join(self.store_path, self.manifest['shards'][shard_no]['file'])
+            self._shards[shard_no] = np.load(shard_file, mmap_mode='r')
+        return self._shards[shard_no]
+
+    def get(self,
+            indices,
+            normalize=True):
+
+        """
+        Returns the images at the given indices, reading only the shards they fall in.
+
+        Paramters:
+            indices: (int, slice or array of ints) positions of the images in the store
+            normalize: (bool) scales the returned batch to float32 in [0, 1] (defaults to True)
+
+        Returns:
+            X_batch: (array) the requested images; a single image if indices is an int
+        """
+
+        if isinstance(indices, (int, np.integer)):
+            return self.get([indices], normalize=normalize)[0]
+        if isinstance(indices, slice):
+            indices = range(*indices.indices(len(self)))
+
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) and (indices.min() < -len(self) or indices.max() >= len(self)):
+            raise IndexError(f'index out of range for store of size {len(self)}')
+        indices = indices % max(len(self), 1)
+
+        out = np.empty((len(indices),) + self.item_shape, dtype=np.float32 if normalize else np.uint8)
+
+        # grouping the requested indices by shard so each shard is visited once
+        shard_nos = np.searchsorted(self._starts, indices, side='right') - 1
+        for shard_no in np.unique(shard_nos):
+            pos = np.flatnonzero(shard_nos == shard_no)
+            local = indices[pos] - self._starts[shard_no]
+            out[pos] = self._shard(int(shard_no))[local]
+
+        if normalize:
+            out *= (1./255)
+
+        return out
+
+    def __getitem__(self, indices):
+        return self.get(indices, normalize=False)
+
+    def class_indices(self, class_no):
+        """Positions in the store of every image of the given (integer) class."""
+        return np.flatnonzero(np.asarray(self.labels) == class_no)
+
+    def get_class(self,
+                  class_no,
+                  normalize=True):
+
+        """
+        Returns every image of the given (integer) class, along with their positions in the store.
+        """
+
+        indices = self.class_indices(class_no)
+        return self.get(indices, normalize=normalize), indices
+
+    def iter_batches(self,
+                     batch_size=32,
+                     indices=None,
+                     normalize=True):
+
+        """
+        Yields (X_batch, y_batch) pairs over the store (or over the given indices) in order, so that only one batch of
+        images is ever held in memory.
+        """
+
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.asarray(indices, dtype=np.int64)
+        eye = np.eye(self.n_classes, dtype=np.float32)
+
+        for i in range(0, len(indices), batch_size):
+            batch_idx = indices[i:i+batch_size]
+            yield self.get(batch_idx, normalize=normalize), eye[np.asarray(self.labels)[batch_idx]]
+
+
+def open_array_data(subset,
+                    data_path='../data/0002_array_data/'):
+
+    """
+    Opens one of the train/val/test subsets without loading it into memory. The sharded store is used when it has
+    been written (see data_processing.ipynb), otherwise the monolithic .npy files are opened memory-mapped.
+
+    Paramters:
+        subset: (string with quotes) 'train', 'val' or 'test'
+        data_path: (string with quotes) base path of the array data directory
+
+    Returns:
+        X: (ArrayStore or memory-mapped uint8 array) the image data, not normalized
+        y: (array) the one-hot encoded class data
+    """
+
+    folder = 'test_data' if subset == 'test' else 'train_data'
+    store_path = f'{data_path}{folder}/X_{subset}_store'
+
+    if os.path.exists(os.path.join(store_path, MANIFEST_NAME)):
+        store = ArrayStore(store_path)
+        return store, store.y
+
+    X = np.load(f'{data_path}{folder}/X_{subset}_data.npy', mmap_mode='r')
+    y = np.load(f'{data_path}{folder}/y_{subset}_data.npy')
+    return X, y
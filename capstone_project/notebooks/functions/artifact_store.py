@@ -0,0 +1,239 @@
+import os
+import time
+import shutil
+import sqlite3
+from functions.file_hash import file_hash
+
+
+MODEL_PATH = '../notebooks/model_construction/saved_models/'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    source TEXT,
+    val_acc REAL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    name TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL REFERENCES objects (sha256),
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_val_acc ON objects (val_acc);
+"""
+
+
+def _link_or_copy(src,
+                  dst):
+
+    # places src at dst atomically: hardlink (or copy, where hardlinks are not supported) to a temporary name in the
+    # destination directory, then rename over dst, so dst is always either the old or the complete new file
+    tmp = f'{dst}.{os.getpid()}.tmp'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ArtifactStore:
+
+    """
+    A content-addressed store for saved model files. Every checkpoint is kept once, under its SHA-256 hash, with its
+    validation accuracy and origin recorded in an SQLite index; named models (eg. model_13.h5 in the saved models
+    folder) are hardlinks to stored objects. Promoting a checkpoint to a name is therefore a link and an atomic rename
+    - no model is deserialized, no bytes are copied, and a crash can never leave a half-written named model. Objects
+    that no name points to are subject to a retention policy (keep the best N by val_acc) and are deleted in bulk.
+
+    Named models share their bytes with the stored object, so they must be treated as read-only: write new checkpoints
+    under a new file name (as the trial checkpoints are) and promote them, rather than saving over a named model.
+
+    Paramters:
+        root: (string with quotes) directory of the store (defaults to artifacts/ in the saved models folder)
+        model_path: (string with quotes) folder where named models are linked
+    """
+
+    def __init__(self,
+                 root=None,
+                 model_path=MODEL_PATH):
+
+        self.model_path = model_path
+        self.root = root or os.path.join(model_path, 'artifacts')
+        self.objects_path = os.path.join(self.root, 'objects')
+        os.makedirs(self.objects_path, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=60)
+        self.conn.executescript(SCHEMA)
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_path, sha256[:2], f'{sha256}.h5')
+
+    def put(self,
+            file_path,
+            val_acc=None,
+            source=None,
+            remove_source=False):
+
+        """
+        Adds a model file to the store (a no-op for content that is already stored, apart from filling in val_acc).
+
+        Paramters:
+            file_path: (string with quotes) path of the .h5 file
+            val_acc: (float) validation accuracy of the checkpoint, used by the retention policy
+            source: (string with quotes) name of the trial the checkpoint comes from (defaults to the file name)
+            remove_source: (bool) removes file_path once stored (the object keeps the bytes, no copy is made)
+
+        Returns:
+            sha256: (string) content hash identifying the stored object
+        """
+
+        sha256 = file_hash(file_path)
+        obj = self.object_path(sha256)
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            _link_or_copy(file_path, obj)
+            os.chmod(obj, 0o444)
+
+        source = source or os.path.splitext(os.path.basename(file_path))[0]
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO objects VALUES (?, ?, ?, ?, ?)',
+                              (sha256, os.path.getsize(obj), source, val_acc, time.time()))
+            if val_acc is not None:
+                self.conn.execute('UPDATE objects SET val_acc = ? WHERE sha256 = ?', (val_acc, sha256))
+
+        if remove_source:
+            os.remove(file_path)
+
+        return sha256
+
+    def promote(self,
+                name,
+                sha256):
+
+        """
+        Points a model name at a stored object by atomically replacing {model_path}{name}.h5 with a hardlink to it.
+        """
+
+        obj = self.object_path(sha256)
+        if not os.path.exists(obj):
+            raise KeyError(f'{sha256} is not in the artifact store')
+        _link_or_copy(obj, os.path.join(self.model_path, f'{name}.h5'))
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO refs VALUES (?, ?, ?)', (name, sha256, time.time()))
+
+    def resolve(self, name):
+
+        """
+        Returns the hash of the object a model name points to, or None for names that are not managed by the store.
+        """
+
+        row = self.conn.execute('SELECT sha256 FROM refs WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def refs(self):
+        return dict(self.conn.execute('SELECT name, sha256 FROM refs ORDER BY name'))
+
+    def release(self, name):
+
+        """
+        Removes a model name (and its linked file); the object stays in the store until the retention policy drops it.
+        """
+
+        with self.conn:
+            self.conn.execute('DELETE FROM refs WHERE name = ?', (name,))
+        path = os.path.join(self.model_path, f'{name}.h5')
+        if os.path.exists(path):
+            os.remove(path)
+
+    def retain(self,
+               keep_top=5):
+
+        """
+        Applies the retention policy: objects pointed to by a model name are always kept, and of the others only the
+        keep_top with the highest val_acc; the rest are deleted from the index and the disk in one pass.
+
+        Returns:
+            freed: (int) number of bytes freed
+        """
+
+        unreferenced = [r[0] for r in self.conn.execute(
+            'SELECT sha256 FROM objects WHERE sha256 NOT IN (SELECT sha256 FROM refs) '
+            'ORDER BY val_acc IS NULL, val_acc DESC, created DESC')]
+        drop = unreferenced[keep_top:]
+
+        freed = 0
+        for sha256 in drop:
+            obj = self.object_path(sha256)
+            if os.path.exists(obj):
+                freed += os.path.getsize(obj)
+                os.remove(obj)
+        with self.conn:
+            self.conn.executemany('DELETE FROM objects WHERE sha256 = ?', [(s,) for s in drop])
+
+        print(f'{len(drop)} artifacts removed, {round(freed/2**20,1)}MB freed!')
+
+        return freed
+
+    def gc(self):
+
+        """
+        Deletes object files that are not in the index (eg. left behind by an interrupted run) and stale temporary
+        files, and drops index entries whose file has gone missing.
+
+        Returns:
+            freed: (int) number of bytes freed
+        """
+
+        known = set(r[0] for r in self.conn.execute('SELECT sha256 FROM objects'))
+        freed = 0
+        for dir_path, _, file_names in os.walk(self.objects_path):
+            for file_name in file_names:
+                sha256 = file_name.split('.')[0]
+                if file_name.endswith('.tmp') or sha256 not in known:
+                    path = os.path.join(dir_path, file_name)
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                else:
+                    known.discard(sha256)
+
+        referenced = set(self.refs().values())
+        with self.conn:
+            self.conn.executemany('DELETE FROM objects WHERE sha256 = ?', [(s,) for s in known - referenced])
+
+        return freed
+
+    def verify(self):
+
+        """
+        Re-hashes every stored object and returns the hashes whose content no longer matches (eg. because a named
+        model was saved over in place).
+        """
+
+        return [s for (s,) in self.conn.execute('SELECT sha256 FROM objects')
+                if os.path.exists(self.object_path(s)) and file_hash(self.object_path(s)) != s]
+
+    def close(self):
+        self.conn.close()
+
+
+def remove_checkpoints(names,
+                       model_path=MODEL_PATH,
+                       trash=True):
+
+    """
+    Removes the .h5 checkpoints of the given trials from the saved models folder in one batch (sent to the trash by
+    default, deleted otherwise), skipping those that do not exist.
+
+    Returns:
+        removed: (list of strings) names of the checkpoints removed
+    """
+
+    paths = {n: os.path.join(model_path, f'{n}.h5') for n in names}
+    paths = {n: p for n, p in paths.items() if os.path.exists(p)}
+    if trash and paths:
+        from send2trash import send2trash
+        send2trash(list(paths.values()))
+    else:
+        for p in paths.values():
+            os.remove(p)
+    return list(paths)
@@ -0,0 +1,343 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from keras.callbacks import Callback
+
+
+CV2_BORDERS = {'nearest': cv2.BORDER_REPLICATE,
+               'constant': cv2.BORDER_CONSTANT,
+               'reflect': cv2.BORDER_REFLECT,
+               'wrap': cv2.BORDER_WRAP}
+
+
+def random_affine_matrices(n,
+                           img_shape,
+                           rng,
+                           rotation_range=0,
+                           width_shift_range=0.,
+                           height_shift_range=0.,
+                           shear_range=0.,
+                           zoom_range=0.,
+                           horizontal_flip=False,
+                           vertical_flip=False):
+
+    """
+    Draws n random affine transforms with the same parameter semantics as keras' ImageDataGenerator (rotation and shear
+    in degrees, shifts as fractions of the image size, zoom in [1-zoom_range, 1+zoom_range], random flips), composed
+    into one matrix per image that maps output (row, col) coordinates to input coordinates.
+
+    Paramters:
+        n: (int) number of transforms
+        img_shape: (tuple) (height, width) of the images
+        rng: (np.random.Generator) source of randomness
+        rotation_range, width_shift_range, height_shift_range, shear_range, zoom_range, horizontal_flip,
+        vertical_flip: as for keras' ImageDataGenerator
+
+    Returns:
+        matrices: (float32 array) shape: (n, 3, 3)
+    """
+
+    h, w = img_shape[:2]
+
+    def uniform(r):
+        return rng.uniform(-r, r, n) if r else np.zeros(n)
+
+    theta = np.deg2rad(uniform(rotation_range))
+    tx = uniform(height_shift_range) * (h if height_shift_range < 1 else 1)
+    ty = uniform(width_shift_range) * (w if width_shift_range < 1 else 1)
+    shear = np.deg2rad(uniform(shear_range))
+    if zoom_range:
+        zx, zy = rng.uniform(1 - zoom_range, 1 + zoom_range, (2, n))
+    else:
+        zx = zy = np.ones(n)
+
+    zeros, ones = np.zeros(n), np.ones(n)
+    rotation = np.stack([np.stack([np.cos(theta), -np.sin(theta), zeros], -1),
+                         np.stack([np.sin(theta), np.cos(theta), zeros], -1),
+                         np.stack([zeros, zeros, ones], -1)], 1)
+    shift = np.stack([np.stack([ones, zeros, tx], -1),
+                      np.stack([zeros, ones, ty], -1),
+                      np.stack([zeros, zeros, ones], -1)], 1)
+    shear_m = np.stack([np.stack([ones, -np.sin(shear), zeros], -1),
+                        np.stack([zeros, np.cos(shear), zeros], -1),
+                        np.stack([zeros, zeros, ones], -1)], 1)
+    zoom = np.stack([np.stack([zx, zeros, zeros], -1),
+                     np.stack([zeros, zy, zeros], -1),
+                     np.stack([zeros, zeros, ones], -1)], 1)
+
+    # transforming about the image centre, as keras does
+    o_x, o_y = h / 2 - 0.5, w / 2 - 0.5
+    offset = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
+    reset = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
+    matrices = offset @ rotation @ shift @ shear_m @ zoom @ reset
+
+    # flips are applied to the output, so they are folded in on the right
+    flip = np.tile(np.eye(3), (n, 1, 1))
+    if horizontal_flip:
+        fh = rng.random(n) < 0.5
+        flip[fh, 1, 1] = -1
+        flip[fh, 1, 2] = w - 1
+    if vertical_flip:
+        fv = rng.random(n) < 0.5
+        flip[fv, 0, 0] = -1
+        flip[fv, 0, 2] = h - 1
+
+    return (matrices @ flip).astype(np.float32)
+
+
+def _map_index(i,
+               size,
+               fill_mode):
+
+    # maps (possibly out of range) integer coordinates back into the image, returning the indices and a validity mask
+    if fill_mode == 'nearest':
+        return np.clip(i, 0, size - 1), None
+    if fill_mode == 'wrap':
+        return np.mod(i, size), None
+    if fill_mode == 'reflect':
+        m = np.mod(i, 2*size)
+        return np.where(m >= size, 2*size - 1 - m, m), None
+    valid = (i >= 0) & (i < size)
+    return np.clip(i, 0, size - 1), valid
+
+
+def apply_affine_batch(X,
+                       matrices,
+                       fill_mode='nearest',
+                       cval=0.,
+                       backend='cv2'):
+
+    """
+    Applies one affine transform per image to a whole batch with bilinear interpolation. The 'cv2' backend warps
+    each image with cv2.warpAffine, which releases the GIL and so scales across the producer threads of
+    AugmentedFlow; the 'numpy' backend transforms the whole batch at once with vectorized gathers, with no per-image
+    Python loop (about an order of magnitude slower on a single core, but dependency-free and exact in float32).
+
+    Paramters:
+        X: (array) batch of images; shape: (number of images, height, width, channels)
+        matrices: (array) output-to-input coordinate transforms; shape: (number of images, 3, 3)
+        fill_mode: (string with quotes) 'nearest', 'constant', 'reflect' or 'wrap', as for ImageDataGenerator
+        cval: (float) fill value used with fill_mode='constant'
+        backend: (string with quotes) 'cv2' or 'numpy'
+
+    Returns:
+        X_out: (float32 array) the transformed batch, same shape as X
+    """
+
+    n, h, w, c = X.shape
+
+    if backend == 'cv2':
+        out = np.empty(X.shape, dtype=np.float32)
+        for i, m in enumerate(matrices):
+            # cv2 works in (x, y) = (col, row) coordinates, so rows and columns of the transform are swapped
+            cv_m = np.array([[m[1, 1], m[1, 0], m[1, 2]], [m[0, 1], m[0, 0], m[0, 2]]], dtype=np.float32)
+            warped = cv2.warpAffine(X[i], cv_m, (w, h), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                    borderMode=CV2_BORDERS[fill_mode], borderValue=(cval,)*4)
+            out[i] = warped.reshape(h, w, c)
+        return out
+
+    rows, cols = np.mgrid[0:h, 0:w]
+    coords = np.stack([rows.ravel(), cols.ravel(), np.ones(h*w)]).astype(np.float32)
+    src = np.asarray(matrices, dtype=np.float32)[:, :2] @ coords
+
+    r0 = np.floor(src[:, 0])
+    c0 = np.floor(src[:, 1])
+    dr = (src[:, 0] - r0)[..., None]
+    dc = (src[:, 1] - c0)[..., None]
+    r0 = r0.astype(np.int64)
+    c0 = c0.astype(np.int64)
+
+    X_flat = X.reshape(n, h*w, c)
+    out = np.zeros((n, h*w, c), dtype=np.float32)
+
+    for r_off, c_off, weight in ((0, 0, (1 - dr)*(1 - dc)), (0, 1, (1 - dr)*dc),
+                                 (1, 0, dr*(1 - dc)), (1, 1, dr*dc)):
+        ri, r_valid = _map_index(r0 + r_off, h, fill_mode)
+        ci, c_valid = _map_index(c0 + c_off, w, fill_mode)
+        vals = np.take_along_axis(X_flat, (ri*w + ci)[..., None], axis=1).astype(np.float32)
+        if r_valid is not None:
+            vals = np.where((r_valid & c_valid)[..., None], vals, np.float32(cval))
+        out += weight*vals
+
+    return out.reshape(n, h, w, c)
+
+
+class AugmentedFlow:
+
+    """
+    A drop-in replacement for ImageDataGenerator(...).flow(X, y, batch_size) when training with model.fit. Each batch
+    is augmented as a whole (see apply_affine_batch) and batches are produced by a pool of background threads, a fixed
+    number of batches ahead of the model. The time the training loop spends waiting for a batch (input stall) is
+    recorded; see PipelineStallLogger.
+
+    Paramters:
+        X: (array, memory-mapped array or ArrayStore) the images, not normalized
+        y: (array) the one-hot encoded class data
+        batch_size: (int) number of images per batch
+        rescale: (float) factor applied to every pixel value after augmentation (eg. 1./255)
+        rotation_range, width_shift_range, height_shift_range, shear_range, zoom_range, fill_mode, cval,
+        horizontal_flip, vertical_flip: augmentation options, as for keras' ImageDataGenerator
+        shuffle: (bool) reshuffles the images every epoch
+        seed: (int) seed for shuffling and augmentation, making every batch reproducible
+        n_workers: (int) number of threads producing batches (defaults to the number of cores)
+        prefetch: (int) number of batches kept ready ahead of the model
+        backend: (string with quotes) warping backend, 'cv2' or 'numpy' (see apply_affine_batch)
+
+    Example (in place of train_datagen.flow(X_train, y_train, batch_size=batch_size)):
+        train_generator = AugmentedFlow(X_train, y_train, batch_size=batch_size, rescale=1./255, rotation_range=40,
+                                        width_shift_range=0.3, height_shift_range=0.3, shear_range=0.3,
+                                        zoom_range=0.3, fill_mode='nearest', horizontal_flip=True, vertical_flip=True)
+        model.fit(train_generator, steps_per_epoch=len(X_train)//batch_size, epochs=n_epochs,
+                  callbacks=[checkpoint, PipelineStallLogger(train_generator)], ...)
+    """
+
+    def __init__(self,
+                 X,
+                 y,
+                 batch_size=32,
+                 rescale=None,
+                 rotation_range=0,
+                 width_shift_range=0.,
+                 height_shift_range=0.,
+                 shear_range=0.,
+                 zoom_range=0.,
+                 fill_mode='nearest',
+                 cval=0.,
+                 horizontal_flip=False,
+                 vertical_flip=False,
+                 shuffle=True,
+                 seed=None,
+                 n_workers=None,
+                 prefetch=None,
+                 backend='cv2'):
+
+        self.X = X
+        self.y = np.asarray(y)
+        self.n = len(self.y)
+        self.batch_size = batch_size
+        self.rescale = rescale
+        self.aug_params = {'rotation_range': rotation_range,
+                           'width_shift_range': width_shift_range,
+                           'height_shift_range': height_shift_range,
+                           'shear_range': shear_range,
+                           'zoom_range': zoom_range,
+                           'horizontal_flip': horizontal_flip,
+                           'vertical_flip': vertical_flip}
+        self.augment = any(bool(v) for v in self.aug_params.values())
+        self.fill_mode = fill_mode
+        self.cval = cval
+        self.shuffle = shuffle
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.prefetch = prefetch or 2*self.n_workers
+        self.backend = backend
+
+        self._executor = None
+        self._pending = deque()
+        self._next_submit = 0
+        self._lock = threading.Lock()
+        self.stall_seconds = 0.
+        self.n_batches = 0
+
+    def __len__(self):
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+    def _order(self, epoch):
+        if not self.shuffle:
+            return np.arange(self.n)
+        return np.random.default_rng([self.seed, epoch]).permutation(self.n)
+
+    def make_batch(self, step):
+
+        """
+        Builds batch number step (counting across epochs) deterministically from the seed.
+        """
+
+        epoch, batch_no = divmod(step, len(self))
+        idx = np.sort(self._order(epoch)[batch_no*self.batch_size:(batch_no + 1)*self.batch_size])
+        X_batch = np.asarray(self.X[idx])
+        if self.augment:
+            rng = np.random.default_rng([self.seed, epoch, batch_no, 1])
+            matrices = random_affine_matrices(len(idx), X_batch.shape[1:3], rng, **self.aug_params)
+            X_batch = apply_affine_batch(X_batch, matrices, fill_mode=self.fill_mode, cval=self.cval,
+                                         backend=self.backend)
+        else:
+            X_batch = X_batch.astype(np.float32)
+        if self.rescale:
+            X_batch *= np.float32(self.rescale)
+        return X_batch, self.y[idx]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+            while len(self._pending) <= self.prefetch:
+                self._pending.append(self._executor.submit(self.make_batch, self._next_submit))
+                self._next_submit += 1
+            future = self._pending.popleft()
+
+        waited = time.perf_counter()
+        batch = future.result()
+        self.stall_seconds += time.perf_counter() - waited
+        self.n_batches += 1
+        return batch
+
+    def reset_stats(self):
+
+        """
+        Returns (stall seconds, batches delivered) since the last reset, and resets both counters.
+        """
+
+        stats = (self.stall_seconds, self.n_batches)
+        self.stall_seconds = 0.
+        self.n_batches = 0
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+                self._pending.clear()
+
+    def __del__(self):
+        self.close()
+
+
+class PipelineStallLogger(Callback):
+
+    """
+    Keras callback reporting, for each epoch, how long the training loop waited on an AugmentedFlow for its batches,
+    both in seconds and as a share of the epoch time. The values are also added to the epoch logs (and so to the
+    history) as input_stall_s and input_stall_frac.
+
+    Paramters:
+        flow: (AugmentedFlow) the training input pipeline
+        verbose: (bool) prints the stall time at the end of each epoch
+    """
+
+    def __init__(self, flow, verbose=True):
+        super().__init__()
+        self.flow = flow
+        self.verbose = verbose
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.flow.reset_stats()
+        self._epoch_start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        stall, n_batches = self.flow.reset_stats()
+        epoch_time = time.perf_counter() - self._epoch_start
+        frac = stall / epoch_time if epoch_time > 0 else 0.
+        if logs is not None:
+            logs['input_stall_s'] = stall
+            logs['input_stall_frac'] = frac
+        if self.verbose:
+            print(f' - input stall: {round(stall,2)}s over {n_batches} batches ({round(frac*100,1)}% of epoch)')
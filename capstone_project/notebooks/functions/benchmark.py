@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+
+# name -> (unit, higher_is_better)
+METRICS = {'ingestion_imgs_per_sec': ('images/sec', True),
+           'augmentation_batches_per_sec': ('batches/sec', True),
+           'train_steps_per_sec': ('steps/sec', True),
+           'single_image_latency_ms': ('ms', False),
+           'batch_inference_imgs_per_sec': ('images/sec', True)}
+
+
+def _median_time(fn,
+                 repeats):
+
+    # runs fn repeats times (after one warm-up run) and returns the median wall time in seconds
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def make_synthetic_images(out_dir,
+                          n_imgs=256,
+                          seed=0):
+
+    """
+    Writes n_imgs random JPEG images of varying sizes (roughly the size of the source photos) to out_dir, so that
+    ingestion can be benchmarked without the real dataset. Returns the list of paths.
+    """
+
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for i in range(n_imgs):
+        h, w = rng.integers(300, 600, 2)
+        # smooth random images compress (and decode) more like photographs than pure noise does
+        small = rng.integers(0, 256, (h // 16 + 1, w // 16 + 1, 3), dtype=np.uint8)
+        img = cv2.resize(small, (int(w), int(h)), interpolation=cv2.INTER_LINEAR)
+        path = os.path.join(out_dir, f'synthetic_{i:05d}.jpg')
+        cv2.imwrite(path, img)
+        paths.append(path)
+    return paths
+
+
+def bench_ingestion(work_dir,
+                    n_imgs=256,
+                    img_size=200,
+                    n_jobs=None,
+                    repeats=3):
+
+    from functions.ingest_imgs import ingest_imgs
+
+    paths = make_synthetic_images(os.path.join(work_dir, 'imgs'), n_imgs=n_imgs)
+    seconds = _median_time(lambda: ingest_imgs(paths, img_size, img_size, n_jobs=n_jobs), repeats)
+    return {'ingestion_imgs_per_sec': n_imgs / seconds}
+
+
+def bench_augmentation(n_imgs=512,
+                       img_size=200,
+                       batch_size=8,
+                       n_batches=50,
+                       repeats=3):
+
+    from functions.augment_flow import AugmentedFlow
+
+    rng = np.random.default_rng(0)
+    X = rng.integers(0, 256, (n_imgs, img_size, img_size, 3), dtype=np.uint8)
+    y = np.eye(20, dtype=np.float32)[rng.integers(0, 20, n_imgs)]
+    flow = AugmentedFlow(X, y, batch_size=batch_size, rescale=1./255, rotation_range=40, width_shift_range=0.3,
+                         height_shift_range=0.3, shear_range=0.3, zoom_range=0.3, fill_mode='nearest',
+                         horizontal_flip=True, vertical_flip=True, seed=0)
+
+    def run():
+        for _ in range(n_batches):
+            next(flow)
+
+    seconds = _median_time(run, repeats)
+    flow.close()
+    return {'augmentation_batches_per_sec': n_batches / seconds}
+
+
+def _synthetic_model(work_dir,
+                     img_size,
+                     runtime=None):
+
+    # builds the model_13 architecture with random weights and saves it, standing in for the trained model
+    from functions.model_architectures import build_model_13
+    from functions.training_runtime import RUNTIME_PROFILES, compile_for_runtime
+
+    model = build_model_13(img_shape=(img_size, img_size, 3))
+    compile_for_runtime(model, runtime or RUNTIME_PROFILES['default'], loss='categorical_crossentropy',
+                        optimizer='adamax', metrics=['acc'])
+    model_file = os.path.join(work_dir, 'synthetic_model_13.h5')
+    model.save(model_file)
+    return model, model_file
+
+
+def bench_training(work_dir,
+                   img_size=200,
+                   batch_size=8,
+                   n_steps=20,
+                   repeats=3,
+                   runtime=None):
+
+    model, _ = _synthetic_model(work_dir, img_size, runtime=runtime)
+    rng = np.random.default_rng(0)
+    X = rng.random((batch_size, img_size, img_size, 3), dtype=np.float32)
+    y = np.eye(20, dtype=np.float32)[rng.integers(0, 20, batch_size)]
+
+    def run():
+        for _ in range(n_steps):
+            model.train_on_batch(X, y)
+
+    seconds = _median_time(run, repeats)
+    return {'train_steps_per_sec': n_steps / seconds}
+
+
+def bench_inference(work_dir,
+                    model_file=None,
+                    img_size=200,
+                    n_imgs=256,
+                    batch_size=32,
+                    repeats=3):
+
+    from functions.decode_img import decode_img
+    from functions.model_registry import ModelRegistry
+
+    if model_file is None:
+        _, model_file = _synthetic_model(work_dir, img_size)
+    registry = ModelRegistry()
+    y_size, x_size = registry.get(model_file).input_shape[1:3]
+
+    img_path = make_synthetic_images(os.path.join(work_dir, 'single'), n_imgs=1)[0]
+    predict_one = registry.predictor(model_file, batch_size=1)
+
+    # the identify_mushroom prediction path: decode, resize, normalize and predict one image on a warm model
+    def single():
+        img = decode_img(img_path, x_size, y_size)
+        predict_one(np.expand_dims(img, axis=0)*(1./255))
+
+    latency = _median_time(single, max(repeats, 10))
+
+    rng = np.random.default_rng(0)
+    X = rng.random((n_imgs, y_size, x_size, 3), dtype=np.float32)
+    predict_batch = registry.predictor(model_file, batch_size=batch_size)
+    seconds = _median_time(lambda: predict_batch(X), repeats)
+
+    return {'single_image_latency_ms': latency * 1000., 'batch_inference_imgs_per_sec': n_imgs / seconds}
+
+
+def run_benchmarks(only=None,
+                   model_file=None,
+                   img_size=200,
+                   n_jobs=None,
+                   repeats=3,
+                   runtime=None):
+
+    """
+    Runs the benchmark suite on synthetic data (random JPEGs and arrays, and the model_13 architecture with random
+    weights unless model_file is given), so it works without the real dataset.
+
+    Paramters:
+        only: (list of strings) subset of 'ingestion', 'augmentation', 'training', 'inference' to run (defaults to all)
+        model_file: (string with quotes) saved .h5 model to use for the inference benchmarks instead of a synthetic one
+        img_size: (int) image height and width in pixels
+        n_jobs: (int) number of worker processes for ingestion (defaults to the number of cores)
+        repeats: (int) number of timed repetitions per benchmark (the median is reported)
+        runtime: (string with quotes or dict) training runtime profile (see configure_runtime); as thread pools are
+        fixed per process, runs with different runtimes are compared by saving one and passing it as the baseline of
+        the other (defaults to the tensorflow defaults)
+
+    Returns:
+        report: (dict) environment details and, for each metric, its value, unit and direction
+    """
+
+    only = only or ['ingestion', 'augmentation', 'training', 'inference']
+    if runtime is not None and 'training' in only:
+        from functions.training_runtime import configure_runtime
+        runtime = configure_runtime(runtime)
+    work_dir = tempfile.mkdtemp(prefix='mushroom_bench_')
+    values = {}
+
+    try:
+        if 'ingestion' in only:
+            values.update(bench_ingestion(work_dir, img_size=img_size, n_jobs=n_jobs, repeats=repeats))
+        if 'augmentation' in only:
+            values.update(bench_augmentation(img_size=img_size, repeats=repeats))
+        if 'training' in only:
+            values.update(bench_training(work_dir, img_size=img_size, repeats=repeats, runtime=runtime))
+        if 'inference' in only:
+            values.update(bench_inference(work_dir, model_file=model_file, img_size=img_size, repeats=repeats))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': sys.version.split()[0],
+                     'platform': platform.platform(),
+                     'cpu_count': os.cpu_count(),
+                     'img_size': img_size,
+                     'runtime': runtime},
+            'results': {name: {'value': value, 'unit': METRICS[name][0], 'higher_is_better': METRICS[name][1]}
+                        for name, value in values.items()}}
+
+
+def compare_to_baseline(report,
+                        baseline,
+                        threshold=0.1):
+
+    """
+    Compares a benchmark report with a stored baseline report. A metric regresses when it is worse than the baseline
+    by more than threshold (relative), taking into account whether higher or lower is better.
+
+    Returns:
+        comparison: (list of dicts) metric, baseline, current, relative change and regression flag for each metric
+        present in both reports
+    """
+
+    comparison = []
+    for name, current in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]['value']
+        change = (current['value'] - base) / base if base else 0.
+        worse = -change if current['higher_is_better'] else change
+        comparison.append({'metric': name,
+                           'baseline': base,
+                           'current': current['value'],
+                           'change': change,
+                           'regression': worse > threshold})
+    return comparison
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark ingestion, augmentation, training and inference.')
+    parser.add_argument('--only', nargs='*', choices=['ingestion', 'augmentation', 'training', 'inference'])
+    parser.add_argument('--model-file', help='saved .h5 model for the inference benchmarks (default: synthetic)')
+    parser.add_argument('--img-size', type=int, default=200)
+    parser.add_argument('--n-jobs', type=int)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--runtime', help='training runtime profile, eg. cpu (default: tensorflow defaults)')
+    parser.add_argument('--out', default='benchmark_results.json', help='path of the JSON results file')
+    parser.add_argument('--baseline', help='JSON results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change flagged as a regression')
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(only=args.only, model_file=args.model_file, img_size=args.img_size,
+                            n_jobs=args.n_jobs, repeats=args.repeats, runtime=args.runtime)
+    with open(args.out, 'w') as file:
+        json.dump(report, file, indent=1)
+
+    for name, result in report['results'].items():
+        print(f"{name}: {round(result['value'],2)} {result['unit']}")
+    print(f'Results saved under {args.out}!')
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        comparison = compare_to_baseline(report, baseline, threshold=args.threshold)
+        print('---')
+        for c in comparison:
+            flag = 'REGRESSION' if c['regression'] else 'ok'
+            print(f"{c['metric']}: {round(c['baseline'],2)} -> {round(c['current'],2)} "
+                  f"({round(c['change']*100,1)}%) {flag}")
+        if any(c['regression'] for c in comparison):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
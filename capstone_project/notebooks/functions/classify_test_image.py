@@ -3,9 +3,9 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
-import tensorflow as tf
-from tensorflow import keras
-from keras import models
+from functions.array_store import open_array_data
+from functions.model_registry import get_registry
+from functions.prediction_cache import get_prediction_cache
 
 
 def classify_test_image(test_no,
@@ -27,15 +27,19 @@ def classify_test_image(test_no,
         
         species_df = pd.read_csv('../data/0003_general/species_list_final.csv')
         species_as_list = species_df['common_name'].tolist()
-        X_test_non_norm = np.load('../data/0002_array_data/test_data/X_test_data.npy')
-        X_test = X_test_non_norm*(1./255)
-        y_test = np.load('../data/0002_array_data/test_data/y_test_data.npy')
+        X_test, y_test = open_array_data('test', data_path='../data/0002_array_data/')
 
-        model = models.load_model(f'../notebooks/model_construction/saved_models/{model_name}.h5')
-        test_img = X_test[test_no]
+        test_img = X_test[test_no]*(1./255)
         test_img_rs = np.expand_dims(test_img, axis=0)
         y_act = np.where(y_test[test_no] == 1)[0][0]
-        ypred = np.argmax(model.predict(test_img_rs),axis=-1)
+        
+        # reusing the model's cached test set outputs when the test set's hash is already known this session
+        # (hashing the whole test set just to look up one image would cost more than predicting it)
+        cached_preds = get_prediction_cache().lookup(model_name, X_test, hash_data=False)
+        if cached_preds is not None:
+            ypred = np.argmax(cached_preds[test_no:test_no+1],axis=-1)
+        else:
+            ypred = np.argmax(get_registry().predictor(model_name)(test_img_rs),axis=-1)
 
         if int(y_act) == int(ypred[0]):
             result = 'Correct!'
@@ -19,9 +19,11 @@ def compile_imgs_to_df(class_name,
     
     img_list = []
 
-    for i in os.listdir(f'{base_path}{class_name}'):
-        img = f'{base_path}{class_name}/'+i
-        img_list.append(img)
+    with os.scandir(f'{base_path}{class_name}') as entries:
+        for entry in entries:
+            if entry.is_file():
+                img = f'{base_path}{class_name}/'+entry.name
+                img_list.append(img)
     
     df = pd.DataFrame(img_list, columns=['image'])
     df['class'] = class_name
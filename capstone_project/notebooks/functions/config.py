@@ -0,0 +1,52 @@
+import os
+import json
+
+
+# the notebooks folder, found from this file rather than from the current directory
+NOTEBOOKS_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_FILE = os.path.join(os.path.expanduser('~'), '.config', 'mushroom_id.json')
+
+DEFAULT_CONFIG = {'model': 'model_13',
+                  'model_path': os.path.join(NOTEBOOKS_PATH, 'model_construction', 'saved_models'),
+                  'data_path': os.path.join(os.path.dirname(NOTEBOOKS_PATH), 'data', '0002_array_data')}
+
+
+def load_config(config_path=None):
+
+    """
+    Resolves the settings of the command-line tools independently of the current directory. Defaults point into this
+    repository; they are overridden by a JSON file (config_path, else $MUSHROOM_ID_CONFIG, else
+    ~/.config/mushroom_id.json if it exists), whose relative paths are taken relative to the file, and then by the
+    environment variables MUSHROOM_ID_MODEL, MUSHROOM_ID_MODEL_PATH and MUSHROOM_ID_DATA_PATH.
+
+    Paramters:
+        config_path: (string with quotes) path of a JSON config file (optional)
+
+    Returns:
+        config: (dict) model, model_path and data_path, with paths made absolute
+    """
+
+    config = dict(DEFAULT_CONFIG)
+
+    config_path = config_path or os.environ.get('MUSHROOM_ID_CONFIG')
+    if config_path is None and os.path.exists(CONFIG_FILE):
+        config_path = CONFIG_FILE
+    if config_path:
+        with open(config_path) as file:
+            overrides = json.load(file)
+        base = os.path.dirname(os.path.abspath(config_path))
+        for k, v in overrides.items():
+            config[k] = os.path.join(base, os.path.expanduser(v)) if k.endswith('_path') else v
+
+    for k in DEFAULT_CONFIG:
+        value = os.environ.get(f'MUSHROOM_ID_{k.upper()}')
+        if value:
+            config[k] = value
+
+    for k in config:
+        if k.endswith('_path'):
+            # the path helpers of this package join names directly onto folders, so folders keep a trailing slash
+            config[k] = os.path.abspath(config[k]) + (os.sep if os.path.isdir(config[k]) else '')
+
+    return config
@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import queue
+import pickle
+import shutil
+import socket
+import tempfile
+import importlib.util
+import multiprocessing
+import numpy as np
+import pandas as pd
+from functions.history_store import HistoryStore
+from functions.model_registry import MODEL_PATH
+from functions.trial_scheduler import DEFAULT_TRIAL
+
+
+def _free_ports(n):
+    # ports the operating system reports as free on localhost, one per worker
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def _shard_dataset(flow,
+                   img_shape,
+                   n_classes):
+
+    # wraps a worker's AugmentedFlow in a tf.data pipeline of per-replica batches; the partial batch at the end of
+    # each pass over the shard is skipped, so that every step trains each replica on exactly batch_size images
+    import tensorflow as tf
+
+    def batches():
+        for X_batch, y_batch in flow:
+            if len(X_batch) == flow.batch_size:
+                yield X_batch, np.asarray(y_batch, dtype=np.float32)
+
+    return tf.data.Dataset.from_generator(
+        batches, output_signature=(tf.TensorSpec((flow.batch_size,) + tuple(img_shape), tf.float32),
+                                   tf.TensorSpec((flow.batch_size, n_classes), tf.float32)))
+
+
+def _run_worker(index,
+                hosts,
+                name,
+                settings,
+                n_epochs,
+                n_threads,
+                steps_per_epoch,
+                data_path,
+                model_path,
+                db_path,
+                results):
+
+    # entry point of one worker process; TF_CONFIG must be set before the strategy (and tensorflow's runtime) exists
+    os.environ['TF_CONFIG'] = json.dumps({'cluster': {'worker': hosts}, 'task': {'type': 'worker', 'index': index}})
+    try:
+        results.put((index, _train_worker(index, len(hosts), name, settings, n_epochs, n_threads, steps_per_epoch,
+                                          data_path, model_path, db_path)))
+    except Exception as e:
+        results.put((index, {'error': repr(e)}))
+        raise
+
+
+def _train_worker(index,
+                  n_workers,
+                  name,
+                  settings,
+                  n_epochs,
+                  n_threads,
+                  steps_per_epoch,
+                  data_path,
+                  model_path,
+                  db_path):
+
+    from functions.training_runtime import configure_runtime, StepRateLogger
+
+    runtime = configure_runtime(settings.get('runtime', 'default'), intra_op_threads=n_threads, inter_op_threads=1)
+    if runtime['accum_steps'] > 1:
+        raise ValueError('gradient accumulation is not supported in data-parallel training, add workers instead')
+
+    import tensorflow as tf
+    from keras import optimizers
+    from keras.callbacks import ModelCheckpoint, LambdaCallback
+    from functions.array_store import open_array_data
+    from functions.augment_flow import AugmentedFlow
+    from functions.model_architectures import ARCHITECTURES
+    from functions.training_profiler import TrainingProfiler
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(
+        communication_options=tf.distribute.experimental.CommunicationOptions(
+            implementation=tf.distribute.experimental.CommunicationImplementation.RING))
+    is_chief = index == 0
+    batch_size = settings['batch_size']
+
+    X_train, y_train = open_array_data('train', data_path)
+    X_val, y_val = open_array_data('val', data_path)
+    img_shape, n_classes = X_train.shape[1:], y_train.shape[1]
+
+    # every worker holds one interleaved shard of each subset; the steps are the same on all workers, as each step
+    # is one collective all-reduce of the gradients
+    train_idx = np.arange(index, len(y_train), n_workers)
+    val_idx = np.arange(index, len(y_val), n_workers)
+    if min(len(train_idx), len(val_idx)) < batch_size:
+        raise ValueError(f'every worker needs at least batch_size ({batch_size}) training and validation images')
+    steps = steps_per_epoch or len(y_train)//n_workers//batch_size
+    val_steps = len(y_val)//n_workers//batch_size
+
+    train_flow = AugmentedFlow(X_train[train_idx], y_train[train_idx], batch_size=batch_size, rescale=1./255,
+                               seed=16 + index, n_workers=n_threads, **settings['augmentation'])
+    val_flow = AugmentedFlow(X_val[val_idx], y_val[val_idx], batch_size=batch_size, rescale=1./255, shuffle=False,
+                             n_workers=n_threads)
+
+    with strategy.scope():
+        model = ARCHITECTURES[settings['architecture']](img_shape=img_shape, n_classes=n_classes,
+                                                       **settings['arch_params'])
+        opt = optimizers.get({'class_name': settings['optimizer'],
+                              'config': {'learning_rate': settings['learning_rate']}})
+        model.compile(loss='categorical_crossentropy', optimizer=opt, metrics=['acc'])
+
+    # only the chief writes the real checkpoint; the others save to a scratch folder, as every worker has to take
+    # part in saving the distributed variables
+    scratch = tempfile.mkdtemp(prefix=f'{name}_worker_{index}_')
+    checkpoint = ModelCheckpoint(filepath=f'{model_path}{name}.h5' if is_chief else os.path.join(scratch, f'{name}.h5'),
+                                 monitor='val_acc', save_best_only=True)
+    # each replica (one per worker on CPU) trains on batch_size images per step
+    callbacks = [checkpoint, TrainingProfiler(checkpoints=[checkpoint], flow=train_flow),
+                 StepRateLogger(batch_size*strategy.num_replicas_in_sync)]
+    if is_chief:
+        store = HistoryStore(db_path)
+        store.start_run(name, config={**settings, 'n_workers': n_workers})
+        callbacks.append(LambdaCallback(on_epoch_end=lambda epoch, logs: store.append(name, epoch, logs or {})))
+
+    # the datasets are handed to the strategy already batched per replica; a batched dataset passed to fit directly
+    # would have each worker's batch taken as the global batch and split across all replicas
+    train_data = strategy.distribute_datasets_from_function(
+        lambda context: _shard_dataset(train_flow, img_shape, n_classes))
+    val_data = strategy.distribute_datasets_from_function(
+        lambda context: _shard_dataset(val_flow, img_shape, n_classes))
+
+    try:
+        history = model.fit(train_data,
+                            steps_per_epoch=steps,
+                            epochs=n_epochs,
+                            callbacks=callbacks,
+                            validation_data=val_data,
+                            validation_steps=val_steps,
+                            verbose=2 if is_chief else 0)
+    finally:
+        train_flow.close()
+        val_flow.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if not is_chief:
+        return None
+
+    with open(f'{model_path}{name}_history.tmp', 'wb') as file_pi:
+        pickle.dump(history.history, file_pi)
+    os.replace(f'{model_path}{name}_history.tmp', f'{model_path}{name}_history')
+    store.finish_run(name)
+    store.close()
+
+    return {key: list(map(float, values)) for key, values in history.history.items()}
+
+
+def train_data_parallel(name,
+                        settings=None,
+                        n_workers=2,
+                        n_epochs=100,
+                        threads_per_worker=None,
+                        hosts=None,
+                        local_workers=None,
+                        steps_per_epoch=None,
+                        data_path='../data/0002_array_data/',
+                        model_path=MODEL_PATH,
+                        db_path=None):
+
+    """
+    Trains one model data-parallel across several worker processes instead of in the notebook's single process. Each
+    worker holds a replica of the model and reads its own shard of the training data (augmented as in the model_XX
+    notebooks); after every step the gradients of all workers are averaged with a collective ring all-reduce over
+    gRPC (tf.distribute.MultiWorkerMirroredStrategy), so all replicas apply the same update. Each step therefore
+    processes n_workers batches of batch_size images: the effective batch size is n_workers times batch_size (the
+    partial batch at the end of each pass over a worker's shard is skipped).
+
+    As in the notebooks, the best-val_acc checkpoint is saved as {name}.h5 and the history pickled as {name}_history
+    (by the first worker, the chief), and every epoch is also recorded in the history store, together with the
+    timing breakdown of TrainingProfiler and the throughput of StepRateLogger (samples_per_s across all workers).
+
+    On one machine the workers are started on free localhost ports. To train across several machines, pass the
+    host:port of every worker as hosts and call the function on each machine with the indices of the workers it runs
+    as local_workers (the data must be available under data_path on every machine). The runtime setting's threads
+    and mixed precision are applied per worker; gradient accumulation is not supported in this mode.
+
+    Paramters:
+        name: (string with quotes) run name, used for the saved model and history (eg. 'm14_t1')
+        settings: (dict) trial settings as for run_trial (defaults to DEFAULT_TRIAL, ie. m13_t1)
+        n_workers: (int) number of workers when training on localhost
+        n_epochs: (int) number of epochs
+        threads_per_worker: (int) number of CPU threads of each worker (defaults to the cores shared equally between
+        the local workers)
+        hosts: (list of strings) host:port of every worker, for training across machines
+        local_workers: (list of ints) indices in hosts of the workers started here (defaults to all)
+        steps_per_epoch: (int) number of steps per epoch (defaults to a full pass over each shard)
+        data_path: (string with quotes) base path of the array data directory
+        model_path: (string with quotes) directory the model and history are saved to
+        db_path: (string with quotes) path of the history store (defaults to history.sqlite in model_path)
+
+    Returns:
+        history: (dict) the history dictionary of the run (None if the chief runs on another machine)
+    """
+
+    settings = {**DEFAULT_TRIAL, **(settings or {})}
+    db_path = db_path or os.path.join(model_path, 'history.sqlite')
+    hosts = hosts or [f'localhost:{port}' for port in _free_ports(n_workers)]
+    local_workers = list(range(len(hosts))) if local_workers is None else list(local_workers)
+    n_threads = threads_per_worker or max(1, (os.cpu_count() or 1) // len(local_workers))
+
+    print(f'Training {name} on {len(hosts)} workers ({len(local_workers)} local, {n_threads} threads each)')
+
+    # spawned (not forked) workers, so that each one initializes its own tensorflow runtime
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=_run_worker,
+                                 args=(index, hosts, name, settings, n_epochs, n_threads, steps_per_epoch,
+                                       data_path, model_path, db_path, results))
+                 for index in local_workers]
+    for p in processes:
+        p.start()
+
+    # a failed worker would leave the others waiting forever in the all-reduce, so all are stopped on the first error
+    outputs = {}
+    try:
+        while len(outputs) < len(processes):
+            try:
+                index, output = results.get(timeout=5)
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in processes):
+                    raise RuntimeError(f'a worker of {name} exited with an error')
+                continue
+            if isinstance(output, dict) and 'error' in output:
+                raise RuntimeError(f"worker {index} of {name} failed: {output['error']}")
+            outputs[index] = output
+    finally:
+        for p in processes:
+            if p.is_alive() and len(outputs) < len(processes):
+                p.terminate()
+            p.join()
+
+    if 0 in outputs:
+        print(f'{name} saved in {model_path}!')
+    return outputs.get(0)
+
+
+def scaling_report(worker_counts=(1, 2, 4),
+                   settings=None,
+                   n_epochs=3,
+                   steps_per_epoch=50,
+                   threads_per_worker=None,
+                   data_path='../data/0002_array_data/'):
+
+    """
+    Measures how training throughput scales with the number of local data-parallel workers. Each worker count trains
+    a short run (saved to a temporary folder, not to the saved models); the first epoch, which includes graph
+    tracing and the workers' start-up, is left out of the throughput. Every worker gets the same number of threads in
+    all runs, so that the comparison is about adding workers rather than redistributing the same cores.
+
+    Paramters:
+        worker_counts: (tuple of ints) numbers of workers to compare
+        settings: (dict) trial settings as for run_trial (defaults to DEFAULT_TRIAL)
+        n_epochs: (int) epochs per run (at least 2)
+        steps_per_epoch: (int) steps per epoch
+        threads_per_worker: (int) threads of each worker (defaults to the cores divided by the largest worker count)
+        data_path: (string with quotes) base path of the array data directory
+
+    Returns:
+        report: dataframe with one row per worker count: samples/sec, speedup over the first worker count and
+        scaling efficiency (speedup divided by the relative number of workers)
+    """
+
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // max(worker_counts))
+    work_dir = tempfile.mkdtemp(prefix='mushroom_scaling_')
+
+    rows = []
+    try:
+        for n in worker_counts:
+            start_time = time.perf_counter()
+            history = train_data_parallel(f'scaling_{n}_workers', settings=settings, n_workers=n, n_epochs=n_epochs,
+                                          threads_per_worker=threads_per_worker, steps_per_epoch=steps_per_epoch,
+                                          data_path=data_path, model_path=f'{work_dir}/')
+            rows.append({'workers': n,
+                         'threads_per_worker': threads_per_worker,
+                         'samples_per_s': float(np.median(history['samples_per_s'][1:])),
+                         'epoch_time_s': float(np.median(history['epoch_time_s'][1:])),
+                         'seconds': time.perf_counter() - start_time})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = pd.DataFrame(rows)
+    base = report.iloc[0]
+    report['speedup'] = report['samples_per_s'] / base['samples_per_s']
+    report['efficiency'] = report['speedup'] / (report['workers'] / base['workers'])
+
+    return report
+
+
+def smoke_test(n_workers=2):
+
+    """
+    Trains a tiny model_13 variant for one step on n_workers local workers over a small synthetic array store, to
+    check that data-parallel training works on this machine (eg. that the workers find each other and the gradients
+    are all-reduced). Everything is written to a temporary folder that is removed afterwards. Skipped (returns None)
+    when tensorflow is not installed.
+
+    Paramters:
+        n_workers: (int) number of local workers
+
+    Returns:
+        history: (dict) the history of the run, or None if skipped
+    """
+
+    if importlib.util.find_spec('tensorflow') is None:
+        print('tensorflow is not installed - data-parallel smoke test skipped')
+        return None
+
+    from functions.array_store import append_array_store
+
+    work_dir = tempfile.mkdtemp(prefix='mushroom_data_parallel_')
+    try:
+        rng = np.random.default_rng(0)
+        batch_size, n_classes = 4, 3
+        for subset in ('train', 'val'):
+            n = 2*n_workers*batch_size
+            append_array_store(rng.integers(0, 256, (n, 32, 32, 3), dtype=np.uint8), np.arange(n) % n_classes,
+                               f'{work_dir}/data/train_data/X_{subset}_store', n_classes=n_classes)
+        settings = {'arch_params': {'filters': (8, 8), 'dense_units': (16,)}, 'batch_size': batch_size}
+        history = train_data_parallel('smoke_test', settings=settings, n_workers=n_workers, n_epochs=1,
+                                      threads_per_worker=1, steps_per_epoch=1, data_path=f'{work_dir}/data/',
+                                      model_path=f'{work_dir}/')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"Data-parallel smoke test passed: {n_workers} workers, {round(history['samples_per_s'][0],1)} samples/s")
+
+    return history
+
+
+if __name__ == '__main__':
+    # python -m functions.data_parallel [N_WORKERS], from the notebooks folder
+    smoke_test(int(sys.argv[1]) if len(sys.argv) > 1 else 2)
@@ -0,0 +1,334 @@
+import os
+import time
+import hashlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+from functions.ingest_imgs import init_decode_worker
+
+
+CACHE_PATH = '../data/0002_array_data/decode_cache/'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    offset INTEGER,
+    height INTEGER,
+    width INTEGER
+);
+CREATE TABLE IF NOT EXISTS derived (
+    key TEXT PRIMARY KEY,
+    x_size INTEGER NOT NULL,
+    y_size INTEGER NOT NULL,
+    n_images INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+"""
+
+
+def _decode_original(img_path,
+                     max_side):
+
+    # decodes one source image to RGB, shrinking it (INTER_AREA) only if its longer side exceeds max_side
+    img = cv2.imread(img_path)
+    if img is None:
+        return None
+    h, w = img.shape[:2]
+    if max_side and max(h, w) > max_side:
+        scale = max_side / max(h, w)
+        img = cv2.resize(img, (max(1, round(w*scale)), max(1, round(h*scale))), interpolation=cv2.INTER_AREA)
+    return np.ascontiguousarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+
+
+def _decode_chunk(img_paths,
+                  max_side):
+    return [_decode_original(p, max_side) for p in img_paths]
+
+
+def _resize_chunk(originals_path,
+                  out_path,
+                  start,
+                  entries,
+                  x_size,
+                  y_size,
+                  interpolation):
+
+    # resizes cached originals straight into their rows of the shared output array
+    originals = np.memmap(originals_path, dtype=np.uint8, mode='r')
+    X = np.load(out_path, mmap_mode='r+')
+    for i, (offset, h, w) in enumerate(entries):
+        img = originals[offset:offset + h*w*3].reshape(h, w, 3)
+        X[start + i] = cv2.resize(img, (x_size, y_size), interpolation=interpolation)
+    X.flush()
+    del X, originals
+
+
+class DecodeCache:
+
+    """
+    A disk cache of decoded source images from which datasets at any resolution are produced without decoding the
+    JPEGs again. Each image is decoded once (in parallel) into one append-only, memory-mapped file of RGB pixels, at
+    full size or shrunk to max_side on its longer side. Resized datasets are then made from these arrays by a pool of
+    worker processes writing into a memory-mapped .npy file, and are themselves cached; when the cache exceeds its
+    disk budget, the least recently used resized datasets are deleted. A resolution sweep therefore costs one decode
+    pass instead of one per resolution. Images that change on disk are decoded again and appended; once the bytes of
+    their replaced versions exceed compact_threshold of the originals file, the file is compacted.
+
+    With max_side=None the resized images are identical to those of decode_img/read_process_imgs (the same
+    INTER_CUBIC resize of the full decoded image); a cap saves disk space at the cost of a slightly different result
+    for sizes close to the cap.
+
+    Paramters:
+        cache_path: (string with quotes) directory of the cache
+        max_side: (int) longest side of the stored originals in pixels, or None to store them at full size
+        budget_bytes: (int) disk budget for the whole cache; only resized datasets are evicted to meet it
+        compact_threshold: (float) fraction of the originals file that replaced images may take up before it is
+        compacted
+    """
+
+    def __init__(self,
+                 cache_path=CACHE_PATH,
+                 max_side=None,
+                 budget_bytes=20 << 30,
+                 compact_threshold=0.25):
+
+        self.cache_path = cache_path
+        self.max_side = max_side
+        self.budget_bytes = budget_bytes
+        self.compact_threshold = compact_threshold
+        self.originals_path = os.path.join(cache_path, 'originals.u8')
+        self.derived_path = os.path.join(cache_path, 'derived')
+        os.makedirs(self.derived_path, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_path, 'index.sqlite'))
+        self.conn.executescript(SCHEMA)
+
+    def _stale(self,
+               img_paths):
+
+        # paths that are not cached yet, or whose file changed since it was cached
+        known = {}
+        for i in range(0, len(img_paths), 500):
+            chunk = img_paths[i:i+500]
+            known.update((r[0], r[1:]) for r in self.conn.execute(
+                f"SELECT path, size, mtime_ns FROM images WHERE path IN ({', '.join('?' * len(chunk))})", chunk))
+        stale = []
+        for p in dict.fromkeys(img_paths):
+            try:
+                stat = os.stat(p)
+                current = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                current = (-1, -1)
+            if known.get(p) != current:
+                stale.append((p, current))
+        return stale
+
+    def add(self,
+            img_paths,
+            n_jobs=None,
+            chunk_size=32):
+
+        """
+        Decodes the images that are not cached yet (or have changed on disk) and appends them to the cache.
+
+        Returns:
+            n_decoded: (int) number of images decoded
+        """
+
+        stale = self._stale(list(img_paths))
+        if not stale:
+            return 0
+
+        n_jobs = n_jobs or os.cpu_count() or 1
+        chunks = [stale[i:i+chunk_size] for i in range(0, len(stale), chunk_size)]
+
+        def store(chunk, imgs):
+            rows = []
+            with open(self.originals_path, 'ab') as file:
+                for (p, (size, mtime_ns)), img in zip(chunk, imgs):
+                    if img is None:
+                        rows.append((p, size, mtime_ns, 'failed', None, None, None))
+                    else:
+                        rows.append((p, size, mtime_ns, 'ok', file.tell(), img.shape[0], img.shape[1]))
+                        file.write(img.tobytes())
+            # pixels are written before their index rows, so an interrupted run never indexes missing bytes
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+        if n_jobs == 1 or len(chunks) == 1:
+            for chunk in chunks:
+                store(chunk, _decode_chunk([p for p, _ in chunk], self.max_side))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_decode_worker) as executor:
+                futures = [executor.submit(_decode_chunk, [p for p, _ in chunk], self.max_side) for chunk in chunks]
+                for chunk, future in zip(chunks, futures):
+                    store(chunk, future.result())
+
+        if self.orphaned_bytes > self.compact_threshold * os.path.getsize(self.originals_path):
+            self.compact()
+
+        return len(stale)
+
+    @property
+    def orphaned_bytes(self):
+        # bytes of the originals file no longer indexed, ie. the earlier versions of images decoded again
+        if not os.path.exists(self.originals_path):
+            return 0
+        live = self.conn.execute("SELECT COALESCE(SUM(height*width*3), 0) FROM images WHERE status = 'ok'")
+        return os.path.getsize(self.originals_path) - live.fetchone()[0]
+
+    def compact(self):
+
+        """
+        Rewrites the originals file with only the images currently indexed, dropping the bytes of images that were
+        decoded again after changing on disk. Resized datasets are keyed on the source files, not on their position
+        in the originals file, so they stay valid.
+
+        Returns:
+            n_bytes: (int) number of bytes freed
+        """
+
+        if not os.path.exists(self.originals_path):
+            return 0
+        before = os.path.getsize(self.originals_path)
+        rows = self.conn.execute("SELECT path, offset, height, width FROM images WHERE status = 'ok' "
+                                 "ORDER BY offset").fetchall()
+        tmp_path = self.originals_path + '.tmp'
+        moved = []
+        with open(tmp_path, 'wb') as file:
+            if rows:
+                originals = np.memmap(self.originals_path, dtype=np.uint8, mode='r')
+                for path, offset, h, w in rows:
+                    moved.append((file.tell(), path))
+                    file.write(originals[offset:offset + h*w*3].tobytes())
+                del originals
+        with self.conn:
+            self.conn.executemany('UPDATE images SET offset = ? WHERE path = ?', moved)
+            os.replace(tmp_path, self.originals_path)
+
+        return before - os.path.getsize(self.originals_path)
+
+    def _entries(self,
+                 img_paths):
+        entries = {}
+        for i in range(0, len(img_paths), 500):
+            chunk = img_paths[i:i+500]
+            entries.update((r[0], r[1:]) for r in self.conn.execute(
+                f"SELECT path, status, offset, height, width, size, mtime_ns FROM images WHERE path IN "
+                f"({', '.join('?' * len(chunk))})", chunk))
+        return entries
+
+    def resized(self,
+                img_paths,
+                x_size,
+                y_size,
+                n_jobs=None,
+                chunk_size=64,
+                interpolation=cv2.INTER_CUBIC):
+
+        """
+        Returns the images resized to x_size by y_size, in the order given, decoding only images not cached yet and
+        resizing only if this exact dataset (same images in any order, same versions of the files, same size) is not
+        cached yet. Datasets are stored with their images sorted by path, so a reshuffled request hits the cache.
+
+        Paramters:
+            img_paths: (list of strings) paths of the source images, in the desired output order
+            x_size: (integer) the desired horizontal output size of each image in pixels
+            y_size: (integer) the desired vertical output size of each image in pixels
+            n_jobs: (int) number of worker processes (defaults to the number of cores; 1 works in-process)
+            chunk_size: (int) number of images handed to a worker at a time
+            interpolation: (int) cv2 interpolation flag
+
+        Returns:
+            X: (uint8 array) the image data; shape: (number of decoded images, y_size, x_size, 3); the cached dataset
+            memory-mapped read-only if the images were requested sorted by path, an in-memory copy in the requested
+            order otherwise
+            failed: (list of strings) paths of the images that could not be decoded
+            stats: (dict) number of images, failures and newly decoded images, elapsed seconds, and whether the
+            resized dataset came from the cache
+        """
+
+        start_time = time.perf_counter()
+        img_paths = list(img_paths)
+        n_decoded = self.add(img_paths, n_jobs=n_jobs)
+        entries = self._entries(img_paths)
+
+        failed = [p for p in img_paths if entries[p][0] != 'ok']
+        ok_paths = [p for p in img_paths if entries[p][0] == 'ok']
+        xs, ys = int(x_size), int(y_size)
+
+        # the dataset is keyed on, and stored in, the canonical (sorted) order of its files, and permuted to the
+        # requested order on the way out
+        canonical, order = np.unique(np.array(ok_paths, dtype=str), return_inverse=True)
+        ok = np.array([entries[p][1:4] for p in canonical], dtype=np.int64).reshape(-1, 3)
+        files = '\n'.join(f'{p}:{entries[p][4]}:{entries[p][5]}' for p in canonical)
+        key = hashlib.sha256(f'{files}\n{xs}x{ys}:{interpolation}'.encode()).hexdigest()[:32]
+        out_path = os.path.join(self.derived_path, f'{key}.npy')
+        hit = os.path.exists(out_path)
+
+        if not hit:
+            tmp_path = out_path[:-4] + '.tmp.npy'
+            np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(ok), ys, xs, 3)).flush()
+            chunks = [(i, ok[i:i+chunk_size].tolist()) for i in range(0, len(ok), chunk_size)]
+            n_jobs = n_jobs or os.cpu_count() or 1
+            if n_jobs == 1 or len(chunks) <= 1:
+                for start, chunk in chunks:
+                    _resize_chunk(self.originals_path, tmp_path, start, chunk, xs, ys, interpolation)
+            else:
+                with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_decode_worker) as executor:
+                    futures = [executor.submit(_resize_chunk, self.originals_path, tmp_path, start, chunk, xs, ys,
+                                               interpolation) for start, chunk in chunks]
+                    for future in futures:
+                        future.result()
+            os.replace(tmp_path, out_path)
+
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO derived VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, xs, ys, len(ok), os.path.getsize(out_path), time.time()))
+        self.evict(keep=key)
+
+        elapsed = time.perf_counter() - start_time
+        stats = {'n_images': len(img_paths),
+                 'n_failed': len(failed),
+                 'n_decoded': n_decoded,
+                 'seconds': elapsed,
+                 'cache_hit': hit}
+
+        X = np.load(out_path, mmap_mode='r')
+        if not np.array_equal(order, np.arange(len(order))):
+            X = X[order.ravel()]
+
+        return X, failed, stats
+
+    @property
+    def total_bytes(self):
+        originals = os.path.getsize(self.originals_path) if os.path.exists(self.originals_path) else 0
+        return originals + (self.conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM derived').fetchone()[0])
+
+    def evict(self,
+              keep=None):
+
+        """
+        Deletes least recently used resized datasets until the cache fits its disk budget (never the one given as
+        keep, nor the decoded originals).
+        """
+
+        total = self.total_bytes
+        for key, n_bytes in self.conn.execute('SELECT key, bytes FROM derived ORDER BY last_used').fetchall():
+            if total <= self.budget_bytes:
+                break
+            if key == keep:
+                continue
+            path = os.path.join(self.derived_path, f'{key}.npy')
+            if os.path.exists(path):
+                os.remove(path)
+            with self.conn:
+                self.conn.execute('DELETE FROM derived WHERE key = ?', (key,))
+            total -= n_bytes
+
+    def close(self):
+        self.conn.close()
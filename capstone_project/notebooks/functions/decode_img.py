@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+
+
+def decode_img(img_path,
+               x_size,
+               y_size,
+               return_size=False):
+
+    """
+    Reads a single image from disk (or from its encoded bytes, eg. an upload), resizes it and converts it from BGR to
+    RGB colour order. This is the same decode/resize/colour step used by read_process_imgs, kept in one place so that
+    every ingestion path produces identical pixels.
+
+    Paramters:
+        img_path: (string with quotes or bytes) path to the image file, or the encoded image file contents
+        x_size: (integer) the desired horizontal output size of the image in pixels
+        y_size: (integer) the desired vertical output size of the image in pixels
+        return_size: (bool) also returns the (height, width) of the source image
+
+    Returns:
+        rgb_img: (uint8 array) the image with shape (y_size, x_size, 3), or None if the file could not be decoded
+        size: (tuple) (height, width) of the source image, or None if it could not be decoded (if return_size is True)
+    """
+
+    if isinstance(img_path, (bytes, bytearray, memoryview)):
+        raw_img = cv2.imdecode(np.frombuffer(img_path, dtype=np.uint8), 1) if len(img_path) else None
+    else:
+        raw_img = cv2.imread(img_path, 1)
+    if raw_img is None:
+        return (None, None) if return_size else None
+
+    try:
+        resized_img = cv2.resize(raw_img, (int(x_size), int(y_size)), interpolation=cv2.INTER_CUBIC)
+    except cv2.error:
+        return (None, None) if return_size else None
+
+    rgb_img = cv2.cvtColor(resized_img, cv2.COLOR_BGR2RGB)
+    return (rgb_img, raw_img.shape[:2]) if return_size else rgb_img
@@ -0,0 +1,399 @@
+import os
+import json
+import time
+import numpy as np
+from functions.model_registry import get_registry
+from functions.layer_activations import iter_activations
+
+
+INDEX_PATH = '../data/0002_array_data/embedding_index/'
+
+CODECS = ('float16', 'pq')
+
+# indexes loaded by similar_images, by absolute index path
+_indexes = {}
+
+
+def _normalize(X):
+    X = np.asarray(X, dtype=np.float32)
+    return X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+
+
+def extract_embeddings(model_name,
+                       X,
+                       layer=-2,
+                       batch_size=64):
+
+    """
+    Extracts image embeddings (the flattened activations of one layer, by default the penultimate layer, ie. the
+    2048-unit dense block of model_13 just before the softmax) batch by batch, L2-normalized so that inner products
+    are cosine similarities.
+
+    Paramters:
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5 file
+        X: (uint8 array, memory-mapped array or ArrayStore) the images, not normalized
+        layer: (string or int) name or position in model.layers of the embedding layer
+        batch_size: (int) number of images per batch
+
+    Returns:
+        embeddings: (float32 array) shape: (number of images, embedding size)
+    """
+
+    embeddings = None
+    for start, batch in iter_activations(model_name, X, [layer], batch_size=batch_size,
+                                         reduce=lambda a: _normalize(a.reshape(len(a), -1))):
+        emb = next(iter(batch.values()))
+        if embeddings is None:
+            embeddings = np.empty((len(X), emb.shape[1]), dtype=np.float32)
+        embeddings[start:start+len(emb)] = emb
+
+    return embeddings
+
+
+def _kmeans(X,
+            k,
+            n_iter=20,
+            seed=16):
+
+    # Lloyd's k-means with squared euclidean distances; empty clusters are re-seeded with random points
+    rng = np.random.RandomState(seed)
+    k = min(k, len(X))
+    centroids = X[rng.choice(len(X), k, replace=False)].copy()
+    for _ in range(n_iter):
+        dists = (X**2).sum(axis=1)[:, None] - 2*X @ centroids.T + (centroids**2).sum(axis=1)[None, :]
+        assign = dists.argmin(axis=1)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, X)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = X[rng.choice(len(X), int(empty.sum()))]
+    return centroids
+
+
+class EmbeddingIndex:
+
+    """
+    An approximate nearest-neighbour index over image embeddings (see extract_embeddings), in NumPy only. Vectors are
+    grouped into inverted lists around k-means centroids (IVF), and a query only scores the vectors of the n_probe
+    lists whose centroids are closest to it. Vectors are stored compactly, either as float16 (half the size of the
+    float32 embeddings, practically exact) or product-quantized: each vector is cut into n_subvectors parts and every
+    part is stored as the one-byte number of its nearest centroid in a per-part codebook (eg. 64 bytes instead of 8kB
+    for a 2048-d embedding), scored against a query with one small lookup table per part, which is also several
+    times faster to search than decoding float16 candidates.
+
+    New vectors can be added at any time with add; the centroids and codebooks are trained once, so adding images
+    never re-encodes the existing vectors. The index is saved under index_path and reopened by passing the same path.
+
+    Paramters:
+        index_path: (string with quotes) directory of the saved index
+        codec: (string with quotes) 'float16' or 'pq'
+        n_lists: (int) number of inverted lists (defaults to about the square root of the number of training vectors)
+        n_subvectors: (int) number of product quantization parts; must divide the embedding size
+        new: (bool) starts an empty index even if one is saved under index_path (which is replaced on save)
+    """
+
+    def __init__(self,
+                 index_path=INDEX_PATH,
+                 codec='float16',
+                 n_lists=None,
+                 n_subvectors=64,
+                 new=False):
+
+        self.index_path = index_path
+        meta_file = os.path.join(index_path, 'meta.json')
+        if os.path.exists(meta_file) and not new:
+            with open(meta_file) as file:
+                self.meta = json.load(file)
+            arrays = np.load(os.path.join(index_path, 'index.npz'))
+            self.centroids = arrays['centroids']
+            self.codebooks = arrays['codebooks'] if self.meta['codec'] == 'pq' else None
+            self.codes = arrays['codes']
+            self.ids = arrays['ids']
+            self.labels = arrays['labels']
+            self.lists = arrays['lists']
+        else:
+            if codec not in CODECS:
+                raise ValueError(f'unknown codec {codec!r}, expected one of {CODECS}')
+            self.meta = {'codec': codec, 'n_lists': n_lists, 'n_subvectors': n_subvectors}
+            self.centroids = None
+            self.codebooks = None
+            self.codes = None
+            self.ids = np.empty(0, dtype=np.int64)
+            self.labels = np.empty(0, dtype=np.int16)
+            self.lists = np.empty(0, dtype=np.int32)
+        self._offsets = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self,
+              embeddings,
+              max_train=20000,
+              n_iter=20,
+              seed=16):
+
+        """
+        Learns the IVF centroids (and for 'pq' the codebooks) from a sample of at most max_train embeddings.
+        """
+
+        X = _normalize(embeddings)
+        if len(X) > max_train:
+            X = X[np.random.RandomState(seed).choice(len(X), max_train, replace=False)]
+
+        n_lists = self.meta['n_lists'] or max(1, int(round(np.sqrt(len(X)))))
+        self.centroids = _normalize(_kmeans(X, n_lists, n_iter=n_iter, seed=seed))
+        self.meta.update(n_lists=len(self.centroids), dim=int(X.shape[1]))
+
+        if self.meta['codec'] == 'pq':
+            m = self.meta['n_subvectors']
+            if X.shape[1] % m:
+                raise ValueError(f'n_subvectors ({m}) must divide the embedding size ({X.shape[1]})')
+            parts = X.reshape(len(X), m, -1)
+            self.codebooks = np.stack([_kmeans(parts[:, j], 256, n_iter=n_iter, seed=seed + j) for j in range(m)])
+
+    def _encode(self, X):
+        if self.meta['codec'] == 'float16':
+            return X.astype(np.float16)
+        parts = X.reshape(len(X), self.meta['n_subvectors'], -1)
+        codes = np.empty(parts.shape[:2], dtype=np.uint8)
+        for j, codebook in enumerate(self.codebooks):
+            dists = -2*parts[:, j] @ codebook.T + (codebook**2).sum(axis=1)[None, :]
+            codes[:, j] = dists.argmin(axis=1)
+        return codes
+
+    def add(self,
+            embeddings,
+            labels,
+            ids=None):
+
+        """
+        Adds embeddings to the index (training it first on them if it is untrained).
+
+        Paramters:
+            embeddings: (array) shape: (number of images, embedding size)
+            labels: (array) class labels of the images, one-hot encoded or as integers
+            ids: (array of ints) ids of the images, eg. their rows in X_train or in the array store (defaults to
+            consecutive ids following the largest id in the index)
+        """
+
+        X = _normalize(embeddings)
+        if not self.is_trained:
+            self.train(X)
+        if X.shape[1] != self.meta['dim']:
+            raise ValueError(f"embedding size {X.shape[1]} does not match the index ({self.meta['dim']})")
+
+        labels = np.asarray(labels)
+        labels = labels.argmax(axis=1) if labels.ndim == 2 else labels
+        if ids is None:
+            start = int(self.ids.max()) + 1 if len(self.ids) else 0
+            ids = np.arange(start, start + len(X))
+
+        codes = self._encode(X)
+        self.codes = codes if self.codes is None else np.concatenate([self.codes, codes])
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self.labels = np.concatenate([self.labels, labels.astype(np.int16)])
+        self.lists = np.concatenate([self.lists, (X @ self.centroids.T).argmax(axis=1).astype(np.int32)])
+        self._offsets = None
+
+    def _inverted_lists(self):
+        # positions of the vectors grouped by list, rebuilt lazily after additions
+        if self._offsets is None:
+            self._order = np.argsort(self.lists, kind='stable')
+            self._offsets = np.concatenate([[0], np.cumsum(np.bincount(self.lists, minlength=len(self.centroids)))])
+        return self._order, self._offsets
+
+    def search(self,
+               queries,
+               k=5,
+               n_probe=8):
+
+        """
+        Finds the approximate k nearest neighbours (by cosine similarity) of each query embedding.
+
+        Paramters:
+            queries: (array) query embeddings; shape: (number of queries, embedding size)
+            k: (int) number of neighbours returned per query
+            n_probe: (int) number of inverted lists searched per query (more is slower but more exact)
+
+        Returns:
+            ids: (int64 array) ids of the neighbours, best first, -1 where fewer than k were found; shape:
+            (number of queries, k)
+            labels: (int array) class labels of the neighbours, -1 where missing
+            scores: (float32 array) cosine similarities (approximate for 'pq'), -inf where missing
+        """
+
+        Q = _normalize(np.atleast_2d(queries))
+        order, offsets = self._inverted_lists()
+        probe = np.argsort(-(Q @ self.centroids.T), axis=1)[:, :n_probe]
+
+        ids = np.full((len(Q), k), -1, dtype=np.int64)
+        labels = np.full((len(Q), k), -1, dtype=np.int16)
+        scores = np.full((len(Q), k), -np.inf, dtype=np.float32)
+
+        for i, q in enumerate(Q):
+            cand = np.concatenate([order[offsets[l]:offsets[l+1]] for l in probe[i]])
+            if not len(cand):
+                continue
+            if self.meta['codec'] == 'float16':
+                s = self.codes[cand].astype(np.float32) @ q
+            else:
+                m = self.meta['n_subvectors']
+                table = np.einsum('mcd,md->mc', self.codebooks, q.reshape(m, -1))
+                s = table[np.arange(m), self.codes[cand]].sum(axis=1)
+            top = np.argsort(-s, kind='stable')[:k]
+            ids[i, :len(top)] = self.ids[cand[top]]
+            labels[i, :len(top)] = self.labels[cand[top]]
+            scores[i, :len(top)] = s[top]
+
+        return ids, labels, scores
+
+    def save(self):
+
+        """
+        Writes the index to index_path (replacing the previous version atomically).
+        """
+
+        os.makedirs(self.index_path, exist_ok=True)
+        arrays = {'centroids': self.centroids, 'codes': self.codes, 'ids': self.ids, 'labels': self.labels,
+                  'lists': self.lists}
+        if self.codebooks is not None:
+            arrays['codebooks'] = self.codebooks
+        tmp_file = os.path.join(self.index_path, 'index.tmp.npz')
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, os.path.join(self.index_path, 'index.npz'))
+        with open(os.path.join(self.index_path, 'meta.tmp'), 'w') as file:
+            json.dump(self.meta, file)
+        os.replace(os.path.join(self.index_path, 'meta.tmp'), os.path.join(self.index_path, 'meta.json'))
+
+
+def build_embedding_index(model_name='model_13',
+                          X=None,
+                          y=None,
+                          index_path=INDEX_PATH,
+                          codec='float16',
+                          n_lists=None,
+                          n_subvectors=64,
+                          layer=-2,
+                          batch_size=64):
+
+    """
+    Extracts the embeddings of a labelled image set (by default X_train) and builds and saves an EmbeddingIndex of
+    them, with the image rows as ids.
+
+    Paramters:
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5 file
+        X: (uint8 array, memory-mapped array or ArrayStore) the images, not normalized (defaults to X_train)
+        y: (array) the class data of X, one-hot encoded or as integers
+        index_path: (string with quotes) directory in which the index is saved
+        codec, n_lists, n_subvectors: as for EmbeddingIndex
+        layer, batch_size: as for extract_embeddings
+
+    Returns:
+        index: (EmbeddingIndex) the saved index
+    """
+
+    start_time = time.perf_counter()
+    if X is None:
+        from functions.array_store import open_array_data
+        X, y = open_array_data('train')
+
+    embeddings = extract_embeddings(model_name, X, layer=layer, batch_size=batch_size)
+    index = EmbeddingIndex(index_path=index_path, codec=codec, n_lists=n_lists, n_subvectors=n_subvectors, new=True)
+    index.train(embeddings)
+    index.add(embeddings, y, ids=np.arange(len(embeddings)))
+    index.meta.update(model_hash=get_registry().model_hash(model_name), layer=layer)
+    index.save()
+    _indexes[os.path.abspath(index_path)] = index
+    print(f'Embedding index of {len(index)} images saved under {index_path}! '
+          f'({round(time.perf_counter() - start_time,2)}s)')
+
+    return index
+
+
+def update_embedding_index(X_new,
+                           y_new,
+                           ids=None,
+                           model_name='model_13',
+                           index_path=INDEX_PATH,
+                           batch_size=64):
+
+    """
+    Adds newly ingested images to a saved index without rebuilding it: only the new images are run through the model,
+    and they are encoded with the existing centroids and codebooks. The model must be the one the index was built
+    with.
+
+    Paramters:
+        X_new: (uint8 array, memory-mapped array or ArrayStore) the new images, not normalized
+        y_new: (array) the class data of the new images, one-hot encoded or as integers
+        ids: (array of ints) ids of the new images, eg. their array store rows (defaults to consecutive ids)
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5 file
+        index_path: (string with quotes) directory of the saved index
+        batch_size: (int) number of images per batch
+
+    Returns:
+        index: (EmbeddingIndex) the updated, saved index
+    """
+
+    index = EmbeddingIndex(index_path=index_path)
+    if not index.is_trained:
+        raise ValueError(f'no embedding index under {index_path}, build one with build_embedding_index first')
+    if index.meta.get('model_hash') != get_registry().model_hash(model_name):
+        raise ValueError(f'{model_name} is not the model the index was built with, rebuild the index instead')
+
+    index.add(extract_embeddings(model_name, X_new, layer=index.meta['layer'], batch_size=batch_size), y_new, ids=ids)
+    index.save()
+    _indexes[os.path.abspath(index_path)] = index
+    print(f'{len(X_new)} images added to the embedding index under {index_path}!')
+
+    return index
+
+
+def similar_images(user_img,
+                   k=5,
+                   model_name='model_13',
+                   index_path=INDEX_PATH,
+                   n_probe=8):
+
+    """
+    Finds the labelled reference images most similar to an image, by the model's own embedding of it. The index is
+    loaded once per session, and the embedding model is cached in the model registry.
+
+    Paramters:
+        user_img: (string with quotes) path to the image, or an already decoded RGB image array of any size (resized to the model's input size)
+        k: (int) number of similar images returned
+        model_name: (string with quotes) model the index was built with
+        index_path: (string with quotes) directory of the saved index
+        n_probe: as for EmbeddingIndex.search
+
+    Returns:
+        ids: (int64 array) ids (eg. X_train rows) of the most similar images, best first
+        labels: (int array) their class labels
+        scores: (float32 array) their cosine similarities
+    """
+
+    import cv2
+
+    index_path = os.path.abspath(index_path)
+    if index_path not in _indexes:
+        index = EmbeddingIndex(index_path=index_path)
+        # an empty index is not cached, so that one built later (eg. by another process) is picked up
+        if not index.is_trained:
+            raise ValueError(f'no embedding index under {index_path}, build one with build_embedding_index first')
+        _indexes[index_path] = index
+    index = _indexes[index_path]
+
+    img = user_img
+    if isinstance(user_img, str):
+        img = cv2.cvtColor(cv2.imread(user_img), cv2.COLOR_BGR2RGB)
+    height, width = get_registry().get(model_name).input_shape[1:3]
+    img = cv2.resize(img, (width, height), interpolation=cv2.INTER_CUBIC)
+
+    query = extract_embeddings(model_name, img[None], layer=index.meta['layer'])
+    ids, labels, scores = index.search(query, k=k, n_probe=n_probe)
+
+    return ids[0], labels[0], scores[0]
@@ -0,0 +1,229 @@
+import numpy as np
+import pandas as pd
+
+
+def to_labels(y):
+
+    """
+    Converts one-hot encoded labels or softmax outputs (2D) to integer class labels; 1D input is returned as integers.
+    """
+
+    y = np.asarray(y)
+    return y.argmax(axis=1) if y.ndim == 2 else y.astype(np.int64)
+
+
+def confusion_matrix(actual,
+                     pred,
+                     n_classes):
+
+    """
+    Computes the n_classes-by-n_classes confusion matrix (rows actual, columns predicted) with a single bincount over
+    actual*n_classes + pred. pred may also be a 2D array of predictions from several models, in which case one matrix
+    per model is returned, stacked along the first axis.
+    """
+
+    actual = np.asarray(actual, dtype=np.int64)
+    pred = np.asarray(pred, dtype=np.int64)
+
+    if pred.ndim == 1:
+        return np.bincount(actual*n_classes + pred, minlength=n_classes**2).reshape(n_classes, n_classes)
+
+    n_models = pred.shape[0]
+    flat = np.arange(n_models)[:, None]*n_classes**2 + actual[None, :]*n_classes + pred
+    return np.bincount(flat.ravel(), minlength=n_models*n_classes**2).reshape(n_models, n_classes, n_classes)
+
+
+def _safe_divide(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    return np.divide(a, b, out=np.zeros_like(a), where=b > 0)
+
+
+def cm_metrics(cm):
+
+    """
+    Derives per-class counts, precision, recall and F1 (and overall accuracy) from one confusion matrix.
+    """
+
+    tp = np.diag(cm)
+    pred_counts = cm.sum(axis=0)
+    actual_counts = cm.sum(axis=1)
+    precision = _safe_divide(tp, pred_counts)
+    recall = _safe_divide(tp, actual_counts)
+    f1 = _safe_divide(2*precision*recall, precision + recall)
+
+    return {'confusion_matrix': cm,
+            'actual_counts': actual_counts,
+            'predicted_counts': pred_counts,
+            'precision': precision,
+            'recall': recall,
+            'f1': f1,
+            'accuracy': float(tp.sum() / max(cm.sum(), 1)),
+            'macro_f1': float(f1.mean())}
+
+
+class EvaluationAccumulator:
+
+    """
+    Accumulates confusion matrices and top-k hit counts for several models over a test set that is fed in batches, so
+    that test sets which do not fit in memory can be evaluated incrementally. Every model is updated with the same
+    batch of true labels in a single bincount.
+
+    Paramters:
+        model_names: (list of strings) names of the models being compared
+        n_classes: (int) number of classes
+        top_k: (tuple of ints) values of k for which top-k accuracy is reported (needs softmax outputs)
+    """
+
+    def __init__(self,
+                 model_names,
+                 n_classes,
+                 top_k=(1, 3, 5)):
+
+        self.model_names = list(model_names)
+        self.n_classes = n_classes
+        self.top_k = tuple(k for k in top_k if k <= n_classes)
+        self.cm = np.zeros((len(self.model_names), n_classes, n_classes), dtype=np.int64)
+        self.top_k_hits = np.zeros((len(self.model_names), len(self.top_k)), dtype=np.int64)
+        self.has_probs = np.zeros(len(self.model_names), dtype=bool)
+        self.n_seen = 0
+
+    def update(self,
+               y_true,
+               preds):
+
+        """
+        Adds one batch to the running totals.
+
+        Paramters:
+            y_true: (array) actual labels for the batch, one-hot encoded or as integers
+            preds: (dict) model name -> softmax outputs (2D) or predicted integer labels (1D) for the batch
+        """
+
+        actual = to_labels(y_true)
+        pred_labels = np.stack([to_labels(preds[name]) for name in self.model_names])
+        self.cm += confusion_matrix(actual, pred_labels, self.n_classes)
+
+        for m, name in enumerate(self.model_names):
+            p = np.asarray(preds[name])
+            if p.ndim != 2 or not self.top_k:
+                continue
+            self.has_probs[m] = True
+            # rank of the actual class = number of classes given a strictly higher probability
+            rank = (p > np.take_along_axis(p, actual[:, None], axis=1)).sum(axis=1)
+            self.top_k_hits[m] += [(rank < k).sum() for k in self.top_k]
+
+        self.n_seen += len(actual)
+        return self
+
+    def results(self):
+
+        """
+        Returns a dictionary of model name -> metrics (see cm_metrics), including top_k_accuracy where softmax outputs
+        were given.
+        """
+
+        out = {}
+        for m, name in enumerate(self.model_names):
+            metrics = cm_metrics(self.cm[m])
+            if self.has_probs[m]:
+                metrics['top_k_accuracy'] = {k: self.top_k_hits[m, i] / max(self.n_seen, 1)
+                                             for i, k in enumerate(self.top_k)}
+            out[name] = metrics
+        return out
+
+
+def evaluate_models(preds,
+                    y_test,
+                    n_classes=None,
+                    top_k=(1, 3, 5)):
+
+    """
+    Evaluates any number of models against one test set in a single vectorized pass.
+
+    Paramters:
+        preds: (dict) model name -> softmax outputs (2D) or predicted integer labels (1D) over the test set
+        y_test: (array) the actual labels for the test set, one-hot encoded or as integers
+        n_classes: (int) number of classes (defaults to the width of the one-hot labels)
+        top_k: (tuple of ints) values of k for which top-k accuracy is reported
+
+    Returns:
+        results: (dict) model name -> dictionary of confusion matrix, per-class counts, precision, recall, F1,
+        accuracy and top-k accuracy
+    """
+
+    y_test = np.asarray(y_test)
+    if n_classes is None:
+        n_classes = y_test.shape[1] if y_test.ndim == 2 else int(y_test.max()) + 1
+
+    return EvaluationAccumulator(preds.keys(), n_classes, top_k=top_k).update(y_test, preds).results()
+
+
+def evaluation_summary(results):
+
+    """
+    Tabulates the headline metrics of evaluate_models (or EvaluationAccumulator.results) with one row per model,
+    sorted by accuracy.
+    """
+
+    rows = []
+    for name, metrics in results.items():
+        row = {'model': name, 'accuracy': metrics['accuracy'], 'macro_f1': metrics['macro_f1']}
+        for k, acc in metrics.get('top_k_accuracy', {}).items():
+            row[f'top_{k}_accuracy'] = acc
+        rows.append(row)
+
+    return pd.DataFrame(rows).sort_values('accuracy', ascending=False).reset_index(drop=True)
+
+
+def evaluate_saved_models(model_names,
+                          X_test,
+                          y_test,
+                          batch_size=256,
+                          top_k=(1, 3, 5)):
+
+    """
+    Runs several saved models over a test set and evaluates them together. Models whose outputs for this test set are
+    already in the prediction cache are not run again. The others are run one model at a time, each loaded once and
+    fed the test set batch by batch (so the test set never needs to be fully in memory as floats, and any number of
+    checkpoints can be compared without them all being held in memory), and their outputs are added to the cache.
+    All models are then scored in one pass over the outputs.
+
+    Paramters:
+        model_names: (list of strings) model names as saved in the saved_models folder, or paths to .h5 files
+        X_test: (uint8 array, memory-mapped array or ArrayStore) the test images, not normalized
+        y_test: (array) the actual labels for the test set, one-hot encoded or as integers
+        batch_size: (int) number of images per batch
+        top_k: (tuple of ints) values of k for which top-k accuracy is reported
+
+    Returns:
+        results: (dict) model name -> metrics, as returned by evaluate_models
+    """
+
+    from functions.model_registry import get_registry
+    from functions.prediction_cache import get_prediction_cache, array_fingerprint, model_fingerprint
+
+    registry = get_registry()
+    cache = get_prediction_cache()
+    data_hash = array_fingerprint(X_test)
+    y_test = np.asarray(y_test)
+    n_classes = y_test.shape[1] if y_test.ndim == 2 else int(y_test.max()) + 1
+
+    preds = {name: cache.get(model_fingerprint(name), data_hash) for name in model_names}
+    for name in model_names:
+        if preds[name] is not None:
+            continue
+        # the model is looked up once for the whole test set, so the registry never evicts it mid-run
+        model = registry.get(name)
+        p = np.concatenate([np.asarray(model.predict_on_batch(np.asarray(X_test[i:i+batch_size], dtype=np.float32)
+                                                              *(1./255)))
+                            for i in range(0, len(y_test), batch_size)])
+        cache.put(model_fingerprint(name), data_hash, p)
+        # scoring the stored precision so that a fresh run and a cached run give identical results
+        preds[name] = np.asarray(p, dtype=cache.dtype).astype(np.float32)
+
+    acc = EvaluationAccumulator(model_names, n_classes, top_k=top_k)
+    for i in range(0, len(y_test), batch_size):
+        acc.update(y_test[i:i+batch_size], {name: p[i:i+batch_size] for name, p in preds.items()})
+
+    return acc.results()
@@ -0,0 +1,235 @@
+import os
+import time
+import threading
+import numpy as np
+from functions.model_registry import model_file
+
+
+QUANTIZATIONS = [None, 'float16', 'int8']
+
+
+def export_path(model_name,
+                quantization=None):
+
+    """
+    Returns the path of the exported inference artifact of a model, next to its .h5 file (eg.
+    saved_models/model_13_int8.tflite).
+    """
+
+    return f'{os.path.splitext(model_file(model_name))[0]}_{quantization or "float32"}.tflite'
+
+
+def _calibration_data(X_calib,
+                      n_calib,
+                      seed=16):
+
+    # draws a random sample of calibration images (sorted indices, so memory-mapped data is read sequentially)
+    if X_calib is None:
+        from functions.array_store import open_array_data
+        X_calib, _ = open_array_data('train')
+    rng = np.random.default_rng(seed)
+    idx = np.sort(rng.choice(len(X_calib), size=min(n_calib, len(X_calib)), replace=False))
+    return np.asarray(X_calib[idx], dtype=np.float32)*(1./255)
+
+
+def export_model(model_name,
+                 quantization=None,
+                 X_calib=None,
+                 n_calib=200,
+                 out_path=None):
+
+    """
+    Converts a saved Keras model into a TensorFlow Lite inference artifact for CPU serving. The conversion freezes the
+    graph (weights become constants, training-only ops such as dropout are removed) and folds constant expressions, and
+    the custom swish activation is resolved at export time, so the artifact loads without registering custom objects.
+    Optionally the weights are quantized to float16 (half the size, same arithmetic) or the whole model is quantized
+    to int8, with the activation ranges calibrated on a random sample of the training images. Inputs and outputs stay
+    float32 in every case, so the artifact is a drop-in replacement for the .h5 model.
+
+    Paramters:
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5 file
+        quantization: (string with quotes) None, 'float16' or 'int8'
+        X_calib: (uint8 array, memory-mapped array or ArrayStore) images to calibrate int8 quantization on, not
+        normalized (defaults to the training set)
+        n_calib: (int) number of calibration images
+        out_path: (string with quotes) path of the exported file (defaults to saved_models/{model_name}_{type}.tflite)
+
+    Returns:
+        out_path: (string) path of the exported artifact
+    """
+
+    import tensorflow as tf
+    from keras import models
+    from functions.swish import add_swish
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f'quantization must be one of {QUANTIZATIONS}')
+
+    add_swish()
+    model = models.load_model(model_file(model_name))
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        calib = _calibration_data(X_calib, n_calib)
+
+        def representative_dataset():
+            for img in calib:
+                yield [img[np.newaxis]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    out_path = out_path or export_path(model_name, quantization)
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(converter.convert())
+    os.replace(tmp_path, out_path)
+
+    print(f'Exported model saved under {out_path}!')
+
+    return out_path
+
+
+class TFLiteModel:
+
+    """
+    Wraps a TensorFlow Lite interpreter with the parts of the Keras model interface used by the inference paths
+    (input_shape, predict_on_batch and predict), so that the model registry, identify_mushroom and the batch APIs can
+    use an exported artifact in place of the .h5 model. The interpreter is not thread-safe, so calls are serialized.
+
+    Paramters:
+        file_path: (string with quotes) path of the .tflite file
+        num_threads: (int) number of threads the interpreter uses (defaults to the number of cores)
+    """
+
+    def __init__(self,
+                 file_path,
+                 num_threads=None):
+
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        self.file_path = file_path
+        self.interpreter = Interpreter(model_path=file_path, num_threads=num_threads or os.cpu_count())
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch = int(self._input['shape'][0])
+        self._lock = threading.Lock()
+
+    @property
+    def input_shape(self):
+        return (None,) + tuple(int(d) for d in self._input['shape'][1:])
+
+    @property
+    def size_bytes(self):
+        return os.path.getsize(self.file_path)
+
+    def predict_on_batch(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        with self._lock:
+            if len(X) != self._batch:
+                self.interpreter.resize_tensor_input(self._input['index'], [len(X)] + list(X.shape[1:]))
+                self.interpreter.allocate_tensors()
+                self._batch = len(X)
+            self.interpreter.set_tensor(self._input['index'], X)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output['index']).copy()
+
+    def predict(self,
+                X,
+                batch_size=32):
+        return np.concatenate([self.predict_on_batch(X[i:i+batch_size]) for i in range(0, len(X), batch_size)])
+
+
+def _latency_ms(predict,
+                img,
+                repeats):
+
+    # median single-image latency after one warm-up call
+    predict(img)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict(img)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000.
+
+
+def export_report(model_name,
+                  artifact_path,
+                  X_test=None,
+                  y_test=None,
+                  batch_size=64,
+                  repeats=50):
+
+    """
+    Checks an exported artifact against the .h5 model it was exported from: both are run over the test set and
+    compared on accuracy, macro F1 and confusion matrix, on single-image latency and batch throughput, and on file
+    size.
+
+    Paramters:
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5 file
+        artifact_path: (string with quotes) path of the exported .tflite file
+        X_test: (uint8 array, memory-mapped array or ArrayStore) the test images, not normalized (defaults to the
+        test set)
+        y_test: (array) the actual labels for the test set, one-hot encoded or as integers
+        batch_size: (int) number of images per prediction batch
+        repeats: (int) number of timed single-image predictions (the median is reported)
+
+    Returns:
+        report: (dict) accuracy and macro F1 of both models and their difference, the confusion matrix delta
+        (artifact minus original), the number of test images whose predicted class changed, latency, throughput and
+        file sizes with the corresponding ratios
+    """
+
+    from functions.model_registry import get_registry
+    from functions.prediction_cache import cached_predict
+    from functions.evaluate_models import evaluate_models
+
+    if X_test is None:
+        from functions.array_store import open_array_data
+        X_test, y_test = open_array_data('test')
+
+    original = model_file(model_name)
+    registry = get_registry()
+
+    preds = {'original': cached_predict(original, X_test, batch_size=batch_size),
+             'exported': cached_predict(artifact_path, X_test, batch_size=batch_size)}
+    results = evaluate_models(preds, y_test)
+
+    img = np.asarray(X_test[:1], dtype=np.float32)*(1./255)
+    X_batch = np.asarray(X_test[:batch_size], dtype=np.float32)*(1./255)
+    timing = {}
+    for name, path in [('original', original), ('exported', artifact_path)]:
+        predict = registry.predictor(path, batch_size=batch_size)
+        timing[name] = {'latency_ms': _latency_ms(predict, img, repeats),
+                        'imgs_per_sec': len(X_batch) / (_latency_ms(predict, X_batch, 3) / 1000.)}
+
+    sizes = {'original': os.path.getsize(original), 'exported': os.path.getsize(artifact_path)}
+
+    report = {'accuracy': {k: results[k]['accuracy'] for k in preds},
+              'accuracy_drift': results['exported']['accuracy'] - results['original']['accuracy'],
+              'macro_f1': {k: results[k]['macro_f1'] for k in preds},
+              'confusion_matrix_delta': results['exported']['confusion_matrix'] - results['original']['confusion_matrix'],
+              'changed_predictions': int((preds['exported'].argmax(axis=1) != preds['original'].argmax(axis=1)).sum()),
+              'latency_ms': {k: timing[k]['latency_ms'] for k in preds},
+              'imgs_per_sec': {k: timing[k]['imgs_per_sec'] for k in preds},
+              'size_bytes': sizes,
+              'latency_speedup': timing['original']['latency_ms'] / timing['exported']['latency_ms'],
+              'size_ratio': sizes['exported'] / sizes['original']}
+
+    print(f"Accuracy: {round(report['accuracy']['original'],4)} -> {round(report['accuracy']['exported'],4)} "
+          f"({report['changed_predictions']} of {len(y_test)} predictions changed)")
+    print(f"Latency: {round(report['latency_ms']['original'],2)}ms -> {round(report['latency_ms']['exported'],2)}ms "
+          f"({round(report['latency_speedup'],2)}x)")
+    print(f"Size: {round(sizes['original']/2**20,1)}MB -> {round(sizes['exported']/2**20,1)}MB "
+          f"({round(report['size_ratio']*100,1)}%)")
+
+    return report
@@ -0,0 +1,24 @@
+import hashlib
+
+
+def file_hash(file_path,
+              block_size=1 << 20):
+
+    """
+    Computes the SHA-256 content hash of a file, reading it in blocks so that large model files are never held in
+    memory at once.
+
+    Paramters:
+        file_path: (string with quotes) path to the file
+        block_size: (int) number of bytes read at a time
+
+    Returns:
+        digest: (string) the hexadecimal SHA-256 digest of the file contents
+    """
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
@@ -0,0 +1,421 @@
+import os
+import re
+import json
+import time
+import pickle
+import sqlite3
+import pandas as pd
+
+
+# per-epoch timing metrics recorded by TrainingProfiler
+TIMING_KEYS = ['epoch_time_s', 'data_wait_s', 'train_step_s', 'val_time_s', 'checkpoint_s', 'peak_rss_mb']
+
+HISTORY_DB = '../notebooks/model_construction/saved_models/history.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    study TEXT,
+    trial TEXT,
+    status TEXT NOT NULL,
+    config TEXT,
+    started REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS params (
+    run TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (run, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS epochs (
+    run TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (run, metric, epoch)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS runs_study ON runs (study, trial);
+CREATE INDEX IF NOT EXISTS params_name ON params (name, value);
+CREATE INDEX IF NOT EXISTS epochs_metric ON epochs (metric, value);
+"""
+
+# stored in the file's user_version; 1 is the first layout (runs without trial, no params, epochs keyed by epoch
+# before metric), 0 a file that predates versioning
+SCHEMA_VERSION = 2
+
+
+def has_timing(history):
+
+    """
+    Returns True if a history dictionary contains the per-epoch timing recorded by TrainingProfiler.
+    """
+
+    return all(k in history for k in ('epoch_time_s', 'data_wait_s', 'train_step_s', 'val_time_s'))
+
+
+def split_run_name(run):
+
+    """
+    Splits a run name into model number and trial following the notebooks' naming, eg. 'm13_t1' -> ('m13', 't1');
+    other names (eg. 'model_13') are their own model with no trial.
+    """
+
+    match = re.fullmatch(r'(m\d+)_(t\d+)', run)
+    return (match.group(1), match.group(2)) if match else (run, None)
+
+
+def _flatten(config,
+             prefix=''):
+    # flattens nested settings (eg. augmentation options) into dotted parameter names
+    flat = {}
+    for k, v in (config or {}).items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, f'{prefix}{k}.'))
+        else:
+            flat[f'{prefix}{k}'] = v if isinstance(v, (int, float, str)) or v is None else json.dumps(v)
+    return flat
+
+
+class HistoryStore:
+
+    """
+    Training histories of all models and trials in one SQLite file, in place of one pickle per trial. Epoch metrics
+    are stored one value per row, keyed (and clustered) by run, metric and epoch, so a single metric curve or a slice
+    of epochs is read without touching the rest, and cross-trial queries (best epoch, top trials, rolling means,
+    filtering on hyperparameters) run inside SQLite. Runs are written epoch by epoch, so several training processes
+    can record into (and read each other's progress from) the same file while they run. Every metric of the epoch
+    logs is stored, so histories recorded with TrainingProfiler keep their timing.
+
+    Paramters:
+        db_path: (string with quotes) path of the SQLite file
+    """
+
+    def __init__(self, db_path=HISTORY_DB):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        # write-ahead logging lets readers and one writer work at the same time across processes
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            self._migrate()
+
+    def _migrate(self):
+        # brings the file to SCHEMA_VERSION; the write lock is taken first, so that of several processes opening an
+        # old file at the same time only one migrates it
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            columns = [r[1] for r in self.conn.execute('PRAGMA table_info(runs)')]
+            if version < SCHEMA_VERSION and columns and 'trial' not in columns:
+                self._migrate_v1()
+            for statement in SCHEMA.split(';'):
+                self.conn.execute(statement)
+            self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def _migrate_v1(self):
+        # version 1 -> 2: the old tables are renamed, the new ones created and filled from them (trial and params
+        # derived from the run name and config, as start_run does), then the old tables dropped
+        self.conn.execute('ALTER TABLE runs RENAME TO runs_v1')
+        self.conn.execute('ALTER TABLE epochs RENAME TO epochs_v1')
+        self.conn.execute('DROP INDEX IF EXISTS runs_study')
+        for statement in SCHEMA.split(';'):
+            self.conn.execute(statement)
+        runs = self.conn.execute('SELECT run, study, status, config, started, finished FROM runs_v1').fetchall()
+        self.conn.executemany('INSERT INTO runs (run, study, trial, status, config, started, finished) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              [(run, study, split_run_name(run)[1], status, config, started, finished)
+                               for run, study, status, config, started, finished in runs])
+        self.conn.executemany('INSERT OR REPLACE INTO params (run, name, value) VALUES (?, ?, ?)',
+                              [(run, k, v) for run, _, _, config, _, _ in runs
+                               for k, v in _flatten(json.loads(config) if config else None).items()])
+        self.conn.execute('INSERT INTO epochs (run, metric, epoch, value) '
+                          'SELECT run, metric, epoch, value FROM epochs_v1')
+        self.conn.execute('DROP TABLE epochs_v1')
+        self.conn.execute('DROP TABLE runs_v1')
+
+    def __contains__(self, run):
+        return self.conn.execute('SELECT 1 FROM runs WHERE run = ?', (run,)).fetchone() is not None
+
+    def start_run(self,
+                  run,
+                  study=None,
+                  config=None,
+                  status='running'):
+
+        """
+        Registers a run and its hyperparameters (replacing any earlier epochs recorded under the same name). The
+        study defaults to the model number of the run name (eg. 'm13' for 'm13_t1').
+        """
+
+        model, trial = split_run_name(run)
+        with self.conn:
+            self.conn.execute('DELETE FROM epochs WHERE run = ?', (run,))
+            self.conn.execute('DELETE FROM params WHERE run = ?', (run,))
+            self.conn.execute('INSERT OR REPLACE INTO runs (run, study, trial, status, config, started, finished) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (run, study or model, trial, status, json.dumps(config, default=str), time.time(), None))
+            self.conn.executemany('INSERT INTO params (run, name, value) VALUES (?, ?, ?)',
+                                  [(run, k, v) for k, v in _flatten(config).items()])
+
+    def finish_run(self,
+                   run,
+                   status='completed'):
+        with self.conn:
+            self.conn.execute('UPDATE runs SET status = ?, finished = ? WHERE run = ?', (status, time.time(), run))
+
+    def append(self,
+               run,
+               epoch,
+               logs):
+
+        """
+        Records the metrics of one epoch (eg. the logs dictionary passed to a callback's on_epoch_end). Epochs are
+        only ever added; an epoch that is already recorded is rejected.
+        """
+
+        with self.conn:
+            self.conn.executemany('INSERT INTO epochs (run, metric, epoch, value) VALUES (?, ?, ?, ?)',
+                                  [(run, k, epoch, float(v)) for k, v in logs.items()])
+
+    def add_history(self,
+                    run,
+                    history,
+                    study=None,
+                    config=None,
+                    status='completed'):
+
+        """
+        Records a complete history dictionary (as returned by keras' model.fit) as one run.
+        """
+
+        self.start_run(run, study=study, config=config, status=status)
+        with self.conn:
+            self.conn.executemany('INSERT INTO epochs (run, metric, epoch, value) VALUES (?, ?, ?, ?)',
+                                  [(run, k, e, float(v)) for k, values in history.items() for e, v in enumerate(values)])
+            self.conn.execute('UPDATE runs SET finished = started WHERE run = ?', (run,))
+
+    def import_pickles(self,
+                       model_path='../notebooks/model_construction/saved_models/',
+                       configs=None,
+                       overwrite=False):
+
+        """
+        Imports the *_history pickles of a saved models folder (eg. m13_t1_history, model_13_history), one run per
+        pickle named after the file.
+
+        Paramters:
+            model_path: (string with quotes) folder containing the history pickles
+            configs: (dict) run name -> hyperparameters to record with the run (optional)
+            overwrite: (bool) re-imports runs already in the store
+
+        Returns:
+            imported: (list of strings) names of the runs imported
+        """
+
+        imported = []
+        for file_name in sorted(os.listdir(model_path)):
+            if not file_name.endswith('_history'):
+                continue
+            run = file_name[:-len('_history')]
+            if run in self and not overwrite:
+                continue
+            with open(os.path.join(model_path, file_name), 'rb') as file:
+                history = pickle.load(file)
+            self.add_history(run, getattr(history, 'history', history), config=(configs or {}).get(run),
+                             status='imported')
+            imported.append(run)
+
+        print(f'{len(imported)} histories imported into {self.db_path}!')
+
+        return imported
+
+    def runs(self,
+             study=None,
+             **params):
+
+        """
+        Returns a dataframe of runs (study, trial, status, start and finish time) with their hyperparameters as
+        columns, optionally for one study and filtered on hyperparameter values, eg. runs(optimizer='Adamax').
+        Nested settings are named with dots (eg. 'augmentation.rotation_range', given here as
+        augmentation__rotation_range=40).
+        """
+
+        names = self.run_names(study, **params)
+        runs = pd.read_sql_query(f"SELECT run, study, trial, status, started, finished FROM runs WHERE run IN "
+                                 f"({', '.join('?' * len(names))}) ORDER BY run", self.conn, params=names)
+        param_df = pd.read_sql_query(f"SELECT run, name, value FROM params WHERE run IN "
+                                     f"({', '.join('?' * len(names))})", self.conn, params=names)
+        if len(param_df):
+            runs = runs.merge(param_df.pivot(index='run', columns='name', values='value'), left_on='run',
+                              right_index=True, how='left')
+        return runs
+
+    def run_names(self,
+                  study=None,
+                  **params):
+
+        """
+        Returns the names of the runs of a study (or all runs) whose hyperparameters match the given values.
+        """
+
+        query = 'SELECT run FROM runs WHERE 1'
+        args = []
+        if study:
+            query += ' AND study = ?'
+            args.append(study)
+        for name, value in params.items():
+            query += ' AND run IN (SELECT run FROM params WHERE name = ? AND value = ?)'
+            args += [name.replace('__', '.'), value]
+        return [r[0] for r in self.conn.execute(query + ' ORDER BY run', args)]
+
+    def history(self,
+                run,
+                metrics=None,
+                start=None,
+                stop=None):
+
+        """
+        Returns the history of a run as a dictionary of metric -> list of per-epoch values, like the history
+        dictionary returned by keras' model.fit. Only the requested metrics and epochs [start, stop) are read.
+        """
+
+        query = 'SELECT metric, value FROM epochs WHERE run = ?'
+        args = [run]
+        if metrics:
+            query += f" AND metric IN ({', '.join('?' * len(metrics))})"
+            args += list(metrics)
+        if start is not None:
+            query += ' AND epoch >= ?'
+            args.append(start)
+        if stop is not None:
+            query += ' AND epoch < ?'
+            args.append(stop)
+
+        history = {}
+        for metric, value in self.conn.execute(query + ' ORDER BY metric, epoch', args):
+            history.setdefault(metric, []).append(value)
+        return history
+
+    def metric_curves(self,
+                      metric,
+                      runs):
+
+        """
+        Returns a dictionary of run name -> list of per-epoch values of one metric for the given runs.
+        """
+
+        curves = {r: [] for r in runs}
+        rows = self.conn.execute(f"SELECT run, value FROM epochs WHERE metric = ? AND run IN "
+                                 f"({', '.join('?' * len(curves))}) ORDER BY run, epoch", (metric, *curves))
+        for run, value in rows:
+            curves[run].append(value)
+        return curves
+
+    def best_epochs(self,
+                    metric='val_acc',
+                    mode='max',
+                    study=None,
+                    **params):
+
+        """
+        Returns a dataframe with the best epoch (counted from 1) and value of a metric for every matching run, best
+        run first.
+
+        Paramters:
+            metric: (string with quotes) metric to rank by
+            mode: (string with quotes) 'max' or 'min' (eg. 'min' for val_loss)
+            study: (string with quotes) restricts the query to one model's trials (eg. 'm13')
+            params: hyperparameter values the runs must match (eg. optimizer='Adamax')
+        """
+
+        if mode not in ('max', 'min'):
+            raise ValueError("mode must be 'max' or 'min'")
+        names = self.run_names(study, **params)
+        order = 'DESC' if mode == 'max' else 'ASC'
+        query = f"""
+            SELECT run, epoch + 1 AS epoch, value, n_epochs FROM (
+                SELECT run, epoch, value,
+                       ROW_NUMBER() OVER (PARTITION BY run ORDER BY value {order}, epoch) AS rank,
+                       COUNT(*) OVER (PARTITION BY run) AS n_epochs
+                FROM epochs WHERE metric = ? AND run IN ({', '.join('?' * len(names))}))
+            WHERE rank = 1 ORDER BY value {order}"""
+        # the metric name is only ever a query parameter; the value column is renamed after it here (with a suffix if
+        # the name is one of the other columns, eg. 'epoch')
+        best = pd.read_sql_query(query, self.conn, params=[metric, *names])
+        return best.rename(columns={'value': f'{metric}_value' if metric in ('run', 'epoch', 'n_epochs') else metric})
+
+    def top_runs(self,
+                 n=10,
+                 metric='val_acc',
+                 mode='max',
+                 study=None,
+                 **params):
+
+        """
+        Returns the best n runs by their best value of a metric (see best_epochs), with their hyperparameters.
+        """
+
+        best = self.best_epochs(metric, mode, study, **params).head(n)
+        return best.merge(self.runs(study, **params).drop(columns=['started', 'finished']), on='run', how='left')
+
+    def rolling_mean(self,
+                     runs,
+                     metric='val_acc',
+                     window=5):
+
+        """
+        Returns a dataframe of the rolling mean (over window epochs, computed in SQLite) of a metric, one column per
+        run and one row per epoch.
+        """
+
+        runs = [runs] if isinstance(runs, str) else list(runs)
+        query = f"""
+            SELECT run, epoch, AVG(value) OVER (PARTITION BY run ORDER BY epoch
+                                                ROWS BETWEEN {int(window) - 1} PRECEDING AND CURRENT ROW) AS value
+            FROM epochs WHERE metric = ? AND run IN ({', '.join('?' * len(runs))})"""
+        df = pd.read_sql_query(query, self.conn, params=[metric, *runs])
+        return df.pivot(index='epoch', columns='run', values='value').reindex(columns=runs)
+
+    def close(self):
+        self.conn.close()
+
+
+def load_history(run,
+                 metrics=None,
+                 db_path=HISTORY_DB,
+                 model_path='../notebooks/model_construction/saved_models/'):
+
+    """
+    Returns the history dictionary of a run, reading only the requested metrics from the history store when the run
+    is recorded there, and falling back to its pickle in the saved models folder otherwise, or when the pickle was
+    written after the run was recorded (eg. rewritten by save_best or a notebook's training cells).
+
+    Paramters:
+        run: (string with quotes) name of the model or trial (eg. 'm13_t1')
+        metrics: (list of strings) metrics needed (defaults to all)
+        db_path: (string with quotes) path of the history store
+        model_path: (string with quotes) folder containing the history pickles
+
+    Returns:
+        history: (dict) metric -> list of per-epoch values
+    """
+
+    pickle_path = f'{model_path}{run}_history'
+    if os.path.exists(db_path):
+        store = HistoryStore(db_path)
+        try:
+            row = store.conn.execute('SELECT finished FROM runs WHERE run = ?', (run,)).fetchone()
+            # runs still training have no finish time, and their store copy is the only up-to-date one
+            if row and (row[0] is None or not os.path.exists(pickle_path) or os.path.getmtime(pickle_path) <= row[0]):
+                return store.history(run, metrics)
+        finally:
+            store.close()
+
+    with open(pickle_path, 'rb') as file:
+        history = pickle.load(file)
+    history = getattr(history, 'history', history)
+    return {k: v for k, v in history.items() if not metrics or k in metrics}
@@ -1,45 +1,28 @@
 import cv2
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
-import tensorflow as tf
-from tensorflow import keras
-from keras import models
+from functions.model_registry import get_registry
+from functions.species import SPECIES_LIST
 
-def identify_mushroom(user_img):
+def identify_mushroom(user_img,
+                      model_name='model_13'):
     
     """
-    Runs the mushroom identification model on an image in the repository
+    Runs the mushroom identification model on an image in the repository. The model is loaded once per session and
+    kept in the shared model registry, so repeat identifications only pay for the prediction itself.
     
     Paramters:
-        model_name: (string with quotes) relative path to the image
+        user_img: (string with quotes) relative path to the image
+        model_name: (string with quotes) model to use, either a saved .h5 model or an exported inference artifact 
+        such as 'model_13_int8' (see export_model)
         
     Returns:
         Visualization of the image, along with a classification result
     """            
     
-    species_list = ['Amethyst Deceiver',
-                'Bolete',
-                'Chanterelle',
-                'Chicken Of The Woods',
-                'Death Cap',
-                'False Chanterelle',
-                'False Morel',
-                'Fibrecap',
-                'Field Mushroom',
-                'Fly Agaric',
-                'Giant Puffball',
-                'Grey Oyster',
-                'Morel',
-                'Orange Peel',
-                'Roundhead',
-                'Saddle',
-                'Shaggy Inkcap',
-                'Stinkhorn',
-                'Waxcap',
-                'Yellow Stainer']
+    species_list = SPECIES_LIST
 
-    model_x = models.load_model(f'../notebooks/model_construction/saved_models/model_13.h5')
+    predict = get_registry().predictor(model_name)
     
     base_img = cv2.imread(user_img)
     img = cv2.cvtColor(base_img, cv2.COLOR_BGR2RGB)
@@ -47,11 +30,9 @@ def identify_mushroom(user_img):
     resized_img = cv2.resize(img,(200,200),interpolation=cv2.INTER_CUBIC)  
     expand_norm_img = (np.expand_dims(resized_img, axis=0))*(1./255)
 
-    layer_outputs = [layer.output for layer in model_x.layers] 
-    activation_model = models.Model(inputs=model_x.input, outputs=layer_outputs)
-    activations = activation_model.predict(expand_norm_img)
+    probs = predict(expand_norm_img)
     
-    prob_list = list(np.round((activations[-1][0])*100,2))
+    prob_list = list(np.round((probs[0])*100,2))
     top_result = species_list[prob_list.index(max(prob_list))]   
     
     fig, axs = plt.subplots(2,1, figsize=(5,9))
@@ -0,0 +1,169 @@
+import os
+import glob
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from functions.decode_img import decode_img
+from functions.ingest_imgs import init_decode_worker
+from functions.model_registry import get_registry
+from functions.species import SPECIES_LIST
+
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def list_images(images):
+
+    """
+    Expands a directory, a glob pattern, a single image path or an iterable of paths into a flat list of image paths.
+    Directories are searched (non-recursively) for files with a common image extension, in sorted order.
+    """
+
+    if isinstance(images, str):
+        if os.path.isdir(images):
+            return sorted(os.path.join(images, f) for f in os.listdir(images)
+                          if f.lower().endswith(IMG_EXTENSIONS))
+        if glob.has_magic(images):
+            return sorted(glob.glob(images))
+        return [images]
+
+    return list(images)
+
+
+def _decode_batch(img_paths,
+                  x_size,
+                  y_size):
+
+    # decodes a batch of images in a worker, returning the decoded stack along with the positions that failed
+    imgs = []
+    failed = []
+    for i, img_path in enumerate(img_paths):
+        img = decode_img(img_path, x_size, y_size)
+        if img is None:
+            failed.append(i)
+        else:
+            imgs.append(img)
+    X = np.stack(imgs) if imgs else np.empty((0, y_size, x_size, 3), dtype=np.uint8)
+    return X, failed
+
+
+def _top_k_rows(img_paths,
+                probs,
+                top_k,
+                species_list):
+
+    # turns a batch of softmax outputs into one result row per image, highest probability first
+    order = np.argsort(-probs, axis=1)[:, :top_k]
+    for img_path, p, idx in zip(img_paths, probs, order):
+        row = {'image': img_path, 'status': 'ok', 'error': None}
+        for rank, j in enumerate(idx, start=1):
+            row[f'species_{rank}'] = species_list[j]
+            row[f'prob_{rank}'] = float(p[j])
+        yield row
+
+
+def iter_identify(images,
+                  model_name='model_13',
+                  batch_size=32,
+                  top_k=3,
+                  n_jobs=None,
+                  prefetch=2):
+
+    """
+    Streams identification results for a collection of images. Images are decoded and resized in a pool of worker
+    processes, a few batches ahead of the model, and classified batch_size at a time. Only the final softmax output of
+    the model is computed.
+
+    Paramters:
+        images: (string or iterable) directory, glob pattern, single image path or iterable of image paths
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5/.tflite file
+        batch_size: (int) number of images per model batch
+        top_k: (int) number of most probable species reported per image
+        n_jobs: (int) number of decoding worker processes (defaults to the number of cores; 1 decodes in-process)
+        prefetch: (int) number of batches decoded ahead of the model
+
+    Returns:
+        Generator of dictionaries, one per image, in input order: image path, status ('ok' or 'error'), error message,
+        and species_1..species_k with their probabilities prob_1..prob_k
+    """
+
+    img_paths = list_images(images)
+    registry = get_registry()
+    predict = registry.predictor(model_name, batch_size=batch_size)
+    y_size, x_size = registry.get(model_name).input_shape[1:3]
+    top_k = min(top_k, len(SPECIES_LIST))
+    n_jobs = n_jobs or os.cpu_count() or 1
+
+    batches = [img_paths[i:i+batch_size] for i in range(0, len(img_paths), batch_size)]
+
+    def results(paths, decoded):
+        X, failed = decoded
+        failed = set(failed)
+        ok_paths = [p for i, p in enumerate(paths) if i not in failed]
+        probs = predict(X*(1./255)) if len(X) else np.empty((0, len(SPECIES_LIST)))
+        ok_rows = _top_k_rows(ok_paths, np.asarray(probs), top_k, SPECIES_LIST)
+        for i, p in enumerate(paths):
+            if i in failed:
+                yield {'image': p, 'status': 'error', 'error': 'could not be read or decoded'}
+            else:
+                yield next(ok_rows)
+
+    if n_jobs == 1:
+        for paths in batches:
+            yield from results(paths, _decode_batch(paths, x_size, y_size))
+        return
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_decode_worker) as executor:
+        pending = deque()
+        batch_iter = iter(batches)
+        for paths in batch_iter:
+            pending.append((paths, executor.submit(_decode_batch, paths, x_size, y_size)))
+            if len(pending) > prefetch:
+                break
+        while pending:
+            paths, future = pending.popleft()
+            next_paths = next(batch_iter, None)
+            if next_paths is not None:
+                pending.append((next_paths, executor.submit(_decode_batch, next_paths, x_size, y_size)))
+            yield from results(paths, future.result())
+
+
+def identify_mushrooms(images,
+                       model_name='model_13',
+                       batch_size=32,
+                       top_k=3,
+                       n_jobs=None,
+                       out_path=None):
+
+    """
+    Runs the mushroom identification model over many images at once, without plotting. Unreadable files are reported
+    with status 'error' rather than stopping the run.
+
+    Paramters:
+        images: (string or iterable) directory, glob pattern, single image path or iterable of image paths
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5/.tflite file
+        batch_size: (int) number of images per model batch
+        top_k: (int) number of most probable species reported per image
+        n_jobs: (int) number of decoding worker processes (defaults to the number of cores)
+        out_path: (string with quotes) optional .csv or .parquet file the results are written to
+
+    Returns:
+        df: dataframe with one row per image (see iter_identify for the columns)
+    """
+
+    import pandas as pd
+
+    df = pd.DataFrame(iter_identify(images,
+                                    model_name=model_name,
+                                    batch_size=batch_size,
+                                    top_k=top_k,
+                                    n_jobs=n_jobs))
+
+    if out_path:
+        if out_path.endswith('.parquet'):
+            df.to_parquet(out_path, index=False)
+        else:
+            df.to_csv(out_path, index=False)
+        print(f'{len(df)} results saved under {out_path}!')
+
+    return df
@@ -0,0 +1,273 @@
+import json
+import queue
+import threading
+import time
+import argparse
+from collections import deque
+from concurrent.futures import Future
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from functions.decode_img import decode_img
+from functions.model_registry import get_registry
+from functions.species import SPECIES_LIST
+
+
+class QueueFull(Exception):
+    pass
+
+
+class MicroBatcher:
+
+    """
+    Groups concurrent prediction requests into micro-batches. Requests wait in a bounded queue; a single worker
+    thread takes up to max_batch_size of them, waiting at most max_wait_ms after the first one arrives, and runs
+    them through the model in one predict call. When the queue is full, submit raises QueueFull immediately
+    instead of letting requests pile up.
+
+    Paramters:
+        predict: function taking a normalized image batch and returning the softmax output
+        max_batch_size: (int) largest number of images sent to the model at once
+        max_wait_ms: (float) longest time the first request of a batch waits for others to join it
+        max_queue: (int) maximum number of requests waiting to be batched
+        latency_window: (int) number of most recent requests kept for the latency percentiles
+    """
+
+    def __init__(self,
+                 predict,
+                 max_batch_size=32,
+                 max_wait_ms=10,
+                 max_queue=256,
+                 latency_window=10000):
+
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._latencies = deque(maxlen=latency_window)
+        self._batch_sizes = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self.n_completed = 0
+        self.n_rejected = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, img):
+
+        """
+        Queues one normalized image (height, width, 3) and returns a Future resolving to its softmax output.
+        """
+
+        future = Future()
+        try:
+            self._queue.put_nowait((img, future, time.perf_counter()))
+        except queue.Full:
+            with self._lock:
+                self.n_rejected += 1
+            raise QueueFull('inference queue is full')
+        return future
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                probs = self.predict(np.stack([b[0] for b in batch]))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            with self._lock:
+                self._batch_sizes.append(len(batch))
+                for _, _, queued in batch:
+                    self._latencies.append(done - queued)
+                    self.n_completed += 1
+            for (_, future, _), p in zip(batch, probs):
+                future.set_result(p)
+
+    def metrics(self):
+
+        """
+        Returns request counts, throughput, mean batch size and p50/p95/p99 latency (ms) of the recent requests.
+        """
+
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000.
+            batch_sizes = np.array(self._batch_sizes)
+            n_completed = self.n_completed
+            n_rejected = self.n_rejected
+        elapsed = time.perf_counter() - self._started
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (None, None, None)
+        return {'completed': n_completed,
+                'rejected': n_rejected,
+                'queued': self._queue.qsize(),
+                'throughput_per_sec': n_completed / elapsed if elapsed > 0 else 0.,
+                'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else None,
+                'latency_ms': {'p50': p50, 'p95': p95, 'p99': p99}}
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def probability_breakdown(probs,
+                          species_list=SPECIES_LIST):
+
+    """
+    Formats one softmax output the way identify_mushroom reports it: the most probable species, and the probability
+    of every species as a percentage rounded to two decimals.
+    """
+
+    prob_list = [round(float(p)*100, 2) for p in probs]
+    return {'most_probably': species_list[int(np.argmax(probs))],
+            'probabilities': dict(zip(species_list, prob_list))}
+
+
+def _read_upload(handler):
+    # returns the uploaded image bytes from either a raw request body or the first file of a multipart form
+    length = int(handler.headers.get('Content-Length', 0))
+    body = handler.rfile.read(length)
+    content_type = handler.headers.get('Content-Type', '')
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        for part in message.iter_parts():
+            if part.get_filename() or part.get_content_maintype() == 'image':
+                return part.get_payload(decode=True)
+        return b''
+    return body
+
+
+def make_handler(batcher,
+                 x_size,
+                 y_size,
+                 timeout=30):
+
+    """
+    Builds the HTTP request handler class serving POST /identify, GET /metrics and GET /health with a given batcher.
+    """
+
+    class InferenceHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, batcher.metrics())
+            elif self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/identify':
+                self._send_json(404, {'error': 'not found'})
+                return
+            img = decode_img(_read_upload(self), x_size, y_size)
+            if img is None:
+                self._send_json(400, {'error': 'could not decode uploaded image'})
+                return
+            try:
+                future = batcher.submit(img*(1./255))
+            except QueueFull:
+                self._send_json(503, {'error': 'server busy, try again later'})
+                return
+            try:
+                probs = future.result(timeout=timeout)
+            except Exception as e:
+                self._send_json(500, {'error': str(e) or type(e).__name__})
+                return
+            self._send_json(200, probability_breakdown(probs))
+
+        def log_message(self, format, *args):
+            pass
+
+    return InferenceHandler
+
+
+def serve(model_name='model_13',
+          host='127.0.0.1',
+          port=8000,
+          max_batch_size=32,
+          max_wait_ms=10,
+          max_queue=256):
+
+    """
+    Runs a local HTTP inference service around a saved model. Images are uploaded with POST /identify (raw body or
+    multipart form) and answered with the same species and probability breakdown as identify_mushroom. Concurrent
+    requests are grouped into micro-batches (see MicroBatcher); GET /metrics reports throughput and latency.
+
+    Paramters:
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5/.tflite file
+        host: (string with quotes) interface to listen on
+        port: (int) port to listen on
+        max_batch_size: (int) largest number of images sent to the model at once
+        max_wait_ms: (float) longest time a request waits for a batch to fill
+        max_queue: (int) maximum number of requests waiting; further requests get HTTP 503
+
+    Returns:
+        Runs until interrupted
+    """
+
+    registry = get_registry()
+    y_size, x_size = registry.get(model_name).input_shape[1:3]
+    batcher = MicroBatcher(registry.predictor(model_name, batch_size=max_batch_size),
+                           max_batch_size=max_batch_size,
+                           max_wait_ms=max_wait_ms,
+                           max_queue=max_queue)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, x_size, y_size))
+    print(f'Serving {model_name} on http://{host}:{port}/identify')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Local mushroom identification inference server')
+    parser.add_argument('--model', default='model_13')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    parser.add_argument('--max-queue', type=int, default=256)
+    args = parser.parse_args()
+
+    serve(model_name=args.model,
+          host=args.host,
+          port=args.port,
+          max_batch_size=args.max_batch_size,
+          max_wait_ms=args.max_wait_ms,
+          max_queue=args.max_queue)
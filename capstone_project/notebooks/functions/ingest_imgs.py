@@ -0,0 +1,151 @@
+import os
+import tempfile
+import time
+import numpy as np
+import cv2
+from concurrent.futures import ProcessPoolExecutor
+from functions.decode_img import decode_img
+
+
+def init_decode_worker():
+
+    """
+    Initializer of image decoding worker processes (ProcessPoolExecutor(initializer=init_decode_worker)): each worker
+    decodes on a single thread, so that n_jobs processes do not oversubscribe the cores.
+    """
+
+    cv2.setNumThreads(1)
+
+
+def _ingest_chunk(out_path,
+                  shape,
+                  start,
+                  img_paths,
+                  x_size,
+                  y_size):
+
+    # writes each decoded image straight into its fixed slot of the shared output array and reports failed slots,
+    # along with the source size of every image in the chunk
+    X = np.memmap(out_path, dtype=np.uint8, mode='r+', shape=shape)
+    failed = []
+    sizes = np.zeros((len(img_paths), 2), dtype=np.int32)
+    for offset, img_path in enumerate(img_paths):
+        img, size = decode_img(img_path, x_size, y_size, return_size=True)
+        if img is None:
+            failed.append(start + offset)
+        else:
+            X[start + offset] = img
+            sizes[offset] = size
+    X.flush()
+    del X
+    return failed, sizes
+
+
+def ingest_imgs(img_paths,
+                x_size,
+                y_size,
+                n_jobs=None,
+                chunk_size=64,
+                out_path=None,
+                return_sizes=False):
+
+    """
+    Decodes, resizes and colour-converts a list of images across a pool of worker processes. Every worker writes
+    directly into a preallocated uint8 memory-mapped array, image i always landing in row i, so no intermediate
+    Python list of images is built. Images that fail to decode are dropped (the remaining rows are compacted in
+    place, preserving order) and reported back rather than silently replaced.
+
+    Paramters:
+        img_paths: (list of strings) paths of the images to read, in the desired output order
+        x_size: (integer) the desired horizontal output size of each image in pixels
+        y_size: (integer) the desired vertical output size of each image in pixels
+        n_jobs: (int) number of worker processes (defaults to the number of cores; 1 decodes in-process)
+        chunk_size: (int) number of images handed to a worker at a time
+        out_path: (string with quotes) path of the .dat file to hold the output array; if given, the returned array
+        is a np.memmap backed by that file, otherwise the result is read into memory and the temporary file removed
+        return_sizes: (bool) also returns the source (height, width) of every input image
+
+    Returns:
+        X: (uint8 array) the image data; shape: (number of decoded images, y_size, x_size, 3)
+        failed: (list of strings) paths of the images that could not be decoded
+        stats: (dict) number of images, number of failures, elapsed seconds and throughput in images/sec
+        sizes: (int array) source (height, width) of each input image in input order, zero for failed images (if
+        return_sizes is True)
+    """
+
+    img_paths = list(img_paths)
+    n_imgs = len(img_paths)
+    xs = int(x_size)
+    ys = int(y_size)
+    shape = (n_imgs, ys, xs, 3)
+    n_jobs = n_jobs or os.cpu_count() or 1
+
+    if out_path:
+        tmp_dir = None
+        dat_path = out_path
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix='ingest_imgs_')
+        dat_path = os.path.join(tmp_dir, 'X.dat')
+
+    start_time = time.perf_counter()
+
+    # preallocating the output file; workers open their own view onto it
+    np.memmap(dat_path, dtype=np.uint8, mode='w+', shape=shape if n_imgs else (1,)).flush()
+
+    chunks = [(i, img_paths[i:i+chunk_size]) for i in range(0, n_imgs, chunk_size)]
+    failed_idx = []
+    sizes = np.zeros((n_imgs, 2), dtype=np.int32)
+
+    if n_jobs == 1 or len(chunks) <= 1:
+        results = (_ingest_chunk(dat_path, shape, start, paths, xs, ys) for start, paths in chunks)
+        for (start, _), (chunk_failed, chunk_sizes) in zip(chunks, results):
+            failed_idx.extend(chunk_failed)
+            sizes[start:start+len(chunk_sizes)] = chunk_sizes
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_decode_worker) as executor:
+            futures = [executor.submit(_ingest_chunk, dat_path, shape, start, paths, xs, ys)
+                       for start, paths in chunks]
+            for (start, _), future in zip(chunks, futures):
+                chunk_failed, chunk_sizes = future.result()
+                failed_idx.extend(chunk_failed)
+                sizes[start:start+len(chunk_sizes)] = chunk_sizes
+
+    failed_idx = sorted(failed_idx)
+    n_ok = n_imgs - len(failed_idx)
+
+    if n_imgs:
+        X_mm = np.memmap(dat_path, dtype=np.uint8, mode='r+', shape=shape)
+
+        # compacting the decoded rows forward over any failed slots, one row at a time
+        if failed_idx:
+            ok_mask = np.ones(n_imgs, dtype=bool)
+            ok_mask[failed_idx] = False
+            for dst, src in enumerate(np.flatnonzero(ok_mask)):
+                if dst != src:
+                    X_mm[dst] = X_mm[src]
+            X_mm.flush()
+
+        if tmp_dir:
+            X = np.empty((n_ok, ys, xs, 3), dtype=np.uint8)
+            for i in range(0, n_ok, chunk_size):
+                X[i:i+chunk_size] = X_mm[i:min(i+chunk_size, n_ok)]
+            del X_mm
+        else:
+            X = X_mm[:n_ok]
+    else:
+        X = np.empty((0, ys, xs, 3), dtype=np.uint8)
+
+    if tmp_dir:
+        os.remove(dat_path)
+        os.rmdir(tmp_dir)
+
+    elapsed = time.perf_counter() - start_time
+    stats = {'n_images': n_imgs,
+             'n_failed': len(failed_idx),
+             'seconds': elapsed,
+             'imgs_per_sec': n_imgs / elapsed if elapsed > 0 else float('inf')}
+
+    if return_sizes:
+        return X, [img_paths[i] for i in failed_idx], stats, sizes
+
+    return X, [img_paths[i] for i in failed_idx], stats
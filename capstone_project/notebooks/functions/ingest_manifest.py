@@ -0,0 +1,244 @@
+import os
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from functions.file_hash import file_hash
+from functions.ingest_imgs import ingest_imgs
+from functions.array_store import ArrayStore, append_array_store, remove_array_store_rows
+
+
+STORE_PATH = '../data/0002_array_data/all_data/X_all_store'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    class TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT,
+    status TEXT NOT NULL,
+    height INTEGER,
+    width INTEGER,
+    store_row INTEGER,
+    duplicate_of TEXT
+);
+CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256);
+CREATE INDEX IF NOT EXISTS images_class ON images (class);
+"""
+
+
+def _scan_class_dir(base_path,
+                    class_name):
+
+    # lists the files of one class directory with the stats needed to detect changes
+    files = []
+    with os.scandir(f'{base_path}{class_name}') as entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                files.append({'path': f'{base_path}{class_name}/'+entry.name,
+                              'class': class_name,
+                              'size': stat.st_size,
+                              'mtime_ns': stat.st_mtime_ns})
+    return files
+
+
+def scan_img_dirs(base_path,
+                  class_names,
+                  n_jobs=None):
+
+    """
+    Lists every image file in the class subdirectories (ie. ../base_path/class_name/) with its size and modification
+    time, scanning the class directories in parallel with os.scandir.
+
+    Paramters:
+        base_path: the base path to the directory containing all of the class subdirectories
+        class_names: (list of strings) names of the classes as they appear in the subdirectory names
+        n_jobs: (int) number of directories scanned at once (defaults to the number of classes)
+
+    Returns:
+        files: (list of dicts) path, class, size and mtime_ns of each file, sorted by class then path
+    """
+
+    with ThreadPoolExecutor(max_workers=n_jobs or len(class_names) or 1) as executor:
+        per_class = list(executor.map(lambda c: _scan_class_dir(base_path, c), class_names))
+
+    return [f for files in per_class for f in sorted(files, key=lambda f: f['path'])]
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def update_ingestion(base_path,
+                     class_names,
+                     store_path=STORE_PATH,
+                     db_path=None,
+                     x_size=200,
+                     y_size=200,
+                     n_jobs=None):
+
+    """
+    Brings the image array store up to date with the image directories, processing only what has changed since the
+    last run. An SQLite manifest records path, size, modification time, content hash, class, decode status, source
+    dimensions and array store row for every file. Files whose size and modification time are unchanged are skipped
+    without being read; new or changed files are hashed, exact duplicates of already ingested content are recorded but
+    not decoded, and the remaining files are decoded in parallel and appended to the array store. The rows of removed
+    files and the old rows of changed files are dropped from the array store (and the store rows in the manifest
+    renumbered), so the store always holds exactly the images of the manifest's 'ok' rows.
+
+    Paramters:
+        base_path: the base path to the directory containing all of the class subdirectories
+        class_names: (list of strings) names of the classes, in class-number order
+        store_path: (string with quotes) directory of the sharded array store receiving the decoded images
+        db_path: (string with quotes) path of the SQLite manifest (defaults to ingest_manifest.sqlite in store_path)
+        x_size: (integer) the desired horizontal output size of each image in pixels
+        y_size: (integer) the desired vertical output size of each image in pixels
+        n_jobs: (int) number of worker processes used for decoding (defaults to the number of cores)
+
+    Returns:
+        summary: (dict) numbers of scanned, new, changed, duplicate, failed and removed files and elapsed seconds
+    """
+
+    start_time = time.perf_counter()
+    os.makedirs(store_path, exist_ok=True)
+    db_path = db_path or os.path.join(store_path, 'ingest_manifest.sqlite')
+    class_no = {c: i for i, c in enumerate(class_names)}
+
+    files = scan_img_dirs(base_path, class_names)
+    conn = _connect(db_path)
+    known = {row[0]: row[1:] for row in conn.execute(
+        'SELECT path, size, mtime_ns, status, sha256, height, width, store_row, duplicate_of FROM images')}
+
+    todo = [f for f in files if f['path'] not in known or known[f['path']][:2] != (f['size'], f['mtime_ns'])
+            or known[f['path']][2] == 'missing']
+    scanned_paths = set(f['path'] for f in files)
+    removed = [p for p, row in known.items() if p not in scanned_paths and row[2] != 'missing']
+
+    # hashing only the new and changed files; hashing is I/O bound, so threads are enough
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count() or 1) as executor:
+        for f, digest in zip(todo, executor.map(lambda f: file_hash(f['path']), todo)):
+            f['sha256'] = digest
+
+    # duplicates of a file that has been removed or whose content has changed are no longer covered by it, so they
+    # are queued again (and decoded, unless another ingested file still has the same content)
+    lost = set(removed) | set(f['path'] for f in todo if f['path'] in known and known[f['path']][3] != f['sha256'])
+    todo_paths = set(f['path'] for f in todo)
+    for f in files:
+        old = known.get(f['path'])
+        if old and old[2] == 'duplicate' and old[7] in lost:
+            f['requeued'] = True
+            if f['path'] not in todo_paths:
+                f['sha256'] = old[3]
+                todo.append(f)
+                todo_paths.add(f['path'])
+
+    seen = {sha: path for path, sha in conn.execute("SELECT path, sha256 FROM images WHERE status = 'ok'")
+            if path not in todo_paths and path not in lost}
+    to_decode = []
+    for f in todo:
+        old = known.get(f['path'])
+        if old and not f.get('requeued') and old[3] == f['sha256'] and old[2] in ('ok', 'duplicate', 'failed'):
+            # touched but not modified: keeping the existing record
+            f.update(status=old[2], height=old[4], width=old[5], store_row=old[6], duplicate_of=old[7])
+            if old[2] == 'ok':
+                seen[f['sha256']] = f['path']
+        elif f['sha256'] in seen:
+            f.update(status='duplicate', duplicate_of=seen[f['sha256']])
+        else:
+            seen[f['sha256']] = f['path']
+            to_decode.append(f)
+
+    # store rows no longer backed by an ingested file (old versions of changed files, removed files) are dropped from
+    # the store, so that it only ever holds the images of the manifest's 'ok' rows
+    store_exists = os.path.exists(os.path.join(store_path, 'manifest.json'))
+    live_rows = {row for path, row in conn.execute("SELECT path, store_row FROM images WHERE status = 'ok'")
+                 if path not in todo_paths and path not in lost}
+    live_rows |= set(f['store_row'] for f in todo if f.get('status') == 'ok')
+    dead_rows = sorted(set(range(len(ArrayStore(store_path)) if store_exists else 0)) - live_rows)
+    new_rows = None
+    if dead_rows:
+        new_rows = remove_array_store_rows(store_path, dead_rows)
+        for f in todo:
+            if f.get('status') == 'ok':
+                f['store_row'] = int(new_rows[f['store_row']])
+
+    if to_decode:
+        X_new, failed, stats, sizes = ingest_imgs([f['path'] for f in to_decode], x_size, y_size,
+                                                  n_jobs=n_jobs, return_sizes=True)
+        failed = set(failed)
+        decoded = [f for f in to_decode if f['path'] not in failed]
+        labels = np.array([class_no[f['class']] for f in decoded], dtype=np.int16)
+        store_start = len(ArrayStore(store_path)) if store_exists else 0
+        append_array_store(X_new, labels, store_path, n_classes=len(class_names))
+
+        row = store_start
+        for f, size in zip(to_decode, sizes):
+            if f['path'] in failed:
+                f.update(status='failed')
+            else:
+                f.update(status='ok', height=int(size[0]), width=int(size[1]), store_row=row)
+                row += 1
+
+    with conn:
+        if new_rows is not None:
+            conn.executemany('UPDATE images SET store_row = ? WHERE path = ?',
+                             [(int(new_rows[row]), path) for path, row in conn.execute(
+                                 "SELECT path, store_row FROM images WHERE status = 'ok'").fetchall()
+                              if path not in todo_paths and row < len(new_rows) and new_rows[row] >= 0])
+        conn.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         [(f['path'], f['class'], f['size'], f['mtime_ns'], f['sha256'], f['status'],
+                           f.get('height'), f.get('width'), f.get('store_row'), f.get('duplicate_of'))
+                          for f in todo])
+        conn.executemany("UPDATE images SET status = 'missing', store_row = NULL WHERE path = ?",
+                         [(p,) for p in removed])
+    conn.close()
+
+    summary = {'scanned': len(files),
+               'new': sum(1 for f in todo if f['path'] not in known),
+               'changed': sum(1 for f in todo if f['path'] in known and known[f['path']][3] != f['sha256']),
+               'duplicates': sum(1 for f in todo if f['status'] == 'duplicate'),
+               'failed': sum(1 for f in todo if f['status'] == 'failed'),
+               'removed': len(removed),
+               'store_rows_dropped': len(dead_rows),
+               'seconds': time.perf_counter() - start_time}
+
+    print(f"Scanned {summary['scanned']} files: {summary['new']} new, {summary['changed']} changed, "
+          f"{summary['duplicates']} duplicates, {summary['failed']} failed, {summary['removed']} removed "
+          f"({round(summary['seconds'],2)}s)")
+
+    return summary
+
+
+def manifest_df(store_path=STORE_PATH,
+                db_path=None,
+                status='ok'):
+
+    """
+    Reads the ingestion manifest into a dataframe. With the default status='ok' the rows are the images currently
+    held in the array store, and the first two columns (image, class) match the output of compile_imgs_to_df.
+
+    Paramters:
+        store_path: (string with quotes) directory of the sharded array store
+        db_path: (string with quotes) path of the SQLite manifest (defaults to ingest_manifest.sqlite in store_path)
+        status: (string with quotes) decode status to select ('ok', 'failed', 'duplicate', 'missing'), or None for all
+
+    Returns:
+        df: dataframe of manifest rows, ordered by array store row
+    """
+
+    db_path = db_path or os.path.join(store_path, 'ingest_manifest.sqlite')
+    conn = _connect(db_path)
+    query = 'SELECT path AS image, * FROM images'
+    params = ()
+    if status:
+        query += ' WHERE status = ?'
+        params = (status,)
+    df = pd.read_sql_query(query + ' ORDER BY store_row, path', conn, params=params).drop(columns='path')
+    conn.close()
+
+    return df
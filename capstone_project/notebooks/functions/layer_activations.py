@@ -0,0 +1,177 @@
+import os
+import numpy as np
+from functions.model_registry import get_registry
+
+
+REDUCTIONS = ('mean', 'max', 'topk')
+
+
+def _layer_names(model,
+                 layers):
+
+    # layers may be given by name or by position in model.layers
+    if not hasattr(model, 'layers'):
+        raise ValueError('layer activations need a Keras model (.h5), not an exported inference artifact')
+    if isinstance(layers, (str, int)):
+        layers = [layers]
+    return tuple(model.layers[l].name if isinstance(l, int) else model.get_layer(l).name for l in layers)
+
+
+def activation_model(model_name,
+                     layers):
+
+    """
+    Returns a sub-model of a saved model whose outputs are only the requested layers, built once per model and set of
+    layers and kept in the model registry (so it is dropped with its model when that is evicted or reloaded). Unlike
+    a model with every layer as an output, predicting with it computes nothing past the deepest requested layer and
+    allocates only the requested feature maps.
+
+    Paramters:
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5 file
+        layers: (list of strings or ints) layer names, or positions in model.layers
+
+    Returns:
+        sub_model: (Keras model) model from the original input to the requested layer outputs, in the order given
+        names: (tuple of strings) the requested layer names
+    """
+
+    registry = get_registry()
+    names = _layer_names(registry.get(model_name), layers)
+
+    def build(model):
+        from keras import models
+        return models.Model(inputs=model.inputs, outputs=[model.get_layer(n).output for n in names])
+
+    return registry.cached(model_name, ('activations',) + names, build), names
+
+
+def reduce_activations(acts,
+                       reduce=None,
+                       top_k=5):
+
+    """
+    Reduces a batch of activations over all axes but the first (images) and the last (channels or units).
+
+    Paramters:
+        acts: (array) activations of one layer; shape: (number of images, ..., number of channels)
+        reduce: None (raw activations), 'mean' or 'max' (per channel), 'topk' (the top_k channels with the highest
+        mean activation), or a function taking and returning an array
+        top_k: (int) number of channels kept by 'topk'
+
+    Returns:
+        reduced: (float32 array) for 'mean'/'max' shape (number of images, number of channels); for 'topk' a tuple of
+        channel indices (int32) and their mean activations, each of shape (number of images, top_k)
+    """
+
+    acts = np.asarray(acts)
+    if reduce is None:
+        return acts
+    if callable(reduce):
+        return reduce(acts)
+
+    axes = tuple(range(1, acts.ndim - 1))
+    if reduce == 'max':
+        return acts.max(axis=axes).astype(np.float32)
+    means = acts.mean(axis=axes, dtype=np.float32)
+    if reduce == 'mean':
+        return means
+    if reduce == 'topk':
+        k = min(top_k, means.shape[1])
+        idx = np.argpartition(-means, k - 1, axis=1)[:, :k]
+        vals = np.take_along_axis(means, idx, axis=1)
+        order = np.argsort(-vals, axis=1, kind='stable')
+        return np.take_along_axis(idx, order, axis=1).astype(np.int32), np.take_along_axis(vals, order, axis=1)
+    raise ValueError(f'unknown reduction {reduce!r}, expected one of {REDUCTIONS}, None or a function')
+
+
+def iter_activations(model_name,
+                     X,
+                     layers,
+                     batch_size=32,
+                     reduce=None,
+                     top_k=5,
+                     rescale=1./255):
+
+    """
+    Runs the images through the sub-model of the requested layers (see activation_model) batch by batch, reducing
+    each batch's activations (see reduce_activations) before the next batch is predicted, so that only one batch of
+    raw feature maps is ever in memory.
+
+    Paramters:
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5 file
+        X: (uint8 array, memory-mapped array or ArrayStore) the images, not normalized
+        layers: (list of strings or ints) layer names, or positions in model.layers
+        batch_size: (int) number of images per batch
+        reduce, top_k: as for reduce_activations
+        rescale: (float) factor applied to each batch before prediction
+
+    Returns:
+        generator of (start, activations): start is the index of the batch's first image, activations a dict of
+        layer name -> (reduced) activations of the batch
+    """
+
+    sub_model, names = activation_model(model_name, layers)
+    for start in range(0, len(X), batch_size):
+        X_batch = np.asarray(X[start:start+batch_size], dtype=np.float32)*rescale
+        outputs = sub_model.predict_on_batch(X_batch)
+        if len(names) == 1 and not isinstance(outputs, (list, tuple)):
+            outputs = [outputs]
+        yield start, {n: reduce_activations(o, reduce=reduce, top_k=top_k) for n, o in zip(names, outputs)}
+
+
+def layer_activations(model_name,
+                      X,
+                      layers,
+                      batch_size=32,
+                      reduce='mean',
+                      top_k=5,
+                      rescale=1./255,
+                      out_path=None):
+
+    """
+    Collects the (reduced) activations of the requested layers for a whole image set, eg. channel means of a conv
+    block over the full test set. Outputs are preallocated after the first batch and filled batch by batch; raw
+    feature maps (reduce=None) can be written to memory-mapped .npy files instead of being held in memory.
+
+    Paramters:
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5 file
+        X: (uint8 array, memory-mapped array or ArrayStore) the images, not normalized
+        layers: (list of strings or ints) layer names, or positions in model.layers
+        batch_size: (int) number of images per batch
+        reduce, top_k: as for reduce_activations (defaults to per-channel means)
+        rescale: (float) factor applied to each batch before prediction
+        out_path: (string with quotes) folder in which each layer's output is saved as {layer name}.npy (for 'topk',
+        {layer name}_idx.npy and {layer name}_val.npy) and returned memory-mapped (optional)
+
+    Returns:
+        activations: (dict) layer name -> array of shape (number of images, ...), or for 'topk' a tuple of channel
+        indices and values
+    """
+
+    def allocate(name, part):
+        shape = (len(X),) + part.shape[1:]
+        if out_path is None:
+            return np.empty(shape, dtype=part.dtype)
+        return np.lib.format.open_memmap(f'{out_path}{name}.npy', mode='w+', dtype=part.dtype, shape=shape)
+
+    if out_path is not None:
+        os.makedirs(out_path, exist_ok=True)
+
+    results = {}
+    for start, batch in iter_activations(model_name, X, layers, batch_size=batch_size, reduce=reduce, top_k=top_k,
+                                         rescale=rescale):
+        for name, acts in batch.items():
+            parts = acts if isinstance(acts, tuple) else (acts,)
+            if name not in results:
+                suffixes = ('_idx', '_val') if isinstance(acts, tuple) else ('',)
+                results[name] = tuple(allocate(name + s, p) for s, p in zip(suffixes, parts))
+            for out, part in zip(results[name], parts):
+                out[start:start+len(part)] = part
+
+    for name, outs in results.items():
+        for out in outs:
+            if isinstance(out, np.memmap):
+                out.flush()
+        results[name] = outs if len(outs) > 1 else outs[0]
+
+    return results
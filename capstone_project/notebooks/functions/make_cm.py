@@ -2,7 +2,10 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-import sklearn.metrics as metrics
+from functions.species import load_species_list
+from functions.array_store import open_array_data
+from functions.prediction_cache import cached_predict
+from functions.evaluate_models import confusion_matrix, to_labels
 
 def make_cm(y_pred,
             y_test,
@@ -12,7 +15,8 @@ def make_cm(y_pred,
     Takes the images from the model test datasets and creates a confusion matrix for the classifications.
     
     Paramters:
-        y_pred: (array) the predicted labels for the test set
+        y_pred: (array) the predicted labels for the test set (or the model's softmax outputs); if None, the outputs of
+        the saved model named model_name on the test set are taken from the prediction cache (computed once if needed)
         y_test: (array) the actual labels for the test set (one-hot encoded)
         model_name: (string with quotes) model name for labelling purposes
         
@@ -22,15 +26,14 @@ def make_cm(y_pred,
     
     if model_name:
         
-        species_df = pd.read_csv('../data/0003_general/species_list_final.csv')
-        species_as_list = species_df['common_name'].tolist()
+        species_as_list = list(load_species_list())
         
-        test_preds = y_pred
-        test_results_df = pd.DataFrame(test_preds,columns=['predicted'])
-        test_results_df['actual'] = pd.DataFrame(y_test).idxmax(axis=1)
+        if y_pred is None:
+            X_test, _ = open_array_data('test', data_path='../data/0002_array_data/')
+            y_pred = cached_predict(model_name, X_test)
         
-        cm = metrics.confusion_matrix(test_results_df['actual'],test_results_df['predicted'])
-        cmn = np.true_divide(cm, cm.sum(axis=1, keepdims=True))*100
+        cm = confusion_matrix(to_labels(y_test), to_labels(y_pred), len(species_as_list))
+        cmn = np.true_divide(cm, np.maximum(cm.sum(axis=1, keepdims=True), 1))*100
         df_cmn = pd.DataFrame(cmn, species_as_list, species_as_list)
 
         fig, ax1 = plt.subplots(1,1,figsize=(10,10))
@@ -0,0 +1,52 @@
+from keras import layers
+from keras import models
+
+
+def build_model_13(img_shape=(200, 200, 3),
+                   n_classes=20,
+                   filters=(64, 128, 256, 512, 512),
+                   dense_units=(1024, 2048),
+                   dropout=0.25,
+                   alpha=0.1):
+
+    """
+    Builds (uncompiled) the architecture of the winning model, as defined for trial m13_t1 in model_13.ipynb: five
+    convolution/LeakyReLU/max pool stacks followed by two LeakyReLU dense layers with dropout and a softmax output.
+    The keyword arguments allow variations of the same architecture family to be built for experiments.
+
+    Paramters:
+        img_shape: (tuple) shape of the input images (height, width, channels)
+        n_classes: (int) number of output classes
+        filters: (tuple of ints) number of filters of each convolution stack
+        dense_units: (tuple of ints) number of units of each fully connected layer
+        dropout: (float) dropout rate after each fully connected layer
+        alpha: (float) negative slope of the LeakyReLU activations
+
+    Returns:
+        model: (keras Sequential model) the model architecture
+    """
+
+    model = models.Sequential()
+
+    # convolution/max pool stacks
+    for i, f in enumerate(filters):
+        if i == 0:
+            model.add(layers.Conv2D(f, (3,3), input_shape=img_shape, padding='same'))
+        else:
+            model.add(layers.Conv2D(f, (3,3), padding='same'))
+        model.add(layers.LeakyReLU(alpha=alpha))
+        model.add(layers.MaxPooling2D((2,2)))
+
+    # fully connected layers
+    model.add(layers.Flatten())
+    for units in dense_units:
+        model.add(layers.Dense(units))
+        model.add(layers.LeakyReLU(alpha=alpha))
+        model.add(layers.Dropout(dropout))
+    # the softmax output stays float32 under a mixed precision policy (see configure_runtime) for a stable loss
+    model.add(layers.Dense(n_classes, activation='softmax', dtype='float32'))
+
+    return model
+
+
+ARCHITECTURES = {'model_13': build_model_13}
@@ -0,0 +1,201 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from functions.file_hash import file_hash
+
+
+MODEL_PATH = '../notebooks/model_construction/saved_models/'
+
+
+def model_file(model_name,
+               model_path=MODEL_PATH):
+
+    """
+    Resolves a model name (eg. 'model_13') to its saved .h5 file, or to an exported .tflite artifact (eg.
+    'model_13_int8', see export_model) when there is no .h5 file of that name; names that already end in .h5 or
+    .tflite are taken as paths.
+    """
+
+    if model_name.endswith(('.h5', '.tflite')):
+        return model_name
+    if not os.path.exists(f'{model_path}{model_name}.h5') and os.path.exists(f'{model_path}{model_name}.tflite'):
+        return f'{model_path}{model_name}.tflite'
+    return f'{model_path}{model_name}.h5'
+
+
+def _model_bytes(model):
+    # memory held by the model weights, used for the registry's memory budget
+    if hasattr(model, 'size_bytes'):
+        return model.size_bytes
+    return int(sum(int(np.prod(w.shape)) * w.dtype.size for w in model.weights))
+
+
+class ModelRegistry:
+
+    """
+    An in-process, least-recently-used cache of loaded Keras models (or exported .tflite artifacts, which are loaded
+    as TFLiteModel interpreters with the same predict interface). Each saved model is deserialized once and kept
+    until it is evicted (by number of models or by total weight memory) or until its .h5 file changes on disk. A file
+    counts as changed when its modification time or size differs and its content hash no longer matches, so merely
+    touching a file does not force a reload.
+
+    Paramters:
+        max_models: (int) maximum number of models held at once
+        max_bytes: (int) maximum total weight memory in bytes held at once (defaults to no limit)
+        verify_hash: (bool) re-hashes the file on every lookup, even if its modification time is unchanged
+        warm: (bool) runs a dummy prediction on load so that the first real prediction does not pay for graph tracing
+    """
+
+    def __init__(self,
+                 max_models=4,
+                 max_bytes=None,
+                 verify_hash=False,
+                 warm=True):
+
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.verify_hash = verify_hash
+        self.warm = warm
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, model_name):
+        return os.path.abspath(model_file(model_name)) in self._entries
+
+    @property
+    def total_bytes(self):
+        return sum(e['bytes'] for e in self._entries.values())
+
+    def _is_current(self, entry, file_path):
+        stat = os.stat(file_path)
+        if (stat.st_mtime_ns, stat.st_size) == entry['stat'] and not self.verify_hash:
+            return True
+        if file_hash(file_path) == entry['hash']:
+            entry['stat'] = (stat.st_mtime_ns, stat.st_size)
+            return True
+        return False
+
+    def _load(self, file_path):
+        stat = os.stat(file_path)
+        digest = file_hash(file_path)
+        if file_path.endswith('.tflite'):
+            from functions.export_model import TFLiteModel
+            model = TFLiteModel(file_path)
+        else:
+            # keras (and tensorflow) are only imported once a .h5 model is actually loaded
+            from keras import models
+            model = models.load_model(file_path)
+        if self.warm:
+            model.predict_on_batch(np.zeros((1,) + tuple(model.input_shape[1:]), dtype=np.float32))
+        return {'model': model,
+                'stat': (stat.st_mtime_ns, stat.st_size),
+                'hash': digest,
+                'bytes': _model_bytes(model),
+                'cache': {}}
+
+    def _evict(self):
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_models or
+                (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            self._entries.popitem(last=False)
+
+    def _entry(self, model_name):
+        file_path = os.path.abspath(model_file(model_name))
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None and self._is_current(entry, file_path):
+                self._entries.move_to_end(file_path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            entry = self._load(file_path)
+            self._entries[file_path] = entry
+            self._evict()
+            return entry
+
+    def get(self, model_name):
+
+        """
+        Returns the loaded model for a model name or .h5/.tflite path, loading it only if it is not cached or has changed.
+        """
+
+        return self._entry(model_name)['model']
+
+    def model_hash(self, model_name):
+
+        """
+        Returns the content hash of the .h5 (or .tflite) file behind the currently cached model.
+        """
+
+        return self._entry(model_name)['hash']
+
+    def cached(self, model_name, key, build):
+
+        """
+        Returns an object derived from a model (eg. a sub-model), building it with build(model) on first use. Derived
+        objects are dropped together with their model when it is evicted or reloaded.
+        """
+
+        entry = self._entry(model_name)
+        with self._lock:
+            if key not in entry['cache']:
+                entry['cache'][key] = build(entry['model'])
+            return entry['cache'][key]
+
+    def predictor(self,
+                  model_name,
+                  batch_size=32):
+
+        """
+        Returns a predict function for the model. Small inputs go through predict_on_batch, which avoids the per-call
+        setup of model.predict; larger inputs are predicted in batches of batch_size.
+
+        Paramters:
+            model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5 or
+            .tflite file
+            batch_size: (int) batch size used for inputs larger than one batch
+
+        Returns:
+            predict: function taking a normalized image array (number of images, height, width, 3) and returning the
+            softmax output as an array (number of images, number of classes)
+        """
+
+        def predict(X):
+            model = self.get(model_name)
+            X = np.asarray(X, dtype=np.float32)
+            if len(X) <= batch_size:
+                return np.asarray(model.predict_on_batch(X))
+            return model.predict(X, batch_size=batch_size)
+
+        return predict
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_default_registry = ModelRegistry()
+
+
+def get_registry():
+
+    """
+    Returns the process-wide model registry shared by identify_mushroom, classify_test_image and the batch APIs.
+    """
+
+    return _default_registry
+
+
+def get_model(model_name):
+
+    """
+    Returns a loaded model from the process-wide registry (see ModelRegistry.get).
+    """
+
+    return _default_registry.get(model_name)
@@ -0,0 +1,105 @@
+import time
+
+_MODULE_START = time.perf_counter()
+
+import os
+import sys
+import csv
+import json
+import argparse
+from functions.config import load_config
+
+
+def _format_text(row,
+                 top_k):
+    if row['status'] != 'ok':
+        return f"{row['image']}: error ({row['error']})"
+    guesses = ', '.join(f"{row[f'species_{i}']} ({round(row[f'prob_{i}']*100,1)}%)" for i in range(1, top_k+1))
+    return f"{row['image']}: {guesses}"
+
+
+def main(argv=None):
+
+    """
+    Command-line mushroom identification:
+
+        python -m functions.mushroom_id IMAGE [IMAGE ...] [--model model_13_int8] [--top-k 3] [--format csv]
+
+    run from the notebooks folder (or from anywhere with the notebooks folder on PYTHONPATH). Model and data folders
+    come from the config (see load_config), not from the current directory. Heavy libraries are imported only when
+    needed: tensorflow when a .h5 model is loaded (not at all for a .tflite artifact with tflite_runtime installed),
+    pandas never, matplotlib only with --plot. With --timing the import, model load and first prediction times are
+    reported on stderr.
+
+    Returns:
+        exit code: 0 if every image was identified, 2 if some could not be read
+    """
+
+    parser = argparse.ArgumentParser(prog='mushroom-id', description='Identify the mushroom species in images.')
+    parser.add_argument('images', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('--model', help='model name in the saved models folder or path to a .h5/.tflite file')
+    parser.add_argument('--config', help='JSON config file (default: $MUSHROOM_ID_CONFIG or ~/.config/mushroom_id.json)')
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--n-jobs', type=int, help='decoding processes (default: in-process for small inputs)')
+    parser.add_argument('--format', choices=['text', 'csv', 'json'], default='text')
+    parser.add_argument('--plot', action='store_true', help='show each image with its probability breakdown')
+    parser.add_argument('--timing', action='store_true', help='report import and startup times on stderr')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+
+    from functions.identify_mushrooms import iter_identify, list_images
+    from functions.model_registry import get_registry, model_file
+
+    imports_done = time.perf_counter()
+
+    model_path = model_file(args.model or config['model'], config['model_path'])
+    get_registry().get(model_path)
+    model_loaded = time.perf_counter()
+
+    img_paths = [p for images in args.images for p in list_images(images)]
+    # starting decoding processes costs more than it saves for a handful of images
+    n_jobs = args.n_jobs or (1 if len(img_paths) < 4*args.batch_size else None)
+
+    writer = None
+    first_result = None
+    n_errors = 0
+    for row in iter_identify(img_paths, model_name=model_path, batch_size=args.batch_size, top_k=args.top_k,
+                             n_jobs=n_jobs):
+        if first_result is None:
+            first_result = time.perf_counter()
+        n_errors += row['status'] != 'ok'
+        if args.format == 'json':
+            print(json.dumps(row))
+        elif args.format == 'csv':
+            if writer is None:
+                # the columns come from top_k, not from the first row, which has no predictions if it failed
+                fieldnames = ['image', 'status', 'error'] + [f'{c}_{i}' for i in range(1, args.top_k+1)
+                                                             for c in ('species', 'prob')]
+                writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames, extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow(row)
+        else:
+            print(_format_text(row, args.top_k))
+
+    if args.timing:
+        first_result = first_result or time.perf_counter()
+        print(f'imports: {round((imports_done - _MODULE_START)*1000)}ms, '
+              f'model load: {round((model_loaded - imports_done)*1000)}ms, '
+              f'first result: {round((first_result - model_loaded)*1000)}ms, '
+              f'total: {round((time.perf_counter() - _MODULE_START)*1000)}ms', file=sys.stderr)
+
+    if args.plot:
+        import matplotlib.pyplot as plt
+        from functions.identify_mushroom import identify_mushroom
+
+        for img_path in img_paths:
+            identify_mushroom(img_path, model_name=model_path)
+        plt.show()
+
+    return 2 if n_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
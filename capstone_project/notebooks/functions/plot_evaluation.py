@@ -1,28 +1,33 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import pickle
+from functions.history_store import TIMING_KEYS, has_timing, load_history
 
 def plot_evaluation(model_name,
-                    roll=None):
+                    roll=None,
+                    timing=False):
 
     """
     Creates a plot of the training/validation accuracy and loss over the training epochs.
     
     Paramters:
-        model_name: (string with quotes) name of model to evaluate (note: the model's history dictionary (as 
-        returned by the keras model.fit function) is required to be in the 'saved models' folder
+        model_name: (string with quotes) name of model to evaluate (note: the model's history is required to be in
+        the history store or, as a pickled dictionary returned by the keras model.fit function, in the 'saved models'
+        folder
         roll: (int) includes rolling mean of validation data in visualization with window size given as 
         argument (defaults to None)
+        timing: (bool) adds a panel with the per-epoch time breakdown recorded by TrainingProfiler (ignored if the 
+        history has no timing)
         
     Returns:
         Visualization of training and validation accuracy and loss over the training epochs
     """    
     
-    with open(f'../notebooks/model_construction/saved_models/{model_name}_history', 'rb') as file:
-            model_history=pickle.load(file)      
+    metrics = ['acc', 'val_acc', 'loss', 'val_loss'] + (TIMING_KEYS if timing else [])
+    model_history = load_history(model_name, metrics)
             
-    fig, axs = plt.subplots(1, 2, figsize=(22,8))
+    timing = timing and has_timing(model_history)
+    fig, axs = plt.subplots(1, 3 if timing else 2, figsize=(33 if timing else 22,8))
     fig.suptitle(f'{model_name} Evaluation', fontsize=15)
 
     if roll:
@@ -52,4 +57,26 @@ def plot_evaluation(model_name,
     axs[1].set_xlabel('Epoch')
     axs[1].legend(loc='best')
 
+    if timing:
+        epochs = np.arange(len(model_history['epoch_time_s']))
+        bottom = np.zeros(len(epochs))
+        for key, label, color in [('data_wait_s', 'Data Wait', 'gold'),
+                                  ('train_step_s', 'Train Steps', 'deepskyblue'),
+                                  ('val_time_s', 'Validation', 'salmon'),
+                                  ('checkpoint_s', 'Checkpoint', 'mediumorchid')]:
+            if key in model_history:
+                axs[2].bar(epochs, model_history[key], bottom=bottom, color=color, label=label)
+                bottom += np.array(model_history[key])
+        axs[2].plot(epochs, model_history['epoch_time_s'], color='black', label='Epoch Wall Time')
+        axs[2].set_title('Epoch Time Breakdown')
+        axs[2].set_ylabel('Seconds')
+        axs[2].set_xlabel('Epoch')
+        axs[2].legend(loc='upper left')
+        if 'peak_rss_mb' in model_history:
+            ax_mem = axs[2].twinx()
+            ax_mem.plot(epochs, model_history['peak_rss_mb'], color='forestgreen', linestyle='dotted',
+                        label='Peak RSS')
+            ax_mem.set_ylabel('Peak RSS (MB)')
+            ax_mem.legend(loc='upper right')
+
     plt.show()
\ No newline at end of file
@@ -2,8 +2,9 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
-import pickle
 import os
+from functions.history_store import TIMING_KEYS, has_timing, load_history
+from functions.trial_report import trial_colors, rolling_mean_matrix
 
 def plot_opt_review(models_hists,
                     baseline=None,
@@ -11,14 +12,17 @@ def plot_opt_review(models_hists,
                     trial_no=None,
                     roll=None,
                     val_acc_ylim=None,
-                    val_loss_ylim=None):
+                    val_loss_ylim=None,
+                    timing=False,
+                    save_path=None):
 
     """
     Takes a list of models and histories and plots the training/validation accuracy and loss over the training epochs.
     
     Paramters:
         models_hists: (list) list of pairs of model names (string) and training history (dict - as returned by the 
-                    keras model.fit function)
+                    keras model.fit function), or just model names, whose histories are then read from the history
+                    store (or the saved pickles)
         baseline: (string with quotes) name of baseline model (or any other) as saved in directory (optional)
         prev_best: (string with quotes) name of any other model to compare as saved in directory (optional)
         trial_no: (int) experiment/trial number for labelling purposes
@@ -26,19 +30,25 @@ def plot_opt_review(models_hists,
         argument (defaults to None)
         val_acc_ylim: (tuple) sets y-axis range to tuple specified (min, max) on the accuracy graph
         val_loss_ylim: (tuple) sets y-axis range to tuple specified (min, max) on the loss graph
+        timing: (bool) adds a row with the epoch time and the validation accuracy against cumulative training time
+        of each history recorded with TrainingProfiler (histories without timing are left out of that row)
+        save_path: (string with quotes) saves the figure to this file (eg. .png or .svg) instead of showing it; for
+        large numbers of trials see render_trial_report
         
     Returns:
         Visualization of training and validation accuracy and loss over the training epochs
     """   
     
+    metrics = ['acc', 'val_acc', 'loss', 'val_loss'] + (TIMING_KEYS if timing else [])
+    models_hists = [(h, load_history(h, metrics)) if isinstance(h, str) else h for h in models_hists]
+
     font_dict = {'fontsize': 15}
     color_list = ['deepskyblue','salmon','gold','forestgreen','mediumorchid','darkmagenta','turquoise']  
               
-    fig, axs = plt.subplots(3, 2, figsize=(22,15))
+    fig, axs = plt.subplots(4 if timing else 3, 2, figsize=(22,20 if timing else 15))
 
     if baseline:            
-        with open(f'../notebooks/model_construction/saved_models/{baseline}_history', 'rb') as file:
-            base_hist=pickle.load(file)            
+        base_hist = load_history(baseline, metrics)
         axs[0][0].plot(base_hist['acc'], color='gray', label='Baseline Train', linestyle=':')
         axs[0][1].plot(base_hist['loss'], color='gray', label='Baseline Train', linestyle=':')
         axs[2][0].plot([i-j for i,j in zip(base_hist['acc'],base_hist['val_acc'])], color='gray', label='Baseline TVA Dif')
@@ -58,8 +68,7 @@ def plot_opt_review(models_hists,
         pass
 
     if prev_best:            
-        with open(f'../notebooks/model_construction/saved_models/{prev_best}_history', 'rb') as file:
-            prev_hist=pickle.load(file)                        
+        prev_hist = load_history(prev_best, metrics)
         axs[0][0].plot(prev_hist['acc'], color='black', label=f'{prev_best} Train', linestyle=':')
         axs[0][1].plot(prev_hist['loss'], color='black', label=f'{prev_best} Train', linestyle=':')
         axs[2][0].plot([i-j for i,j in zip(prev_hist['acc'],prev_hist['val_acc'])],color='black',
@@ -80,23 +89,44 @@ def plot_opt_review(models_hists,
     else:
         pass
 
-    for h in models_hists:
-        axs[0][0].plot(h[1]['acc'], color=color_list[models_hists.index(h)], label=f'{h[0]} Train', linestyle=':')
-        axs[0][1].plot(h[1]['loss'], color=color_list[models_hists.index(h)], label=f'{h[0]} Train', linestyle=':')
-        axs[2][0].plot([i-j for i,j in zip(h[1]['acc'],h[1]['val_acc'])],
-                       color=color_list[models_hists.index(h)], label=f'{h[0]} TVA Dif')
-        axs[2][1].plot([j-i for i,j in zip(h[1]['loss'],h[1]['val_loss'])],
-                       color=color_list[models_hists.index(h)], label=f'{h[0]} TVA Dif')
+    colors = trial_colors(len(models_hists), color_list)
+
+    for (name, hist), color in zip(models_hists, colors):
+        axs[0][0].plot(hist['acc'], color=color, label=f'{name} Train', linestyle=':')
+        axs[0][1].plot(hist['loss'], color=color, label=f'{name} Train', linestyle=':')
+        axs[2][0].plot(np.subtract(hist['acc'], hist['val_acc']), color=color, label=f'{name} TVA Dif')
+        axs[2][1].plot(np.subtract(hist['val_loss'], hist['loss']), color=color, label=f'{name} TVA Dif')
 
         if roll:
-            axs[1][0].plot(pd.DataFrame(h[1]['val_acc']).rolling(roll, min_periods=1).mean(),
-                     color=color_list[models_hists.index(h)], label=f'{h[0]} Val')
-            axs[1][1].plot(pd.DataFrame(h[1]['val_loss']).rolling(roll, min_periods=1).mean(),
-                     color=color_list[models_hists.index(h)], label=f'{h[0]} Val')                
+            axs[1][0].plot(rolling_mean_matrix(hist['val_acc'], roll)[0], color=color, label=f'{name} Val')
+            axs[1][1].plot(rolling_mean_matrix(hist['val_loss'], roll)[0], color=color, label=f'{name} Val')
 
         else:
-            axs[1][0].plot(h[1]['val_acc'], color=color_list[models_hists.index(h)], label=f'{h[0]} Val')
-            axs[1][1].plot(h[1]['val_loss'], color=color_list[models_hists.index(h)], label=f'{h[0]} Val')
+            axs[1][0].plot(hist['val_acc'], color=color, label=f'{name} Val')
+            axs[1][1].plot(hist['val_loss'], color=color, label=f'{name} Val')
+
+    if timing:
+        timed = [('Baseline', base_hist, 'gray')] if baseline and has_timing(base_hist) else []
+        if prev_best and has_timing(prev_hist):
+            timed.append((prev_best, prev_hist, 'black'))
+        timed += [(name, hist, color) for (name, hist), color in zip(models_hists, colors) if has_timing(hist)]
+        for name, hist, color in timed:
+            axs[3][0].plot(hist['epoch_time_s'], color=color, label=f'{name} Epoch')
+            axs[3][0].plot(hist['data_wait_s'], color=color, label=f'{name} Data Wait', linestyle=':')
+            axs[3][1].plot(np.cumsum(hist['epoch_time_s']), hist['val_acc'], color=color, label=f'{name} Val')
+
+        axs[3][0].set_title('Epoch Time & Data Wait', fontdict=font_dict)
+        axs[3][0].set_xlabel('Epoch')
+        axs[3][0].set_ylabel('Seconds')
+        axs[3][0].legend(loc='best')
+
+        axs[3][1].set_title('Validation Accuracy vs Training Time', fontdict=font_dict)
+        axs[3][1].set_xlabel('Cumulative Training Time (s)')
+        axs[3][1].legend(loc='best')
+        if val_acc_ylim:
+            axs[3][1].set_ylim(val_acc_ylim)
+        else:
+            pass
 
     axs[0][0].set_title('Training Accuracy', fontdict=font_dict)
     axs[0][0].set_xlabel('Epoch')
@@ -137,5 +167,9 @@ def plot_opt_review(models_hists,
         fig.suptitle('Optimization Trials', fontsize=20)        
     
     plt.tight_layout(rect=[0, 0.03, 1, 0.975])
-    plt.show()
+    if save_path:
+        fig.savefig(save_path)
+        plt.close(fig)
+    else:
+        plt.show()
     
\ No newline at end of file
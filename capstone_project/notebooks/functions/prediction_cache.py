@@ -0,0 +1,229 @@
+import os
+import mmap
+import glob
+import json
+import hashlib
+import numpy as np
+from functions.file_hash import file_hash
+from functions.model_registry import get_registry, model_file
+
+
+CACHE_PATH = '../notebooks/model_construction/prediction_cache/'
+
+_fingerprints = {}
+_model_hashes = {}
+
+
+def _backing_files(X):
+    # files whose stats identify the contents of a memory-mapped array or array store, if any
+    if hasattr(X, 'store_path'):
+        return [os.path.join(X.store_path, 'manifest.json')] + \
+               [os.path.join(X.store_path, s['file']) for s in X.manifest['shards']]
+    if isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap):
+        return [X.filename]
+    return []
+
+
+def _fingerprint_key(X):
+    # session key of a file-backed array: its shape and the paths, modification times and sizes of its files
+    files = _backing_files(X)
+    if not files:
+        return None
+    return (tuple(X.shape),) + tuple((os.path.abspath(f), os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in files)
+
+
+def known_fingerprint(X):
+
+    """
+    Returns the content hash of a file-backed array if array_fingerprint has already computed it for the unchanged
+    files in this session, or None, without reading the array.
+    """
+
+    return _fingerprints.get(_fingerprint_key(X))
+
+
+def model_fingerprint(model_name):
+
+    """
+    Returns the content hash of a saved model's file (the same hash as ModelRegistry.model_hash) without loading the
+    model. The result is remembered for the session, keyed by the file's modification time and size.
+    """
+
+    file_path = os.path.abspath(model_file(model_name))
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size)
+    if key not in _model_hashes:
+        _model_hashes[key] = file_hash(file_path)
+    return _model_hashes[key]
+
+
+def array_fingerprint(X,
+                      chunk_size=256):
+
+    """
+    Computes a content hash of an image array (in-memory, memory-mapped or an ArrayStore), reading it in chunks.
+    For arrays backed by files the result is remembered for the session, keyed by the files' modification times and
+    sizes, so repeated lookups on unchanged data do not re-read it.
+
+    Paramters:
+        X: (array, memory-mapped array or ArrayStore) the image data
+        chunk_size: (int) number of images hashed at a time
+
+    Returns:
+        digest: (string) hexadecimal SHA-256 digest of the array's shape, dtype and contents
+    """
+
+    key = _fingerprint_key(X)
+    if key in _fingerprints:
+        return _fingerprints[key]
+
+    sha = hashlib.sha256()
+    sha.update(json.dumps([list(X.shape), 'uint8' if hasattr(X, 'store_path') else str(X.dtype)]).encode())
+    for i in range(0, len(X), chunk_size):
+        sha.update(np.ascontiguousarray(X[i:i+chunk_size]).tobytes())
+    digest = sha.hexdigest()
+
+    if key:
+        _fingerprints[key] = digest
+
+    return digest
+
+
+class PredictionCache:
+
+    """
+    An on-disk cache of model outputs, keyed by the content hash of the saved model file and of the input array, so
+    that a cached entry is reused exactly as long as neither the model nor the data has changed. Entries are stored as
+    .npy files (float16 by default), and the least recently used entries are removed once the cache grows beyond
+    max_bytes.
+
+    Paramters:
+        cache_path: (string with quotes) directory holding the cached outputs
+        max_bytes: (int) size budget of the cache directory in bytes
+        dtype: (string with quotes) storage precision of the outputs, 'float16' or 'float32'
+    """
+
+    def __init__(self,
+                 cache_path=CACHE_PATH,
+                 max_bytes=2*1024**3,
+                 dtype='float16'):
+
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+
+    def _file(self, model_hash, data_hash):
+        return os.path.join(self.cache_path, f'{model_hash[:20]}_{data_hash[:20]}.npy')
+
+    def get(self,
+            model_hash,
+            data_hash):
+
+        """
+        Returns the cached outputs (float32) for a model/data pair, or None if they are not cached.
+        """
+
+        file_path = self._file(model_hash, data_hash)
+        if not os.path.exists(file_path):
+            return None
+        os.utime(file_path)
+        return np.load(file_path).astype(np.float32)
+
+    def put(self,
+            model_hash,
+            data_hash,
+            preds):
+
+        """
+        Stores the outputs for a model/data pair, then evicts least recently used entries beyond the size budget.
+        """
+
+        os.makedirs(self.cache_path, exist_ok=True)
+        file_path = self._file(model_hash, data_hash)
+        tmp_path = file_path[:-4] + '.tmp.npy'
+        np.save(tmp_path, np.asarray(preds, dtype=self.dtype))
+        os.replace(tmp_path, file_path)
+        self.evict()
+
+    def evict(self):
+
+        """
+        Removes the least recently used entries until the cache fits within max_bytes.
+        """
+
+        entries = [(os.stat(f).st_mtime, os.stat(f).st_size, f)
+                   for f in glob.glob(os.path.join(self.cache_path, '*.npy')) if not f.endswith('.tmp.npy')]
+        total = sum(e[1] for e in entries)
+        for _, size, f in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(f)
+            total -= size
+
+    def lookup(self,
+               model_name,
+               X,
+               hash_data=True):
+
+        """
+        Returns the cached outputs of a saved model for an input array, or None if they are not cached. The model is
+        never loaded; with hash_data=False the array is not read either, and outputs are only found if its hash is
+        already known this session (see known_fingerprint).
+        """
+
+        data_hash = array_fingerprint(X) if hash_data else known_fingerprint(X)
+        if data_hash is None:
+            return None
+        return self.get(model_fingerprint(model_name), data_hash)
+
+    def clear(self):
+        for f in glob.glob(os.path.join(self.cache_path, '*.npy')):
+            os.remove(f)
+
+
+_default_cache = PredictionCache()
+
+
+def get_prediction_cache():
+
+    """
+    Returns the prediction cache shared by the evaluation and plotting helpers.
+    """
+
+    return _default_cache
+
+
+def cached_predict(model_name,
+                   X,
+                   batch_size=256,
+                   cache=None):
+
+    """
+    Returns a saved model's softmax outputs for an image array, computing them (batch by batch, normalizing each
+    batch by 1/255) only when they are not already in the prediction cache for this exact model file and data.
+
+    Paramters:
+        model_name: (string with quotes) model name as saved in the saved_models folder, or path to a .h5 file
+        X: (uint8 array, memory-mapped array or ArrayStore) the images, not normalized
+        batch_size: (int) number of images per prediction batch
+        cache: (PredictionCache) cache to use (defaults to the shared cache)
+
+    Returns:
+        preds: (float32 array) the softmax outputs; shape: (number of images, number of classes)
+    """
+
+    cache = cache or _default_cache
+    # keyed on the model file's hash, so that a cached result never loads the model
+    model_hash = model_fingerprint(model_name)
+    data_hash = array_fingerprint(X)
+
+    preds = cache.get(model_hash, data_hash)
+    if preds is None:
+        predict = get_registry().predictor(model_name, batch_size=batch_size)
+        preds = np.concatenate([predict(np.asarray(X[i:i+batch_size], dtype=np.float32)*(1./255))
+                                for i in range(0, len(X), batch_size)])
+        cache.put(model_hash, data_hash, preds)
+        # returning the stored precision so that a fresh run and a cached run give identical results
+        preds = np.asarray(preds, dtype=cache.dtype).astype(np.float32)
+
+    return preds
@@ -3,47 +3,54 @@ import cv2
 import numpy as np
 from sklearn.preprocessing import LabelEncoder
 from keras.utils import np_utils
+from functions.ingest_imgs import ingest_imgs
 
 def read_process_imgs(image_df,
                       x_size,
-                      y_size):
+                      y_size,
+                      n_jobs=None,
+                      out_path=None,
+                      decode_cache=None):
     
     """
     Takes an x-by-2 dataframe of named and classified images (where the first column is the image name and the second column
     is the image class) and processes it into a set of numpy arrays for use in a neural network. Reading and resizing is
-    performed by the cv2 library, and class values are one-hot encoded using the relevant sklearn.preprocessing and keras.utils 
-    libraries.
+    performed by the cv2 library across a pool of worker processes (see ingest_imgs), and class values are one-hot encoded 
+    using the relevant sklearn.preprocessing and keras.utils libraries. Images that cannot be decoded are left out of the 
+    output and listed, along with the ingestion throughput.
     
     Paramters:
         image_df: (dataframe) the x-by-2 dataframe of named and classified images
         x_size: (integer) the disired horizontal output size of each image in pixels
         y_size: (integer) the disired vertical output size of each image in pixels
+        n_jobs: (int) number of worker processes used for decoding (defaults to the number of cores)
+        out_path: (string with quotes) optional path of a .dat file; if given, X is a np.memmap backed by that file
+        decode_cache: (DecodeCache) optional cache of decoded images; if given, only images not decoded before are
+        read from disk and X is the cache's read-only memory-mapped array at this size (out_path is ignored)
         
     Returns:
-        X: the numpy array form of the image data; shape: (number of images, x_size, y_size, 3)
+        X: the numpy array form of the image data; shape: (number of images, y_size, x_size, 3)
         y: the numpy array form of the class data; shape: (number of images, number of classes)
         y_list: a list of class values in string form for each image in X (used primarily for labeling visualisations)
     """
     
-    X_list = []
-    y_list = []
-    xs = int(x_size)
-    ys = int(y_size)
-    
     shuffle_df = image_df.sample(frac=1).reset_index(drop=True)
     
-    for index, row in shuffle_df.iterrows():
-        raw_img = cv2.imread(row[0],1)
-        try:
-            resized_img = cv2.resize(raw_img, (xs,ys),interpolation=cv2.INTER_CUBIC)
-        except cv2.error as e:
-            pass
-        
-        rgb_img = cv2.cvtColor(resized_img, cv2.COLOR_BGR2RGB)
-        X_list.append(rgb_img)
-        y_list.append(row[1])
-        
-    X = np.array(X_list)
+    if decode_cache is not None:
+        X, failed, stats = decode_cache.resized(shuffle_df.iloc[:,0].tolist(), x_size, y_size, n_jobs=n_jobs)
+        stats['imgs_per_sec'] = stats['n_images'] / stats['seconds'] if stats['seconds'] > 0 else float('inf')
+    else:
+        X, failed, stats = ingest_imgs(shuffle_df.iloc[:,0].tolist(), x_size, y_size, n_jobs=n_jobs,
+                                       out_path=out_path)
+    
+    print(f"Read {stats['n_images']} images in {round(stats['seconds'],2)}s ({round(stats['imgs_per_sec'],1)} images/sec)")
+    if failed:
+        print(f'{len(failed)} images could not be decoded and were skipped:')
+        for f in failed:
+            print(f'    {f}')
+    
+    failed_set = set(failed)
+    y_list = [c for i, c in zip(shuffle_df.iloc[:,0], shuffle_df.iloc[:,1]) if i not in failed_set]
     
     encoder = LabelEncoder()
     encoder.fit(y_list)
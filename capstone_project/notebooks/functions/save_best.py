@@ -1,48 +1,72 @@
-from keras import models
 import pickle
 import os
-from send2trash import send2trash
+from functions.artifact_store import MODEL_PATH, ArtifactStore, remove_checkpoints
 
 def save_best(name_list,
               best_history,
               best_name=None,
-              save_as=None):
-    
+              save_as=None,
+              keep_top=0,
+              model_path=MODEL_PATH):
+
     """
-    Saves the selected model from a list of models, and sends the others to the trash.
-    
+    Saves the selected model from a list of models, and sends the others to the trash. The chosen checkpoint is added
+    to the artifact store and save_as is pointed at it with an atomic hardlink, so the model is never deserialized or
+    copied and a crash cannot leave a half-written file under save_as. The retention policy is applied afterwards, so
+    the model save_as pointed to before is deleted unless it is among the keep_top best unpromoted checkpoints.
+
     Paramters:
         name_list: (list of strings) names of models from the trial
         best_history: (Keras history object) history dictionary for the model chosen to be saved
         best_name: (string with quotes) name of the chosen model from the trial
         save_as: (string with quotes) name under which the chosen model will be saved in the folder
-        
+        keep_top: (int) instead of trashing the other checkpoints, keeps them in the artifact store (with the val_acc
+        of their saved history) and retains only the keep_top best unpromoted checkpoints there (defaults to 0: trash)
+        model_path: (string with quotes) directory the trial models and histories were saved to
+
     Returns:
         Message confirmation of execution
-    """ 
-    
-    if os.path.exists(f'../notebooks/model_construction/saved_models/{best_name}.h5'):
-        
-        best_model = models.load_model(f'../notebooks/model_construction/saved_models/{best_name}.h5')
-        best_model.save(f'../notebooks/model_construction/saved_models/{save_as}.h5')            
-
-        print(f'{best_name} saved as {save_as} in ../notebooks/model_construction/saved_models/!')
+    """
+
+    store = ArtifactStore(model_path=model_path)
+
+    if os.path.exists(f'{model_path}{best_name}.h5'):
+
+        history = getattr(best_history, 'history', best_history)
+        sha256 = store.put(f'{model_path}{best_name}.h5', val_acc=max(history['val_acc']), source=best_name)
+        store.promote(save_as, sha256)
+
+        print(f'{best_name} saved as {save_as} in {model_path}!')
         print('---')
-        with open(f'../notebooks/model_construction/saved_models/{save_as}_history', 'wb') as file_pi:
+        with open(f'{model_path}{save_as}_history.tmp', 'wb') as file_pi:
             pickle.dump(best_history, file_pi)
-        print(f'{best_name}_history saved as {save_as}_history saved in ../notebooks/model_construction/saved_models/!')
+        os.replace(f'{model_path}{save_as}_history.tmp', f'{model_path}{save_as}_history')
+        print(f'{best_name}_history saved as {save_as}_history saved in {model_path}!')
         print('---')
 
     else:
-        print(f'Cannot save {best_name} because the file does not exist - maybe already saved as {save_as}')    
+        print(f'Cannot save {best_name} because the file does not exist - maybe already saved as {save_as}')
 
-    name_list_2 = name_list
+    stored = []
+    if keep_top:
+        for m in name_list:
+            if os.path.exists(f'{model_path}{m}.h5') and os.path.exists(f'{model_path}{m}_history'):
+                with open(f'{model_path}{m}_history', 'rb') as file:
+                    history = pickle.load(file)
+                store.put(f'{model_path}{m}.h5', val_acc=max(getattr(history, 'history', history)['val_acc']),
+                          source=m, remove_source=True)
+                stored.append(m)
+                print(f'{m} moved to the artifact store!')
 
-    for m in name_list_2:
-        if os.path.exists(f'../notebooks/model_construction/saved_models/{m}.h5'):
-            send2trash(f'../notebooks/model_construction/saved_models/{m}.h5')
+    # with keep_top=0 this drops every unreferenced object, eg. the model save_as pointed to before this promotion
+    store.retain(keep_top=keep_top)
+    store.gc()
+
+    removed = remove_checkpoints(name_list, model_path)
+    for m in name_list:
+        if m in removed:
             print(f'{m} moved to trash!')
-        else:
+        elif m not in stored:
             print(f'Cannot remove {m} because the file does not exist - maybe already removed')
-    
-    
\ No newline at end of file
+
+    store.close()
@@ -0,0 +1,42 @@
+import csv
+from functools import lru_cache
+
+
+# display names of the 20 classes, in the order of the model's softmax output (and of species_list_final.csv)
+SPECIES_LIST = ['Amethyst Deceiver',
+                'Bolete',
+                'Chanterelle',
+                'Chicken Of The Woods',
+                'Death Cap',
+                'False Chanterelle',
+                'False Morel',
+                'Fibrecap',
+                'Field Mushroom',
+                'Fly Agaric',
+                'Giant Puffball',
+                'Grey Oyster',
+                'Morel',
+                'Orange Peel',
+                'Roundhead',
+                'Saddle',
+                'Shaggy Inkcap',
+                'Stinkhorn',
+                'Waxcap',
+                'Yellow Stainer']
+
+
+@lru_cache(maxsize=None)
+def load_species_list(species_path='../data/0003_general/species_list_final.csv'):
+
+    """
+    Reads the class names (the common_name column) from the species information file, once per path and session.
+
+    Paramters:
+        species_path: (string with quotes) path to species_list_final.csv
+
+    Returns:
+        species_as_list: (tuple of strings) lower-case common names in class order
+    """
+
+    with open(species_path, newline='', encoding='utf-8-sig') as file:
+        return tuple(row['common_name'] for row in csv.DictReader(file))
@@ -0,0 +1,110 @@
+import os
+import time
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+
+def _one_hot(y):
+    # the notebook stratifies on the one-hot labels; sklearn orders classes differently for one-hot rows than for
+    # integer labels, so integer labels are one-hot encoded first to reproduce exactly the same split
+    y = np.asarray(y)
+    if y.ndim == 2:
+        return y
+    return np.eye(int(y.max()) + 1, dtype=np.float32)[y]
+
+
+def split_indices(y,
+                  test_size=0.2,
+                  val_test_size=0.6,
+                  random_states=(16, 17)):
+
+    """
+    Computes the train/validation/test split of data_processing.ipynb on row indices only: the same two stratified
+    train_test_split calls with the same seeds, applied to np.arange(n) instead of to X, so no pixel data is touched
+    or copied. Indexing X with the returned indices gives exactly the subsets the notebook produces.
+
+    Paramters:
+        y: (array) one-hot encoded class data, or integer labels (one-hot encoded before stratifying)
+        test_size: (float) share of the data held out of training by the first split
+        val_test_size: (float) share of the held-out data that goes to the test set in the second split
+        random_states: (tuple of ints) seeds of the two splits
+
+    Returns:
+        indices: (dict) 'train', 'val' and 'test' -> integer row indices, in subset order
+    """
+
+    y = _one_hot(y)
+    idx = np.arange(len(y))
+    idx_train, idx_tv, _, y_tv = train_test_split(idx, y, test_size=test_size, stratify=y,
+                                                  random_state=random_states[0])
+    idx_val, idx_test = train_test_split(idx_tv, test_size=val_test_size, stratify=y_tv,
+                                         random_state=random_states[1])
+
+    return {'train': idx_train, 'val': idx_val, 'test': idx_test}
+
+
+def _copy_rows(X,
+               indices,
+               out,
+               chunk_size):
+
+    # copies X[indices] into out chunk by chunk, reading each chunk's rows in ascending order for sequential disk access
+    for start in range(0, len(indices), chunk_size):
+        chunk = indices[start:start+chunk_size]
+        order = np.argsort(chunk, kind='stable')
+        rows = np.asarray(X[chunk[order]])
+        out[start + order] = rows
+    out.flush()
+
+
+def split_to_disk(X,
+                  y,
+                  data_path='../data/0002_array_data/',
+                  chunk_size=256,
+                  test_size=0.2,
+                  val_test_size=0.6,
+                  random_states=(16, 17)):
+
+    """
+    Splits an image dataset into train/validation/test subsets (see split_indices) and streams each subset straight
+    into its .npy files (X_train_data.npy, y_train_data.npy, ... in train_data/ and test_data/, as saved by
+    data_processing.ipynb), chunk_size images at a time. X is never loaded or copied as a whole, so peak memory is one
+    chunk of images plus the labels.
+
+    Paramters:
+        X: (memory-mapped array or ArrayStore) the image data, eg. from read_process_imgs with out_path, or the array
+        store of update_ingestion
+        y: (array) one-hot encoded class data, or integer labels (saved one-hot encoded)
+        data_path: (string with quotes) base path of the array data directory
+        chunk_size: (int) number of images copied at a time
+        test_size, val_test_size, random_states: as for split_indices
+
+    Returns:
+        subsets: (dict) 'train', 'val' and 'test' -> (memory-mapped X subset, y subset)
+    """
+
+    start_time = time.perf_counter()
+    y = _one_hot(y)
+    indices = split_indices(y, test_size=test_size, val_test_size=val_test_size, random_states=random_states)
+    item_shape = tuple(X.shape[1:])
+    dtype = getattr(X, 'dtype', np.uint8)
+
+    subsets = {}
+    for subset, idx in indices.items():
+        folder = 'test_data' if subset == 'test' else 'train_data'
+        os.makedirs(f'{data_path}{folder}', exist_ok=True)
+        X_file = f'{data_path}{folder}/X_{subset}_data.npy'
+        y_file = f'{data_path}{folder}/y_{subset}_data.npy'
+
+        X_out = np.lib.format.open_memmap(X_file + '.tmp', mode='w+', dtype=dtype, shape=(len(idx),) + item_shape)
+        _copy_rows(X, idx, X_out, chunk_size)
+        del X_out
+        os.replace(X_file + '.tmp', X_file)
+        np.save(y_file, y[idx])
+        print(f'X_{subset} ({len(idx)} images) saved under {X_file}!')
+
+        subsets[subset] = (np.load(X_file, mmap_mode='r'), y[idx])
+
+    print(f'Split written in {round(time.perf_counter() - start_time,2)}s')
+
+    return subsets
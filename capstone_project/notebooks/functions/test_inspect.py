@@ -2,7 +2,10 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-from collections import Counter
+from functions.species import load_species_list
+from functions.array_store import open_array_data
+from functions.prediction_cache import cached_predict
+from functions.evaluate_models import to_labels
 
 def test_inspect(y_pred,
                  y_test,
@@ -13,7 +16,8 @@ def test_inspect(y_pred,
     of each class.
     
     Paramters:
-        y_pred: (array) the predicted labels for the test set
+        y_pred: (array) the predicted labels for the test set (or the model's softmax outputs); if None, the outputs of
+        the saved model named model_name on the test set are taken from the prediction cache (computed once if needed)
         y_test: (array) the actual labels for the test set (one-hot encoded)
         model_name: (string with quotes) model name for labelling purposes
         
@@ -23,28 +27,18 @@ def test_inspect(y_pred,
     
     if model_name:
         
-        species_df = pd.read_csv('../data/0003_general/species_list_final.csv')
-        species_as_list = species_df['common_name'].tolist()
+        species_as_list = list(load_species_list())
         
-        y_actual = pd.DataFrame(y_test).idxmax(axis=1).to_list()
-        test_preds = y_pred
+        if y_pred is None:
+            X_test, _ = open_array_data('test', data_path='../data/0002_array_data/')
+            y_pred = cached_predict(model_name, X_test)
+        n_classes = len(species_as_list)
         
-        named_test_actuals = []
-        named_test_preds = []
+        actual_counts = np.bincount(to_labels(y_test), minlength=n_classes)
+        pred_counts = np.bincount(to_labels(y_pred), minlength=n_classes)
         
-        for i in y_actual:
-            named_test_actuals.append(species_as_list[i])
-        
-        for i in test_preds:
-            named_test_preds.append(species_as_list[i])
-
-        df_pred_count = pd.DataFrame.from_dict(
-            Counter(named_test_preds), orient='index').reset_index().rename(columns={'index':'species', 0:'predicted'})
-        
-        df_act_count = pd.DataFrame.from_dict(
-            Counter(named_test_actuals), orient='index').reset_index().rename(columns={'index':'species', 0:'actual'})
-        
-        big_df = df_act_count.merge(df_pred_count, how='left')
+        big_df = pd.DataFrame({'species': species_as_list, 'actual': actual_counts, 'predicted': pred_counts})
+        big_df = big_df[big_df['actual'] > 0]
         
         melt_df = pd.melt(big_df, id_vars=['species'], value_vars=['predicted', 'actual']).sort_values('species')
         
@@ -0,0 +1,135 @@
+import time
+import resource
+from keras.callbacks import Callback
+from functions.history_store import TIMING_KEYS, has_timing
+
+
+def _reset_peak_rss():
+    # resets the kernel's high-water mark of this process (Linux only) so the peak can be measured per epoch
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    # falling back to the peak over the whole process lifetime (kilobytes on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class TrainingProfiler(Callback):
+
+    """
+    Keras callback recording where the time goes in each epoch: total wall time, time waiting for input data, time in
+    train steps, validation time, checkpoint saving time (of the ModelCheckpoint callbacks passed in) and peak resident
+    memory. The values are added to the epoch logs, so they end up in history.history next to acc/loss/val_acc/
+    val_loss and are saved with the *_history pickles; plot_evaluation and plot_opt_review can then show them with
+    timing=True.
+
+    Data wait is taken from the input pipeline's own stall counter when an AugmentedFlow is given; otherwise it is the
+    time between the end of one train step and the start of the next, which includes the data fetch for generators
+    that are not prefetched.
+
+    Passing the profiler after the checkpoints in the callbacks list makes the epoch wall time include checkpointing.
+
+    Paramters:
+        checkpoints: (list) ModelCheckpoint callbacks whose saving time is measured (they must also be passed to fit)
+        flow: (AugmentedFlow) the training input pipeline, if one is used
+        verbose: (bool) prints the timing breakdown at the end of each epoch
+    """
+
+    def __init__(self,
+                 checkpoints=(),
+                 flow=None,
+                 verbose=False):
+
+        super().__init__()
+        self.flow = flow
+        self.verbose = verbose
+        self.timing = {k: [] for k in TIMING_KEYS}
+        self._pending_checkpoint = 0.
+        self._first_epoch = None
+        for cp in checkpoints:
+            self._wrap_checkpoint(cp)
+
+    def _wrap_checkpoint(self, checkpoint):
+        on_epoch_end = checkpoint.on_epoch_end
+
+        def timed_on_epoch_end(epoch, logs=None):
+            start = time.perf_counter()
+            result = on_epoch_end(epoch, logs)
+            elapsed = time.perf_counter() - start
+            if logs is not None:
+                logs['checkpoint_s'] = logs.get('checkpoint_s', 0.) + elapsed
+            if len(self.timing['checkpoint_s']) > epoch - self._first_epoch:
+                # the profiler has already recorded this epoch (it ran before the checkpoint)
+                self.timing['checkpoint_s'][-1] += elapsed
+            else:
+                self._pending_checkpoint += elapsed
+            return result
+
+        checkpoint.on_epoch_end = timed_on_epoch_end
+
+    def on_train_begin(self, logs=None):
+        self._first_epoch = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if self._first_epoch is None:
+            self._first_epoch = epoch - len(self.timing['epoch_time_s'])
+        _reset_peak_rss()
+        if self.flow is not None:
+            self.flow.reset_stats()
+        self._pending_checkpoint = 0.
+        self._epoch_start = time.perf_counter()
+        self._last_batch_end = self._epoch_start
+        self._data_wait = 0.
+        self._train_step = 0.
+        self._val_time = 0.
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._batch_start = time.perf_counter()
+        self._data_wait += self._batch_start - self._last_batch_end
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._last_batch_end = time.perf_counter()
+        self._train_step += self._last_batch_end - self._batch_start
+
+    def on_test_begin(self, logs=None):
+        self._val_start = time.perf_counter()
+
+    def on_test_end(self, logs=None):
+        self._val_time += time.perf_counter() - self._val_start
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_time = time.perf_counter() - self._epoch_start
+        data_wait = self._data_wait
+        train_step = self._train_step
+        if self.flow is not None:
+            stall, _ = self.flow.reset_stats()
+            # with a prefetching pipeline the stall happens inside the step, so it is moved from step to wait time
+            data_wait, train_step = stall, max(train_step + self._data_wait - stall, 0.)
+
+        values = {'epoch_time_s': epoch_time,
+                  'data_wait_s': data_wait,
+                  'train_step_s': train_step,
+                  'val_time_s': self._val_time,
+                  'checkpoint_s': logs.get('checkpoint_s', self._pending_checkpoint) if logs else self._pending_checkpoint,
+                  'peak_rss_mb': _peak_rss_mb()}
+        for k, v in values.items():
+            self.timing[k].append(v)
+        if logs is not None:
+            logs.update(values)
+
+        if self.verbose:
+            print(f" - epoch {round(epoch_time,1)}s: data {round(data_wait,1)}s, train {round(train_step,1)}s, "
+                  f"val {round(self._val_time,1)}s, peak RSS {round(values['peak_rss_mb'])}MB")
+
@@ -0,0 +1,188 @@
+import os
+import time
+import types
+from keras.callbacks import Callback
+
+
+# settings of each runtime profile; None leaves the tensorflow default
+RUNTIME_PROFILES = {'default': {'intra_op_threads': None,
+                                'inter_op_threads': None,
+                                'jit_compile': False,
+                                'accum_steps': 1,
+                                'mixed_precision': False},
+                    'cpu': {'intra_op_threads': os.cpu_count() or 1,
+                            'inter_op_threads': 2,
+                            'jit_compile': True,
+                            'accum_steps': 1,
+                            'mixed_precision': 'auto'}}
+
+
+def cpu_supports_bfloat16():
+
+    """
+    Returns True if the CPU has native bfloat16 instructions (AVX512-BF16 or AMX-BF16, Linux only). On other CPUs
+    bfloat16 is emulated and mixed precision makes training slower, not faster.
+    """
+
+    try:
+        with open('/proc/cpuinfo') as file:
+            for line in file:
+                if line.startswith('flags'):
+                    flags = line.split()
+                    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+    except OSError:
+        pass
+    return False
+
+
+def configure_runtime(profile='cpu',
+                      **overrides):
+
+    """
+    Configures tensorflow for training on CPU: sizes of the intra-op (threads per operation) and inter-op (operations
+    run at the same time) thread pools, and bfloat16 mixed precision. Must be called before tensorflow runs anything
+    (ie. at the top of a notebook or worker process, importing is fine) and before the model is built, as the thread
+    pools are fixed once created and layers take the precision policy in force when they are built. XLA compilation
+    and gradient accumulation are applied per model by compile_for_runtime.
+
+    Paramters:
+        profile: (string with quotes or dict) name of a profile in RUNTIME_PROFILES, or a dict of settings
+        overrides: settings replacing those of the profile: intra_op_threads (int), inter_op_threads (int),
+        jit_compile (bool), accum_steps (int, number of micro-batches per optimizer update) and mixed_precision
+        (True, False or 'auto' to use bfloat16 only on CPUs with native support)
+
+    Returns:
+        runtime: (dict) the settings in force, with mixed_precision resolved to True or False
+    """
+
+    runtime = dict(RUNTIME_PROFILES['default'])
+    runtime.update(RUNTIME_PROFILES[profile] if isinstance(profile, str) else profile)
+    runtime.update(overrides)
+    if runtime['mixed_precision'] == 'auto':
+        runtime['mixed_precision'] = cpu_supports_bfloat16()
+
+    if runtime['intra_op_threads']:
+        for var in ('OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS'):
+            os.environ[var] = str(runtime['intra_op_threads'])
+    if runtime['inter_op_threads']:
+        os.environ['TF_NUM_INTEROP_THREADS'] = str(runtime['inter_op_threads'])
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+    import tensorflow as tf
+    from keras import mixed_precision
+
+    try:
+        if runtime['intra_op_threads']:
+            tf.config.threading.set_intra_op_parallelism_threads(runtime['intra_op_threads'])
+        if runtime['inter_op_threads']:
+            tf.config.threading.set_inter_op_parallelism_threads(runtime['inter_op_threads'])
+    except RuntimeError:
+        print('Thread pools already initialized - restart the kernel and configure the runtime first')
+
+    mixed_precision.set_global_policy('mixed_bfloat16' if runtime['mixed_precision'] else 'float32')
+
+    return runtime
+
+
+def _accumulating_train_step(model,
+                             accum_steps):
+
+    # train step applying the mean gradient of accum_steps consecutive micro-batches in one optimizer update; it
+    # replaces the train_step of this model instance only, so the model is saved and loaded as a plain keras model
+    import tensorflow as tf
+
+    variables = model.trainable_variables
+    accum = [tf.Variable(tf.zeros_like(v), trainable=False) for v in variables]
+    counter = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+    # optimizer slots are created here, as variables cannot be created inside the conditional update below
+    if hasattr(model.optimizer, 'build'):
+        model.optimizer.build(variables)
+    else:
+        model.optimizer._create_all_weights(variables)
+
+    def apply_update():
+        model.optimizer.apply_gradients(zip([a.read_value() for a in accum], variables))
+        for a in accum:
+            a.assign(tf.zeros_like(a))
+        return tf.constant(True)
+
+    def train_step(self, data):
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
+        grads = tape.gradient(loss, variables)
+        for a, g in zip(accum, grads):
+            a.assign_add(tf.cast(g, a.dtype) / accum_steps)
+        counter.assign_add(1)
+        tf.cond(counter % accum_steps == 0, apply_update, lambda: tf.constant(False))
+        self.compiled_metrics.update_state(y, y_pred, sample_weight)
+        return {m.name: m.result() for m in self.metrics}
+
+    return types.MethodType(train_step, model)
+
+
+def compile_for_runtime(model,
+                        runtime,
+                        **compile_kwargs):
+
+    """
+    Compiles a model with the XLA and gradient accumulation settings of a runtime (see configure_runtime). With
+    accum_steps > 1 the model is fitted on micro-batches as usual (eg. batch size 8, which keeps memory low), but the
+    weights are only updated with the mean gradient of every accum_steps micro-batches, ie. with an effective batch
+    size of accum_steps times the micro-batch size.
+
+    Paramters:
+        model: (keras model) the model, built after configure_runtime
+        runtime: (dict) runtime settings, as returned by configure_runtime
+        compile_kwargs: arguments of model.compile (loss, optimizer, metrics)
+
+    Returns:
+        model: the compiled model
+    """
+
+    model.compile(jit_compile=runtime['jit_compile'], **compile_kwargs)
+    if runtime['accum_steps'] > 1:
+        model.train_step = _accumulating_train_step(model, runtime['accum_steps'])
+        model.train_function = None
+    return model
+
+
+class StepRateLogger(Callback):
+
+    """
+    Keras callback adding the training throughput of each epoch to the logs (and so to history.history and the history
+    store): steps_per_s (train batches per second) and samples_per_s, over the training phase of the epoch (validation
+    excluded), so that runs with different runtime settings can be compared directly.
+
+    Paramters:
+        batch_size: (int) micro-batch size, for samples_per_s
+        verbose: (bool) prints the rates at the end of each epoch
+    """
+
+    def __init__(self,
+                 batch_size,
+                 verbose=False):
+
+        super().__init__()
+        self.batch_size = batch_size
+        self.verbose = verbose
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = time.perf_counter()
+        self._train_end = None
+        self._n_steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._n_steps += 1
+        self._train_end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = (self._train_end or time.perf_counter()) - self._start
+        steps_per_s = self._n_steps / seconds if seconds > 0 else 0.
+        if logs is not None:
+            logs['steps_per_s'] = steps_per_s
+            logs['samples_per_s'] = steps_per_s * self.batch_size
+        if self.verbose:
+            print(f' - {round(steps_per_s,2)} steps/s ({round(steps_per_s*self.batch_size,1)} samples/s)')
@@ -0,0 +1,265 @@
+import os
+import math
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from functions.history_store import HISTORY_DB, HistoryStore, load_history
+
+
+COLOR_LIST = ['deepskyblue', 'salmon', 'gold', 'forestgreen', 'mediumorchid', 'darkmagenta', 'turquoise']
+
+METRICS = ['acc', 'val_acc', 'loss', 'val_loss']
+
+
+def trial_colors(n,
+                 color_list=COLOR_LIST):
+
+    """
+    Returns n plot colors: the colors of color_list first, then as many further colors as needed from the tab20
+    colormap, so that any number of trials can be drawn.
+    """
+
+    import matplotlib.pyplot as plt
+
+    extra = [plt.cm.tab20(i % 20) for i in range(max(0, n - len(color_list)))]
+    return (list(color_list) + extra)[:n]
+
+
+def history_matrix(histories,
+                   metric):
+
+    """
+    Stacks one metric of several histories into a trials-by-epochs float array, padding shorter histories (eg. early
+    stopped trials) with NaN.
+    """
+
+    curves = [np.asarray(h.get(metric, []), dtype=np.float64) for h in histories]
+    M = np.full((len(curves), max((len(c) for c in curves), default=0)), np.nan)
+    for i, c in enumerate(curves):
+        M[i, :len(c)] = c
+    return M
+
+
+def rolling_mean_matrix(M,
+                        window):
+
+    """
+    Rolling mean over the last window epochs of every row of a trials-by-epochs matrix (or of a single curve), with
+    the same result as pandas' rolling(window, min_periods=1).mean() on each row: two cumulative sums, no loop over
+    trials. NaN (padding) values are ignored in the windows and kept as NaN in the output.
+    """
+
+    M = np.atleast_2d(np.asarray(M, dtype=np.float64))
+    valid = ~np.isnan(M)
+    pad = np.zeros((len(M), 1))
+    sums = np.concatenate([pad, np.cumsum(np.where(valid, M, 0.), axis=1)], axis=1)
+    counts = np.concatenate([pad, np.cumsum(valid, axis=1)], axis=1)
+    lag = np.maximum(np.arange(1, M.shape[1] + 1) - window, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = (sums[:, 1:] - sums[:, lag]) / (counts[:, 1:] - counts[:, lag])
+    out[~valid] = np.nan
+    return out
+
+
+def trial_matrices(histories,
+                   roll=None):
+
+    """
+    Precomputes everything the comparison plots draw as trials-by-epochs matrices: training and validation accuracy
+    and loss (validation metrics as rolling means if roll is given) and the train/validation differences.
+
+    Paramters:
+        histories: (list of dicts) training histories
+        roll: (int) window size of the rolling mean of the validation metrics (defaults to None)
+
+    Returns:
+        matrices: (dict) name -> (number of trials, number of epochs) array, NaN-padded
+    """
+
+    m = {metric: history_matrix(histories, metric) for metric in METRICS}
+    m['acc_dif'] = m['acc'] - m['val_acc']
+    m['loss_dif'] = m['val_loss'] - m['loss']
+    if roll:
+        m['val_acc'] = rolling_mean_matrix(m['val_acc'], roll)
+        m['val_loss'] = rolling_mean_matrix(m['val_loss'], roll)
+    return m
+
+
+def _load_histories(runs,
+                    db_path):
+
+    # reads the curves of many runs with one query per metric when they are all in the history store
+    if os.path.exists(db_path):
+        store = HistoryStore(db_path)
+        try:
+            if all(r in store for r in runs):
+                curves = {metric: store.metric_curves(metric, runs) for metric in METRICS}
+                return [{metric: curves[metric][r] for metric in METRICS} for r in runs]
+        finally:
+            store.close()
+    return [load_history(r, METRICS, db_path=db_path) for r in runs]
+
+
+def _render_page(page_no,
+                 n_pages,
+                 names,
+                 matrices,
+                 references,
+                 out_file,
+                 title,
+                 val_acc_ylim,
+                 val_loss_ylim):
+
+    # draws one page of the comparison (the plot_opt_review layout) without a display
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    font_dict = {'fontsize': 15}
+    panels = [(0, 0, 'acc', 'Training Accuracy', ':'),
+              (0, 1, 'loss', 'Training Loss', ':'),
+              (1, 0, 'val_acc', 'Validation Accuracy', '-'),
+              (1, 1, 'val_loss', 'Validation Loss', '-'),
+              (2, 0, 'acc_dif', 'Training & Validation Accuracy Difference', '-'),
+              (2, 1, 'loss_dif', 'Training & Validation Loss Difference', '-')]
+
+    fig, axs = plt.subplots(3, 2, figsize=(22,15))
+    colors = trial_colors(len(names))
+    for r, c, key, panel_title, style in panels:
+        ax = axs[r][c]
+        for ref_name, ref, ref_color in references:
+            ax.plot(ref[key], color=ref_color, label=ref_name, linestyle=style)
+        # one call per panel: matplotlib draws each column of the transposed matrix as a line
+        lines = ax.plot(matrices[key].T, linestyle=style)
+        for line, color, name in zip(lines, colors, names):
+            line.set_color(color)
+            line.set_label(name)
+        ax.set_title(panel_title, fontdict=font_dict)
+        ax.set_xlabel('Epoch')
+        ax.legend(loc='best', fontsize='small', ncol=1 + len(names) // 12)
+
+    axs[2][0].axhspan(0, 0.2, color='deepskyblue', alpha=0.2)
+    if val_acc_ylim:
+        axs[1][0].set_ylim(val_acc_ylim)
+    if val_loss_ylim:
+        axs[1][1].set_ylim(val_loss_ylim)
+
+    fig.suptitle(f'{title} ({page_no} of {n_pages})', fontsize=20)
+    plt.tight_layout(rect=[0, 0.03, 1, 0.975])
+    fig.savefig(out_file)
+    plt.close(fig)
+    return out_file
+
+
+def _render_overview(names,
+                     val_acc,
+                     out_file,
+                     title):
+
+    # draws the ranking of all trials by best validation accuracy and their validation accuracy heatmap
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    best = np.nanmax(val_acc, axis=1)
+    order = np.argsort(-best)
+    height = max(6, 0.18*len(names))
+    fig, axs = plt.subplots(1, 2, figsize=(22, height), gridspec_kw={'width_ratios': [1, 2]})
+
+    axs[0].barh(np.arange(len(names)), best[order], color='deepskyblue')
+    axs[0].set_yticks(np.arange(len(names)))
+    axs[0].set_yticklabels([names[i] for i in order], fontsize='small')
+    axs[0].invert_yaxis()
+    axs[0].set_title('Best Validation Accuracy', fontsize=15)
+
+    im = axs[1].imshow(np.ma.masked_invalid(val_acc[order]), aspect='auto', interpolation='nearest', cmap='viridis')
+    axs[1].set_yticks([])
+    axs[1].set_xlabel('Epoch')
+    axs[1].set_title('Validation Accuracy by Epoch', fontsize=15)
+    fig.colorbar(im, ax=axs[1])
+
+    fig.suptitle(f'{title} - Overview', fontsize=20)
+    plt.tight_layout(rect=[0, 0.03, 1, 0.975])
+    fig.savefig(out_file)
+    plt.close(fig)
+    return out_file
+
+
+def render_trial_report(runs,
+                        out_dir,
+                        baseline=None,
+                        prev_best=None,
+                        roll=None,
+                        per_page=10,
+                        sort=True,
+                        fmt='png',
+                        title='Optimization Trials',
+                        val_acc_ylim=None,
+                        val_loss_ylim=None,
+                        n_jobs=None,
+                        db_path=HISTORY_DB):
+
+    """
+    Headless version of plot_opt_review for comparing any number of trials, eg. in a nightly job. All histories are
+    stacked into trials-by-epochs matrices once (differences and rolling means included), then split into pages of
+    per_page trials drawn in the plot_opt_review layout, each with the baseline and previous best for reference.
+    Pages are rendered in parallel worker processes and written as image files, together with an overview page
+    ranking every trial by best validation accuracy.
+
+    Paramters:
+        runs: (list) run names (read from the history store or the saved pickles), or pairs of name and history
+        out_dir: (string with quotes) directory the report files are written to
+        baseline: (string with quotes) name of the baseline model drawn on every page (optional)
+        prev_best: (string with quotes) name of any other model drawn on every page (optional)
+        roll: (int) window size of the rolling mean of the validation metrics (defaults to None)
+        per_page: (int) number of trials per page
+        sort: (bool) orders the trials by best validation accuracy, so the first page holds the leaders
+        fmt: (string with quotes) file format, 'png' or 'svg'
+        title: (string with quotes) title of the report pages
+        val_acc_ylim: (tuple) sets y-axis range to tuple specified (min, max) on the accuracy graph
+        val_loss_ylim: (tuple) sets y-axis range to tuple specified (min, max) on the loss graph
+        n_jobs: (int) number of rendering processes (defaults to the number of cores)
+        db_path: (string with quotes) path of the history store
+
+    Returns:
+        files: (list of strings) paths of the overview and page files
+    """
+
+    names = [r if isinstance(r, str) else r[0] for r in runs]
+    if all(isinstance(r, str) for r in runs):
+        histories = _load_histories(names, db_path)
+    else:
+        histories = [load_history(r, METRICS, db_path=db_path) if isinstance(r, str) else r[1] for r in runs]
+
+    val_acc = history_matrix(histories, 'val_acc')
+    matrices = trial_matrices(histories, roll=roll)
+    if sort:
+        order = np.argsort(-np.nanmax(val_acc, axis=1), kind='stable')
+        names = [names[i] for i in order]
+        val_acc = val_acc[order]
+        matrices = {k: v[order] for k, v in matrices.items()}
+
+    references = []
+    for ref_name, color in [(baseline, 'gray'), (prev_best, 'black')]:
+        if ref_name:
+            ref = trial_matrices([load_history(ref_name, METRICS, db_path=db_path)], roll=roll)
+            references.append((ref_name, {k: v[0] for k, v in ref.items()}, color))
+
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = title.lower().replace(' ', '_')
+    n_pages = math.ceil(len(names) / per_page)
+    n_jobs = max(1, min(n_jobs or os.cpu_count() or 1, n_pages + 1))
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(_render_overview, names, val_acc,
+                                   os.path.join(out_dir, f'{prefix}_overview.{fmt}'), title)]
+        for p in range(n_pages):
+            page = slice(p*per_page, (p+1)*per_page)
+            futures.append(executor.submit(_render_page, p+1, n_pages, names[page],
+                                           {k: v[page] for k, v in matrices.items()}, references,
+                                           os.path.join(out_dir, f'{prefix}_page_{p+1:03d}.{fmt}'), title,
+                                           val_acc_ylim, val_loss_ylim))
+        files = [f.result() for f in futures]
+
+    print(f'{len(files)} report pages saved under {out_dir}!')
+
+    return files
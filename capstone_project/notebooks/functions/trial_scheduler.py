@@ -0,0 +1,299 @@
+import os
+import time
+import pickle
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from functions.history_store import HISTORY_DB, HistoryStore
+from functions.model_registry import MODEL_PATH
+
+
+DEFAULT_AUGMENTATION = {'rotation_range': 40,
+                        'width_shift_range': 0.3,
+                        'height_shift_range': 0.3,
+                        'shear_range': 0.3,
+                        'zoom_range': 0.3,
+                        'fill_mode': 'nearest',
+                        'horizontal_flip': True,
+                        'vertical_flip': True}
+
+DEFAULT_TRIAL = {'architecture': 'model_13',
+                 'arch_params': {},
+                 'optimizer': 'Adamax',
+                 'learning_rate': 9e-4,
+                 'batch_size': 8,
+                 'augmentation': DEFAULT_AUGMENTATION,
+                 'runtime': 'default'}
+
+
+def expand_search_space(space,
+                        prefix='m14'):
+
+    """
+    Expands a search space into the list of trials to run, one per combination of the listed values (grid search).
+    Keys that are left out take the values of the m13_t1 trial (see DEFAULT_TRIAL).
+
+    Paramters:
+        space: (dict) trial setting -> list of values to try; settings are architecture (name in ARCHITECTURES),
+        arch_params (dict of keyword arguments for the architecture builder), optimizer (name of a keras optimizer),
+        learning_rate, batch_size, augmentation (dict of AugmentedFlow augmentation options) and runtime (name of a
+        profile in RUNTIME_PROFILES or dict of runtime settings, see configure_runtime; thread counts are set by
+        run_trials)
+        prefix: (string with quotes) model number used in the trial names, eg. 'm14' gives m14_t1, m14_t2, ...
+
+    Returns:
+        trials: (list) pairs of trial name and trial settings (dict)
+    """
+
+    keys = list(space)
+    trials = []
+    for i, values in enumerate(itertools.product(*(space[k] for k in keys))):
+        trials.append((f'{prefix}_t{i+1}', {**DEFAULT_TRIAL, **dict(zip(keys, values))}))
+    return trials
+
+
+def _init_worker(n_threads):
+    # caps the threads of every native thread pool before tensorflow is imported in the worker process
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS'):
+        os.environ[var] = str(n_threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+    import tensorflow as tf
+    import cv2
+
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    cv2.setNumThreads(1)
+
+
+def should_prune(own,
+                 others,
+                 n_epochs,
+                 min_epochs=10,
+                 window=5,
+                 margin=0.05):
+
+    """
+    Decides whether a trial is clearly losing. The trial's val_acc trend (rolling mean over the last window epochs and
+    the slope of that rolling mean) is extrapolated linearly to the final epoch, which is optimistic for learning
+    curves that flatten out; the trial is pruned when even that projection falls short, by more than margin, of the
+    rolling mean the best other trial had already reached at the same epoch.
+
+    Paramters:
+        own: (list) val_acc per epoch of the trial so far
+        others: (list of lists) val_acc per epoch of the other trials of the study
+        n_epochs: (int) number of epochs the trial would run in full
+        min_epochs: (int) number of epochs a trial always runs before it can be pruned
+        window: (int) window size of the rolling mean
+        margin: (float) accuracy gap tolerated below the leader
+
+    Returns:
+        (bool) True if the trial should be stopped
+    """
+
+    epoch = len(own)
+    if epoch < max(min_epochs, 2*window):
+        return False
+
+    leaders = [np.mean(o[epoch-window:epoch]) for o in others if len(o) >= epoch]
+    if not leaders:
+        return False
+
+    own_rm = np.mean(own[-window:])
+    slope = (own_rm - np.mean(own[-2*window:-window])) / window
+    projected = own_rm + max(slope, 0.)*(n_epochs - epoch)
+
+    return projected < max(leaders) - margin
+
+
+def _pruner(store, run, runs, n_epochs, prune_params):
+
+    # keras callback recording each epoch in the shared history store and stopping the trial when should_prune says so
+    from keras.callbacks import Callback
+
+    class TrialPruner(Callback):
+
+        pruned = False
+
+        def on_epoch_end(self, epoch, logs=None):
+            store.append(run, epoch, logs or {})
+            curves = store.metric_curves('val_acc', runs)
+            own = curves.pop(run)
+            if should_prune(own, list(curves.values()), n_epochs, **prune_params):
+                print(f'{run} pruned after {epoch+1} epochs (val_acc {round(own[-1],4)})')
+                self.pruned = True
+                self.model.stop_training = True
+
+    return TrialPruner()
+
+
+def run_trial(name,
+              settings,
+              runs,
+              n_epochs=100,
+              n_threads=1,
+              data_path='../data/0002_array_data/',
+              model_path=MODEL_PATH,
+              db_path=HISTORY_DB,
+              prune_params=None):
+
+    """
+    Builds, compiles and fits one trial as the model_XX notebooks do (augmented training batches, validation after
+    every epoch, best-val_acc checkpoint saved as {name}.h5, history pickled as {name}_history), recording every epoch
+    in the shared history store and stopping early if the trial is clearly losing (see should_prune).
+
+    Returns:
+        result: (dict) trial name, status ('completed' or 'pruned'), epochs run, best val_acc and its epoch, seconds
+    """
+
+    from keras import optimizers
+    from keras.callbacks import ModelCheckpoint
+    from functions.array_store import open_array_data
+    from functions.augment_flow import AugmentedFlow
+    from functions.model_architectures import ARCHITECTURES
+    from functions.training_profiler import TrainingProfiler
+    from functions.training_runtime import configure_runtime, compile_for_runtime, StepRateLogger
+
+    start_time = time.perf_counter()
+    X_train, y_train = open_array_data('train', data_path)
+    X_val, y_val = open_array_data('val', data_path)
+    batch_size = settings['batch_size']
+    runtime = configure_runtime(settings.get('runtime', 'default'), intra_op_threads=n_threads, inter_op_threads=1)
+
+    model = ARCHITECTURES[settings['architecture']](img_shape=X_train.shape[1:], n_classes=y_train.shape[1],
+                                                   **settings['arch_params'])
+    opt = optimizers.get({'class_name': settings['optimizer'],
+                          'config': {'learning_rate': settings['learning_rate']}})
+    compile_for_runtime(model, runtime, loss='categorical_crossentropy', optimizer=opt, metrics=['acc'])
+
+    train_generator = AugmentedFlow(X_train, y_train, batch_size=batch_size, rescale=1./255, n_workers=n_threads,
+                                    **settings['augmentation'])
+    val_generator = AugmentedFlow(X_val, y_val, batch_size=batch_size, rescale=1./255, shuffle=False,
+                                  n_workers=n_threads)
+
+    checkpoint = ModelCheckpoint(filepath=f'{model_path}{name}.h5', monitor='val_acc', save_best_only=True)
+    store = HistoryStore(db_path)
+    pruner = _pruner(store, name, runs, n_epochs, prune_params or {})
+
+    try:
+        history = model.fit(train_generator,
+                            steps_per_epoch=len(X_train)//batch_size,
+                            epochs=n_epochs,
+                            callbacks=[checkpoint, TrainingProfiler(checkpoints=[checkpoint], flow=train_generator),
+                                       StepRateLogger(batch_size), pruner],
+                            validation_data=val_generator,
+                            validation_steps=len(X_val)//batch_size,
+                            verbose=0)
+    finally:
+        train_generator.close()
+        val_generator.close()
+
+    with open(f'{model_path}{name}_history', 'wb') as file_pi:
+        pickle.dump(history.history, file_pi)
+
+    status = 'pruned' if pruner.pruned else 'completed'
+    store.finish_run(name, status)
+    store.close()
+
+    val_acc = history.history['val_acc']
+    return {'name': name,
+            'status': status,
+            'epochs': len(val_acc),
+            'best_val_acc': max(val_acc),
+            'best_epoch': int(np.argmax(val_acc)) + 1,
+            'seconds': time.perf_counter() - start_time}
+
+
+def run_trials(trials,
+               n_epochs=100,
+               n_workers=None,
+               threads_per_trial=None,
+               study=None,
+               save_as=None,
+               data_path='../data/0002_array_data/',
+               model_path=MODEL_PATH,
+               db_path=HISTORY_DB,
+               min_epochs=10,
+               window=5,
+               margin=0.05):
+
+    """
+    Runs a set of trials in parallel, each in its own worker process with a fixed share of the CPU threads, instead of
+    one after another in a notebook. Every epoch of every trial is recorded in the shared history store, where the
+    trials also see each other's progress so that clearly losing trials can be stopped early (see should_prune). When
+    all trials are done the winner (highest val_acc) can be promoted through save_best, which keeps it under save_as
+    and sends the other trials' models to the trash.
+
+    Paramters:
+        trials: (list) pairs of trial name and trial settings, eg. from expand_search_space
+        n_epochs: (int) maximum number of epochs per trial
+        n_workers: (int) number of trials run at the same time (defaults to the number of cores divided by
+        threads_per_trial, and at most the number of trials)
+        threads_per_trial: (int) number of CPU threads given to each trial (defaults to the number of cores divided by
+        n_workers)
+        study: (string with quotes) name grouping the trials in the history store (defaults to the first trial's
+        model number, eg. 'm14')
+        save_as: (string with quotes) name under which the winning model is saved (eg. 'model_14'); None keeps all
+        trial models and promotes nothing
+        data_path: (string with quotes) base path of the array data directory
+        model_path: (string with quotes) directory the trial models and histories are saved to
+        db_path: (string with quotes) path of the shared history store
+        min_epochs, window, margin: early stopping settings (see should_prune)
+
+    Returns:
+        summary: dataframe with one row per trial (status, epochs run, best val_acc and epoch, seconds), best first
+    """
+
+    n_cores = os.cpu_count() or 1
+    if n_workers is None:
+        n_workers = n_cores // threads_per_trial if threads_per_trial else n_cores
+    n_workers = max(1, min(n_workers, len(trials)))
+    threads_per_trial = threads_per_trial or max(1, n_cores // n_workers)
+    study = study or trials[0][0].split('_')[0]
+    runs = [name for name, _ in trials]
+    prune_params = {'min_epochs': min_epochs, 'window': window, 'margin': margin}
+
+    store = HistoryStore(db_path)
+    for name, settings in trials:
+        store.start_run(name, study=study, config=settings)
+
+    print(f'Running {len(trials)} trials on {n_workers} workers with {threads_per_trial} threads each')
+
+    results = []
+    # spawned (not forked) workers, so that each one initializes its own tensorflow runtime with its thread cap
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(threads_per_trial,)) as executor:
+        futures = {executor.submit(run_trial, name, settings, runs, n_epochs, threads_per_trial, data_path,
+                                   model_path, db_path, prune_params): name for name, settings in trials}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                store.finish_run(name, 'failed')
+                result = {'name': name, 'status': 'failed', 'error': repr(e)}
+            results.append(result)
+            print(f"{name} {result['status']}" + (f": best val_acc {round(result['best_val_acc'],4)} at epoch "
+                                                  f"{result['best_epoch']}" if 'best_val_acc' in result else ''))
+
+    store.close()
+    summary = pd.DataFrame(results)
+    if 'best_val_acc' not in summary:
+        print('All trials failed')
+        return summary
+    summary = summary.sort_values('best_val_acc', ascending=False, na_position='last').reset_index(drop=True)
+
+    if save_as:
+        from functions.save_best import save_best
+
+        best_name = summary.loc[0, 'name']
+        with open(f'{model_path}{best_name}_history', 'rb') as file:
+            best_history = pickle.load(file)
+        save_best(runs, best_history, best_name=best_name, save_as=save_as, model_path=model_path)
+
+    return summary